@@ -3,13 +3,19 @@
 import os
 import sys
 import time
+import atexit
 import logging
 import logging.handlers
 from os.path import expanduser
 from optparse import OptionParser
 
-from src import MangaBase
-from src.plugins import MangaFoxPlugin, MangaParkPlugin
+from src import MangaBase, MangaZipper, Metrics, Tracing, Profiling
+from src.ImageWriter import ImageWriter
+from src.ImageProcessing import Transcoder, TRANSCODE_FORMATS
+from src.PageFilter import PageFilter, FILTER_MODES
+from src.Planner import Planner, HostStatistics
+from src.JobScheduler import JobScheduler, load_job_file, DEFAULT_MAX_WORKERS
+from src import plugins
 
 
 APP_NAME = 'MangaLoader'
@@ -53,6 +59,49 @@ def create_logger():
 #  python3 MangaLoader.py -m MangaPark -n "Fairy Tail" -c 9 -o .
 
 
+def get_loader_options(options, parser):
+    """
+    Returns keyword arguments for all Loader objects from the command line
+    options. Invalid options are reported by the parser.
+    """
+    transcoder = None
+    if options.transcode:
+        transcoder = Transcoder(options.transcode, options.quality, options.max_dimension,
+                                options.keep_original is not None)
+    page_filter = None
+    if options.filter_pages:
+        try:
+            page_filter = PageFilter(options.filter_pages, options.blocklist, threshold=options.hash_threshold)
+        except (OSError, ValueError) as e:
+            parser.error('could not create page filter: {}'.format(e))
+    return dict(image_writer=ImageWriter(fsync_batch=options.fsync_batch),
+                compression_policy=MangaZipper.CompressionPolicy(options.compression, options.compression_level),
+                postprocess_workers=options.postprocess_workers, transcoder=transcoder, page_filter=page_filter,
+                host_statistics=HostStatistics())
+
+
+def run_jobs(options, parser):
+    """Loads all jobs from the job file given on the command line in this process."""
+    start_time = time.time()
+    try:
+        jobs = load_job_file(options.jobs)
+    except (OSError, ValueError) as e:
+        logger.error('Could not read job file: {}'.format(e))
+        sys.exit(1)
+    logger.info('running {} jobs with {} workers'.format(len(jobs), options.workers))
+    loader_options = get_loader_options(options, parser)
+    scheduler = JobScheduler(jobs, max_workers=options.workers, **loader_options)
+    success = scheduler.run()
+    loader_options['host_statistics'].save()
+    print(scheduler.format_report())
+    if options.report:
+        scheduler.write_report(options.report)
+    print(('Elapsed Time: %.2f s' % (time.time() - start_time)))
+    logger.info('MangaLoader done')
+    if not success:
+        sys.exit(1)
+
+
 def parse_and_load():
 
     #####
@@ -72,11 +121,94 @@ def parse_and_load():
     parser.add_option('-m',
                       action='store',
                       dest='module',
-                      help='specify the used module (currently supported: MangaFox, MangaPark)')
+                      help='specify the used module (currently supported: {})'.format(
+                          ', '.join(plugins.get_plugin_names())))
     parser.add_option('-z',
                       action='store_true',
                       dest='zip',
                       help='create cbz files')
+    parser.add_option('--archive-only',
+                      action='store_true',
+                      dest='archive_only',
+                      help='write images directly into cbz files without storing image files (implies -z), '
+                           'images are not post processed by the module and cannot be transcoded or filtered')
+    parser.add_option('--compression',
+                      action='store',
+                      type='choice',
+                      choices=MangaZipper.COMPRESSION_MODES,
+                      dest='compression',
+                      default='auto',
+                      help='compression of cbz files: auto, store or deflate (default: auto)')
+    parser.add_option('--compression-level',
+                      action='store',
+                      type='int',
+                      dest='compression_level',
+                      default=6,
+                      metavar='LEVEL',
+                      help='compression level for deflated files in cbz files, 0-9 (default: 6)')
+    parser.add_option('--zip-workers',
+                      action='store',
+                      type='int',
+                      dest='zip_workers',
+                      default=1,
+                      metavar='N',
+                      help='create cbz files in N processes after all chapters were loaded (default: 1)')
+    parser.add_option('--postprocess-workers',
+                      action='store',
+                      type='int',
+                      dest='postprocess_workers',
+                      default=0,
+                      metavar='N',
+                      help='post process images in N separate processes (default: 0 = while loading)')
+    parser.add_option('--transcode',
+                      action='store',
+                      type='choice',
+                      choices=sorted(TRANSCODE_FORMATS),
+                      dest='transcode',
+                      metavar='FORMAT',
+                      help='transcode images after loading them (webp or jpeg)')
+    parser.add_option('--quality',
+                      action='store',
+                      type='int',
+                      dest='quality',
+                      help='quality for transcoded images, images already in the target format are only '
+                           're-encoded if it is given (default: 80)')
+    parser.add_option('--max-dimension',
+                      action='store',
+                      type='int',
+                      dest='max_dimension',
+                      metavar='PIXELS',
+                      help='downscale transcoded images to the given maximum width and height')
+    parser.add_option('--keep-original',
+                      action='store_true',
+                      dest='keep_original',
+                      help='keep original images with suffix .orig after transcoding')
+    parser.add_option('--filter-pages',
+                      action='store',
+                      type='choice',
+                      choices=FILTER_MODES,
+                      dest='filter_pages',
+                      metavar='MODE',
+                      help='find duplicated and blocklisted pages and mark, skip or drop them')
+    parser.add_option('--blocklist',
+                      action='store',
+                      type='string',
+                      dest='blocklist',
+                      metavar='FILE',
+                      help='file with perceptual hashes of pages to filter, one per line')
+    parser.add_option('--hash-threshold',
+                      action='store',
+                      type='int',
+                      dest='hash_threshold',
+                      default=4,
+                      metavar='BITS',
+                      help='maximum number of different bits for matching pages (default: 4)')
+    parser.add_option('--volume',
+                      action='store',
+                      type='int',
+                      dest='volume',
+                      metavar='VOLUME',
+                      help='bundle all loaded chapters into a single cbz file for the given volume number')
     parser.add_option('-n',
                       action='store',
                       type='string',
@@ -95,13 +227,125 @@ def parse_and_load():
                       dest='output',
                       metavar='DEST_DIR',
                       help='destination directory')
+    parser.add_option('--plan',
+                      action='store_true',
+                      dest='plan',
+                      help='only estimate requests, size and time for loading the chapters without loading images')
+    parser.add_option('--jobs',
+                      action='store',
+                      type='string',
+                      dest='jobs',
+                      metavar='FILE',
+                      help='load all jobs from a JSON, TOML or YAML file instead of -m, -n, -c and -o')
+    parser.add_option('--workers',
+                      action='store',
+                      type='int',
+                      dest='workers',
+                      default=DEFAULT_MAX_WORKERS,
+                      metavar='N',
+                      help='load at most N chapters at the same time for all jobs (default: {})'.format(
+                          DEFAULT_MAX_WORKERS))
+    parser.add_option('--report',
+                      action='store',
+                      type='string',
+                      dest='report',
+                      metavar='FILE',
+                      help='write results of all jobs as JSON file')
+    parser.add_option('--fsync-batch',
+                      action='store',
+                      type='int',
+                      dest='fsync_batch',
+                      default=0,
+                      metavar='N',
+                      help='sync images to disk after every N files (default: 0 = never)')
+    parser.add_option('--metrics-port',
+                      action='store',
+                      type='int',
+                      dest='metrics_port',
+                      metavar='PORT',
+                      help='serve Prometheus metrics of all stages on http://127.0.0.1:PORT/metrics')
+    parser.add_option('--metrics-file',
+                      action='store',
+                      type='string',
+                      dest='metrics_file',
+                      metavar='FILE',
+                      help='write Prometheus metrics of all stages to a file at exit')
+    parser.add_option('--trace',
+                      action='store',
+                      type='string',
+                      dest='trace',
+                      metavar='FILE',
+                      help='write spans of all operations as Chrome trace file (for chrome://tracing or Perfetto)')
+    parser.add_option('--record',
+                      action='store',
+                      type='string',
+                      dest='record',
+                      metavar='FILE',
+                      help='record all HTTP responses in a compressed cassette file')
+    parser.add_option('--replay',
+                      action='store',
+                      type='string',
+                      dest='replay',
+                      metavar='FILE',
+                      help='answer all HTTP requests from a cassette file without accessing the network')
+    parser.add_option('--replay-latency',
+                      action='store',
+                      type='int',
+                      dest='replay_latency',
+                      default=0,
+                      metavar='MS',
+                      help='delay every replayed response by MS milliseconds (default: 0)')
+    parser.add_option('--profile',
+                      action='store',
+                      type='choice',
+                      choices=Profiling.PROFILE_MODES,
+                      dest='profile',
+                      metavar='MODE',
+                      help='profile cpu or mem usage of every stage and print a summary at exit')
+    parser.add_option('--profile-dir',
+                      action='store',
+                      type='string',
+                      dest='profile_dir',
+                      default=Profiling.DEFAULT_PROFILE_DIR,
+                      metavar='DIR',
+                      help='directory for .pstats files or memory snapshots (default: {})'.format(
+                          Profiling.DEFAULT_PROFILE_DIR))
 
     (options, args) = parser.parse_args()
 
+    if options.compression_level not in MangaZipper.COMPRESSION_LEVELS:
+        parser.error('compression level must be between {} and {}'.format(MangaZipper.COMPRESSION_LEVELS[0],
+                                                                          MangaZipper.COMPRESSION_LEVELS[-1]))
+    if options.archive_only and (options.transcode or options.filter_pages):
+        parser.error('--archive-only cannot be combined with --transcode or --filter-pages')
+
     if options.version is not None:
         print('{} {}'.format(APP_NAME, APP_VERSION))
         sys.exit()
 
+    if options.metrics_port is not None:
+        Metrics.start_http_server(options.metrics_port)
+    if options.metrics_file is not None:
+        atexit.register(Metrics.dump, options.metrics_file)
+    if options.trace is not None:
+        Tracing.enable()
+        atexit.register(Tracing.save, options.trace)
+    if options.profile is not None:
+        Profiling.start(options.profile, options.profile_dir)
+        atexit.register(Profiling.finish)
+    if options.record is not None or options.replay is not None:
+        # requests is only imported when a cassette is used
+        from src.Cassette import Cassette
+        if options.replay is not None:
+            cassette = Cassette(options.replay, 'replay', latency=options.replay_latency / 1000)
+        else:
+            cassette = Cassette(options.record, 'record')
+        cassette.install()
+        atexit.register(cassette.uninstall)
+
+    if options.jobs is not None:
+        return run_jobs(options, parser)
+
     if options.module is None:
         logger.error('Missing module.')
         parser.print_usage()
@@ -130,7 +374,7 @@ def parse_and_load():
                 parser.print_usage()
                 sys.exit()
 
-    if not options.module.lower() in ('mangafox', 'mangapark'):
+    if not options.module.lower() in plugins.get_plugin_names():
         logger.error('Unknown module.')
         parser.print_usage()
         sys.exit()
@@ -149,23 +393,26 @@ def parse_and_load():
     do_zip = options.zip is not None
 
     logger.info('loading plugin')
-    if options.module.lower() == 'mangafox':
-        plugin = MangaFoxPlugin.MangaFoxPlugin()
-        logger.debug('using MangaFox plugin')
-    elif options.module.lower() == 'mangapark':
-        plugin = MangaParkPlugin.MangaParkPlugin()
-        logger.debug('using MangaPark plugin')
-    else:
-        plugin = MangaFoxPlugin.MangaFoxPlugin()
-        logger.warning('using MangaFox plugin because no plugin was given')
+    plugin = plugins.create_plugin(options.module)
+    logger.debug('using {} plugin'.format(plugin.__class__.__name__))
 
     logger.info('loading Loader')
-    loader = MangaBase.Loader(plugin, dest_dir)
+    loader_options = get_loader_options(options, parser)
+    transcoder = loader_options['transcoder']
+    loader = MangaBase.Loader(plugin, dest_dir, archive_only=bool(options.archive_only), **loader_options)
 
     logger.info('loading chapters ' + str(chapter))
-    manga = loader.get_manga_by_name(manga_name)
-    # TODO: Check whether manga with given name exists.
-    chapter_list = loader.get_all_chapters(manga)
+    with Tracing.span('manga', 'manga', manga=manga_name, plugin=options.module):
+        manga = loader.get_manga_by_name(manga_name)
+        # TODO: Check whether manga with given name exists.
+        chapter_list = loader.get_all_chapters(manga)
+    if options.plan:
+        planner = Planner(loader, host_statistics=loader.host_statistics)
+        chapters = [c for c in chapter_list if c.chapterNo in chapter]
+        print(planner.format_report(planner.plan(manga, chapters)))
+        return
+    chapters_to_zip = []
+    loaded_chapters = []
     for no in chapter:
         # find chapter object
         current_chapter = None
@@ -175,10 +422,21 @@ def parse_and_load():
                 break
         if current_chapter:
             loader.handle_chapter(current_chapter)
-            if do_zip:
+            loaded_chapters.append(current_chapter)
+            if do_zip and options.zip_workers > 1:
+                chapters_to_zip.append(current_chapter)
+            elif do_zip:
                 loader.zip_chapter(manga, current_chapter)
         else:
             logger.error('Could not find object for chapter {}.'.format(no))
+    if chapters_to_zip:
+        loader.zip_chapters(manga, chapters_to_zip, max_workers=options.zip_workers)
+    if options.volume is not None:
+        loader.bundle_volume(manga, loaded_chapters, options.volume)
+    loader.close()
+    loader.host_statistics.save()
+    if transcoder:
+        print('Transcoded: {}'.format(loader.transcode_statistics))
 
     end_time = time.time()
     logger.debug('end time: %.2f s' % end_time)
@@ -5,10 +5,12 @@ import sys
 import logging
 import logging.handlers
 from os.path import expanduser
+from optparse import OptionParser
 
 from PyQt4 import QtGui
 
 from gui import loader
+from src import Profiling
 
 
 APP_NAME = 'MangaLoaderGUI'
@@ -47,9 +49,34 @@ def create_logger():
 #  <module>
 # -------------------------------------------------------------------------------------------------
 
+def parse_options():
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option('--profile',
+                      action='store',
+                      type='choice',
+                      choices=Profiling.PROFILE_MODES,
+                      dest='profile',
+                      metavar='MODE',
+                      help='profile cpu or mem usage of every stage and print a summary at exit')
+    parser.add_option('--profile-dir',
+                      action='store',
+                      type='string',
+                      dest='profile_dir',
+                      default=Profiling.DEFAULT_PROFILE_DIR,
+                      metavar='DIR',
+                      help='directory for .pstats files or memory snapshots (default: {})'.format(
+                          Profiling.DEFAULT_PROFILE_DIR))
+    # all other arguments are handed over to Qt
+    parser.disable_interspersed_args()
+    return parser.parse_args()
+
+
 def startGUI():
     logger.info('MangaLoaderGUI started.')
-    app = QtGui.QApplication(sys.argv)
+    options, args = parse_options()
+    if options.profile is not None:
+        Profiling.start(options.profile, options.profile_dir)
+    app = QtGui.QApplication(sys.argv[:1] + args)
     app.setApplicationName(APP_NAME)
     main = QtGui.QMainWindow()
     main.setWindowTitle('MangaLoader')
@@ -57,8 +84,10 @@ def startGUI():
     loader_window = loader.LoaderWindow(main)
     main.setCentralWidget(loader_window)
     main.show()
-    sys.exit(app.exec_())
+    result = app.exec_()
+    Profiling.finish()
     logger.info('MangaLoaderGUI done.')
+    sys.exit(result)
 
 
 if __name__ == '__main__':
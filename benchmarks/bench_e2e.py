@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+"""
+End-to-end benchmark for loading chapters. A local mock site shaped like
+MangaFox (see benchmarks/mock_site.py) is served with the given latency,
+bandwidth and error rate and all chapters of one manga are loaded through the
+real MangaFox plugin by several engine configurations. For each configuration
+the throughput in images/s and MB/s, the median and 99th percentile of the
+latency per image and the CPU usage are printed.
+
+Run from the repository root with:
+    python3 -m benchmarks.bench_e2e [chapters] [pages] [latency in ms] [bandwidth in KB/s] [error rate]
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+
+from benchmarks.mock_site import MockSite
+from src import MangaBase
+from src import Tracing
+from src.JobScheduler import JobScheduler, Job
+from src.helper import CachedFunction
+from src.plugins import MangaFoxPlugin
+
+
+CHAPTER_COUNT = 4
+PAGE_COUNT = 20
+LATENCY = 10
+BANDWIDTH = 0
+ERROR_RATE = 0.0
+MANGA_NO = 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+# -------------------------------------------------------------------------------------------------
+#  engine configurations
+# -------------------------------------------------------------------------------------------------
+def load_with_loader(site, target_dir, **loader_options):
+    loader = MangaBase.Loader(MangaFoxPlugin.MangaFoxPlugin(), target_dir, pickle_data=False, **loader_options)
+    manga = loader.get_manga_by_name(site.get_manga_name(MANGA_NO))
+    for chapter in loader.get_all_chapters(manga):
+        loader.handle_chapter(chapter)
+    loader.close()
+
+
+def load_with_scheduler(site, target_dir, max_workers):
+    job = Job('mangafox', site.get_manga_name(MANGA_NO), list(range(1, site.chapter_count + 1)), target_dir)
+    scheduler = JobScheduler([job], {'mangafox': MangaFoxPlugin.MangaFoxPlugin}, max_workers=max_workers)
+    scheduler.run()
+
+
+CONFIGURATIONS = [
+    ('Loader', lambda site, target_dir: load_with_loader(site, target_dir)),
+    ('Loader, archive only', lambda site, target_dir: load_with_loader(site, target_dir, archive_only=True)),
+    ('Loader, 2 postprocess workers',
+     lambda site, target_dir: load_with_loader(site, target_dir, postprocess_workers=2)),
+    ('JobScheduler, 4 workers', lambda site, target_dir: load_with_scheduler(site, target_dir, 4)),
+]
+
+
+def clear_plugin_caches(plugin_class):
+    """Clears the results cached by a plugin, which are shared by all of its instances in this process."""
+    for value in vars(plugin_class).values():
+        if isinstance(value, CachedFunction):
+            value.cache_clear()
+
+
+def run(name, load_function, site):
+    # every configuration has to load the catalog, chapter lists and page URLs itself
+    clear_plugin_caches(MangaFoxPlugin.MangaFoxPlugin)
+    target_dir = tempfile.mkdtemp(prefix='bench_e2e_')
+    working_dir = os.getcwd()
+    # the job scheduler stores the catalog in the working directory
+    os.chdir(target_dir)
+    request_count, error_count = site.request_count, site.error_count
+    Tracing.enable()
+    try:
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        start_children = os.times()
+        load_function(site, target_dir)
+        elapsed = time.perf_counter() - start_time
+        end_children = os.times()
+        cpu = time.process_time() - start_cpu
+        cpu += (end_children.children_user + end_children.children_system
+                - start_children.children_user - start_children.children_system)
+    finally:
+        tracer = Tracing.disable()
+        os.chdir(working_dir)
+        shutil.rmtree(target_dir)
+    events = [e for e in tracer.events if e['ph'] == 'X']
+    latencies = [e['dur'] / 1000 for e in events if e['name'] == 'image']
+    image_count = sum(1 for e in events if e['name'] == 'write')
+    size = sum(e['args'].get('size', 0) for e in events if e['name'] == 'write')
+    print('{:<32} {:>8.1f} img/s {:>8.1f} MB/s {:>8.1f} ms p50 {:>8.1f} ms p99 {:>6.0f} % CPU'
+          '  ({} images, {} requests, {} errors)'.format(
+              name, image_count / elapsed, size / 1024 / 1024 / elapsed, percentile(latencies, 0.5),
+              percentile(latencies, 0.99), cpu / elapsed * 100, image_count, site.request_count - request_count,
+              site.error_count - error_count))
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    chapter_count = int(sys.argv[1]) if len(sys.argv) > 1 else CHAPTER_COUNT
+    page_count = int(sys.argv[2]) if len(sys.argv) > 2 else PAGE_COUNT
+    latency = int(sys.argv[3]) if len(sys.argv) > 3 else LATENCY
+    bandwidth = int(sys.argv[4]) * 1024 if len(sys.argv) > 4 else BANDWIDTH
+    error_rate = float(sys.argv[5]) if len(sys.argv) > 5 else ERROR_RATE
+    # failed requests are expected with an error rate and counted in the results
+    logging.basicConfig(level=logging.ERROR)
+    site = MockSite(chapter_count=chapter_count, page_count=page_count, latency=latency / 1000,
+                    bandwidth=bandwidth, error_rate=error_rate)
+    site.start()
+    # let the plugin load its catalog from the mock site
+    MangaFoxPlugin.MANGA_LIST_URL = site.manga_list_url
+    print('{} chapters with {} pages, {} ms latency, {} bandwidth, {:.0%} errors'.format(
+        chapter_count, page_count, latency, '{} KB/s'.format(bandwidth // 1024) if bandwidth else 'unlimited',
+        error_rate))
+    for name, load_function in CONFIGURATIONS:
+        run(name, load_function, site)
+    site.stop()
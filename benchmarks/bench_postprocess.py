@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for cropping ad bands from manga pages. All images of a directory
+are copied to a temporary directory and cropped once in the current process
+and once in a pool of processes. If no directory is given, synthetic pages
+with a colored ad band at the bottom are generated.
+
+Run from the repository root with:
+    python3 -m benchmarks.bench_postprocess [image directory] [number of processes]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy
+import PIL.Image
+
+from src import ImageProcessing
+
+
+SYNTHETIC_PAGE_COUNT = 40
+
+
+def create_pages(target_dir, page_count):
+    for i in range(page_count):
+        page = numpy.full((1600, 1100, 3), 255, dtype=numpy.uint8)
+        page[60:1450, 50:1050] = numpy.random.randint(0, 255, (1390, 1000, 1), dtype=numpy.uint8)
+        page[1520:1600, :, 0] = 230
+        page[1520:1600, :, 1] = numpy.random.randint(0, 80, (80, 1100), dtype=numpy.uint8)
+        PIL.Image.fromarray(page).save(os.path.join(target_dir, '{:03d}.jpg'.format(i)), quality=90)
+
+
+def run(name, source_dir, max_workers):
+    work_dir = tempfile.mkdtemp(prefix='bench_postprocess_')
+    try:
+        files = []
+        for f in sorted(os.listdir(source_dir)):
+            shutil.copy(os.path.join(source_dir, f), work_dir)
+            files.append(os.path.join(work_dir, f))
+        start_time = time.perf_counter()
+        if max_workers:
+            pool = ImageProcessing.ImageProcessingPool(max_workers)
+            for f in files:
+                pool.submit(ImageProcessing.crop_bands, f)
+            cropped = sum(1 for result in pool.wait() if result)
+            pool.shutdown()
+        else:
+            cropped = sum(1 for f in files if ImageProcessing.crop_bands(f))
+        elapsed = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(work_dir)
+    print('{:<24} {:>8.1f} pages/s ({} of {} pages cropped)'.format(name, len(files) / elapsed, cropped, len(files)))
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    if len(sys.argv) > 1:
+        source_dir = sys.argv[1]
+        temp_dir = None
+    else:
+        temp_dir = source_dir = tempfile.mkdtemp(prefix='bench_postprocess_src_')
+        create_pages(source_dir, SYNTHETIC_PAGE_COUNT)
+    try:
+        run('current process', source_dir, 0)
+        run('{} processes'.format(max_workers), source_dir, max_workers)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for the start up time of the command line interface. Every command
+is run several times in a new interpreter and the median of the wall clock
+time is printed. Additionally the modules with the longest import time for
+"--version" are listed, as reported by "python -X importtime".
+
+Run from the repository root with:
+    python3 -m benchmarks.bench_startup [number of runs]
+"""
+
+import os
+import sys
+import time
+import statistics
+import subprocess
+
+
+RUN_COUNT = 10
+TOP_IMPORTS = 10
+
+COMMANDS = [
+    ('interpreter only', ['-c', 'pass']),
+    ('MangaLoader.py --version', ['MangaLoader.py', '--version']),
+    ('MangaLoader.py --help', ['MangaLoader.py', '--help']),
+    ('import src.MangaBase', ['-c', 'import src.MangaBase']),
+    ('import MangaFox plugin', ['-c', 'from src import plugins; plugins.get_plugin_class("mangafox")']),
+]
+
+
+def run(name, arguments, run_count):
+    times = []
+    for _ in range(run_count):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - start_time)
+    print('{:<32} {:>8.1f} ms (min {:.1f} ms)'.format(name, statistics.median(times) * 1000, min(times) * 1000))
+
+
+def print_top_imports(arguments):
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        # nested imports are indented, only count top level imports
+        if module.startswith('  '):
+            continue
+        imports.append((int(cumulative), module.strip()))
+    print('\nslowest top level imports for {}:'.format(' '.join(arguments)))
+    for cumulative, module in sorted(imports, reverse=True)[:TOP_IMPORTS]:
+        print('  {:<40} {:>8.1f} ms'.format(module, cumulative / 1000))
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    run_count = int(sys.argv[1]) if len(sys.argv) > 1 else RUN_COUNT
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    # create plugin manifest before measuring
+    subprocess.run([sys.executable, 'MangaLoader.py', '--help'], stdout=subprocess.DEVNULL, check=True)
+    for name, arguments in COMMANDS:
+        run(name, arguments, run_count)
+    print_top_imports(['MangaLoader.py', '--version'])
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for writing downloaded images to disk. A local HTTP server delivers
+random image data which is stored by different writer configurations. For each
+configuration the throughput in MB/s and the CPU time per GB is printed.
+
+Run from the repository root with:
+    python3 -m benchmarks.bench_writer [image count] [image size in KB]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from src.ImageWriter import ImageWriter
+
+
+IMAGE_COUNT = 200
+IMAGE_SIZE = 512 * 1024
+
+
+# -------------------------------------------------------------------------------------------------
+#  local image server
+# -------------------------------------------------------------------------------------------------
+def start_server(payload):
+    class ImageHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# -------------------------------------------------------------------------------------------------
+#  writer variants
+# -------------------------------------------------------------------------------------------------
+def write_with_iteration(response, file_name):
+    """Writes the response like before: iterating over 128 byte chunks and creating directories every time."""
+    try:
+        os.makedirs(os.path.dirname(file_name))
+    except OSError:
+        pass
+    with open(file_name, 'wb') as f:
+        for chunk in response:
+            f.write(chunk)
+
+
+def make_writer_variant(writer):
+    def write_with_writer(response, file_name):
+        response.raw.decode_content = True
+        writer.write_stream(response.raw, file_name, expected_length=int(response.headers['content-length']))
+    return write_with_writer
+
+
+def run(name, write_function, url, image_count, image_size, flush=None):
+    session = requests.Session()
+    target_dir = tempfile.mkdtemp(prefix='bench_writer_')
+    try:
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        for i in range(image_count):
+            response = session.get(url, stream=True)
+            write_function(response, os.path.join(target_dir, 'Manga', 'Manga 001', '{:03d}.jpg'.format(i)))
+        if flush:
+            flush()
+        elapsed = time.perf_counter() - start_time
+        cpu = time.process_time() - start_cpu
+    finally:
+        shutil.rmtree(target_dir)
+    total_gb = image_count * image_size / 1024 ** 3
+    print('{:<32} {:>10.1f} MB/s {:>10.2f} s CPU/GB'.format(name, total_gb * 1024 / elapsed, cpu / total_gb))
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    image_count = int(sys.argv[1]) if len(sys.argv) > 1 else IMAGE_COUNT
+    image_size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else IMAGE_SIZE
+    server = start_server(os.urandom(image_size))
+    url = 'http://127.0.0.1:{}/image.jpg'.format(server.server_address[1])
+    print('{} images with {} KB each'.format(image_count, image_size // 1024))
+    run('iterate response (128 B)', write_with_iteration, url, image_count, image_size)
+    for fsync_batch in (0, 1, 50):
+        writer = ImageWriter(fsync_batch=fsync_batch)
+        run('ImageWriter (fsync batch {})'.format(fsync_batch), make_writer_variant(writer),
+            url, image_count, image_size, flush=writer.flush)
+    server.shutdown()
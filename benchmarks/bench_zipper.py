@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+"""
+Benchmark for creating CBZ files. Synthetic chapters with incompressible page
+data (like JPEG files) are archived with every compression policy, once one
+after another and once in a pool of processes. For each run the time per
+chapter and the total size of all archives is printed.
+
+Run from the repository root with:
+    python3 -m benchmarks.bench_zipper [chapter count] [pages per chapter]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from src import MangaZipper
+
+
+CHAPTER_COUNT = 16
+PAGE_COUNT = 20
+PAGE_SIZE = 300 * 1024
+
+
+def create_chapters(base_dir, chapter_count, page_count):
+    chapter_dirs = []
+    for c in range(1, chapter_count + 1):
+        chapter_dir = os.path.join(base_dir, 'Manga {:03d}'.format(c))
+        os.makedirs(chapter_dir)
+        for p in range(1, page_count + 1):
+            with open(os.path.join(chapter_dir, '{:03d}.jpg'.format(p)), 'wb') as f:
+                f.write(os.urandom(PAGE_SIZE))
+        chapter_dirs.append(chapter_dir)
+    return chapter_dirs
+
+
+def run(name, chapter_dirs, policy, max_workers):
+    dest_dir = tempfile.mkdtemp(prefix='bench_zipper_dest_')
+    try:
+        start_time = time.perf_counter()
+        MangaZipper.create_zips([(d, dest_dir) for d in chapter_dirs], policy, max_workers)
+        elapsed = time.perf_counter() - start_time
+        size = sum(os.path.getsize(os.path.join(dest_dir, f)) for f in os.listdir(dest_dir))
+    finally:
+        shutil.rmtree(dest_dir)
+    print('{:<36} {:>8.3f} s/chapter {:>10.1f} MB'.format(name, elapsed / len(chapter_dirs), size / 1024 ** 2))
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    chapter_count = int(sys.argv[1]) if len(sys.argv) > 1 else CHAPTER_COUNT
+    page_count = int(sys.argv[2]) if len(sys.argv) > 2 else PAGE_COUNT
+    source_dir = tempfile.mkdtemp(prefix='bench_zipper_src_')
+    try:
+        chapter_dirs = create_chapters(source_dir, chapter_count, page_count)
+        print('{} chapters with {} pages of {} KB'.format(chapter_count, page_count, PAGE_SIZE // 1024))
+        for policy in (MangaZipper.CompressionPolicy('deflate', 6), MangaZipper.CompressionPolicy('deflate', 1),
+                       MangaZipper.CompressionPolicy('auto'), MangaZipper.CompressionPolicy('store')):
+            run('{}, serial'.format(policy), chapter_dirs, policy, 1)
+            run('{}, {} processes'.format(policy, os.cpu_count()), chapter_dirs, policy, None)
+    finally:
+        shutil.rmtree(source_dir)
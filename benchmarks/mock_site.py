@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+
+"""
+Local mock of a manga site that is shaped like the MangaFox pages in
+testdata/MangaFox. It serves a catalog, chapter lists, image pages and
+synthetic JPEG images, so that the real MangaFox plugin can be driven
+without network access. Latency, bandwidth and the error rate of image
+requests can be configured.
+
+Serve a site for manual tests from the repository root with:
+    python3 -m benchmarks.mock_site [port]
+"""
+
+import io
+import re
+import sys
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+import PIL.Image
+
+
+MANGA_COUNT = 50
+CHAPTER_COUNT = 10
+PAGE_COUNT = 20
+# number of different images, all pages reuse these images
+DISTINCT_IMAGES = 4
+CHUNK_SIZE = 16 * 1024
+
+
+def create_image(seed, image_size=0):
+    """
+    Creates a JPEG image of a manga page with a colored ad band at the bottom.
+    If the image is smaller than the given size, it is padded after the end
+    of the JPEG data, which is ignored by all decoders.
+    """
+    generator = numpy.random.default_rng(seed)
+    page = numpy.full((1600, 1100, 3), 255, dtype=numpy.uint8)
+    page[60:1450, 50:1050] = generator.integers(0, 255, (1390, 1000, 1), dtype=numpy.uint8)
+    page[1520:1600, :, 0] = 230
+    page[1520:1600, :, 1] = generator.integers(0, 80, (80, 1100), dtype=numpy.uint8)
+    buffer = io.BytesIO()
+    PIL.Image.fromarray(page).save(buffer, 'JPEG', quality=90)
+    data = buffer.getvalue()
+    if len(data) < image_size:
+        data += bytes(image_size - len(data))
+    return data
+
+
+# -------------------------------------------------------------------------------------------------
+#  MockSite class
+# -------------------------------------------------------------------------------------------------
+class MockSite(object):
+    """
+    Serves a synthetic manga site on a local port in a background thread.
+
+    :param manga_count: number of manga in the catalog
+    :param chapter_count: number of chapters of every manga
+    :param page_count: number of pages of every chapter
+    :param latency: delay in seconds before every response is sent
+    :param bandwidth: maximum bytes per second for every response, 0 for unlimited
+    :param error_rate: fraction of image requests that are answered with status 503
+    :param image_size: minimum size of every image in bytes
+    :param seed: seed for the random errors
+    """
+    def __init__(self, manga_count=MANGA_COUNT, chapter_count=CHAPTER_COUNT, page_count=PAGE_COUNT, latency=0.0,
+                 bandwidth=0, error_rate=0.0, image_size=0, seed=42):
+        self.manga_count = manga_count
+        self.chapter_count = chapter_count
+        self.page_count = page_count
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.images = [create_image(i, image_size) for i in range(DISTINCT_IMAGES)]
+        self.request_count = 0
+        self.error_count = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}/'.format(self.__server.server_address[1])
+
+    @property
+    def manga_list_url(self):
+        return self.base_url + 'manga/'
+
+    @staticmethod
+    def get_manga_name(no):
+        return 'Mock Manga {:03d}'.format(no)
+
+    def start(self, port=0):
+        site = self
+
+        class MockSiteHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                site.handle_request(self)
+
+            def do_HEAD(self):
+                site.handle_request(self, send_body=False)
+
+            def log_message(self, format, *args):
+                pass
+
+        class MockSiteServer(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # clients close idle keep alive connections at any time
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        self.__server = MockSiteServer(('127.0.0.1', port), MockSiteHandler)
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    # ---------------------------------------------------------------------------------------------
+    #  pages
+    # ---------------------------------------------------------------------------------------------
+    def get_manga_list(self):
+        items = []
+        for no in range(1, self.manga_count + 1):
+            items.append('<li><a href="{}manga/mock_{:03d}/" rel="{}" class="series_preview manga_{}">{}</a>'
+                         '</li>'.format(self.base_url, no, no, 'open' if no % 2 else 'close',
+                                        self.get_manga_name(no)))
+        return ('<html><head><title>Manga Index - Mock</title></head><body><div class="manga_list">'
+                '<ul id="idx_m"><em>M</em><a href="#alpha" class="top"></a>{}</ul></div></body></html>').format(
+            '\n'.join(items))
+
+    def get_chapter_list(self, manga_no):
+        items = []
+        for no in range(self.chapter_count, 0, -1):
+            items.append('<li><div><span class="date">Mar 31, 2016</span><h3>'
+                         '<a href="{}manga/mock_{:03d}/v01/c{:03d}/1.html" class="tips">{} {}</a>'
+                         '<span class="title nowrap">Chapter title {}</span></h3></div></li>'.format(
+                             self.base_url, manga_no, no, self.get_manga_name(manga_no), no, no))
+        return ('<html><body><div id="chapters"><h2>{} Chapters</h2><ul class="chlist" style="display:block">{}'
+                '</ul></div></body></html>').format(self.get_manga_name(manga_no), '\n'.join(items))
+
+    def get_image_page(self, manga_no, chapter_no, page_no):
+        options = ''.join('<option value="{0}">{0}</option>'.format(i) for i in range(1, self.page_count + 1))
+        return ('<html><body><div class="r m"><div class="l">Page <select onchange="change_page(this)" class="m">'
+                '{}<option value="0">Comments</option></select> of {}</div></div><div id="viewer">'
+                '<div class="read_img"><a href="{}.html"><img src="{}store/{:03d}/{:03d}/{:03d}.jpg" id="image" '
+                'width="728"></a></div></div></body></html>').format(
+            options, self.page_count, page_no + 1, self.base_url, manga_no, chapter_no, page_no)
+
+    def handle_request(self, handler, send_body=True):
+        with self.__lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        path = handler.path.split('?', 1)[0]
+        content_type = 'text/html; charset=UTF-8'
+        body = None
+        if path == '/manga/':
+            body = self.get_manga_list()
+        elif re.fullmatch(r'/manga/mock_(\d+)/', path):
+            body = self.get_chapter_list(int(path.split('_')[1].strip('/')))
+        else:
+            match = re.fullmatch(r'/manga/mock_(\d+)/v01/c(\d+)/(\d+)\.html', path)
+            if match:
+                body = self.get_image_page(*map(int, match.groups()))
+            match = re.fullmatch(r'/store/(\d+)/(\d+)/(\d+)\.jpg', path)
+            if match:
+                with self.__lock:
+                    failed = self.__random.random() < self.error_rate
+                    self.error_count += failed
+                if failed:
+                    self.send(handler, 503, 'text/plain', b'Service Unavailable', send_body)
+                    return
+                manga_no, chapter_no, page_no = map(int, match.groups())
+                body = self.images[(manga_no + chapter_no + page_no) % len(self.images)]
+                content_type = 'image/jpeg'
+        if body is None:
+            self.send(handler, 404, 'text/plain', b'Not Found', send_body)
+            return
+        self.send(handler, 200, content_type, body if isinstance(body, bytes) else body.encode('utf-8'), send_body)
+
+    def send(self, handler, status, content_type, data, send_body=True):
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        if not send_body:
+            return
+        try:
+            if not self.bandwidth:
+                handler.wfile.write(data)
+                return
+            for start in range(0, len(data), CHUNK_SIZE):
+                chunk = data[start:start + CHUNK_SIZE]
+                handler.wfile.write(chunk)
+                time.sleep(len(chunk) / self.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    site = MockSite()
+    site.start(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    print('Serving mock manga site on {}'.format(site.manga_list_url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        site.stop()
@@ -0,0 +1,298 @@
+
+"""
+Background worker to download manga chapters without blocking the GUI.
+
+@author: Christian Wichmann
+"""
+
+
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt4 import QtCore
+
+from src.MangaBase import Loader
+from src.Planner import HostStatistics
+
+
+logger = logging.getLogger('MangaLoader.gui')
+
+# time in milliseconds after the last change of the chosen manga before its chapter list is loaded
+CHAPTER_LIST_DELAY = 300
+CHAPTER_LIST_CACHE_SIZE = 32
+
+
+class DownloadJob(object):
+    """
+    Chapters of a single manga that should be loaded by the download worker.
+
+    :param manga: Manga object of the series
+    :param chapter_list: list of Chapter objects to be loaded
+    :param store_directory: base directory for all manga series data
+    :param do_zip: create CBZ files after loading the chapters
+    """
+    def __init__(self, manga, chapter_list, store_directory, do_zip=False):
+        self.manga = manga
+        self.chapter_list = chapter_list
+        self.store_directory = store_directory
+        self.do_zip = do_zip
+        self.cancelled = False
+
+    def __str__(self):
+        return '{} ({} chapters)'.format(self.manga.name, len(self.chapter_list))
+
+
+class DownloadProgress(object):
+    """
+    Counts loaded images of a job and estimates throughput and remaining time.
+    Chapters that were not parsed yet are estimated with the average number of
+    images per chapter.
+    """
+    def __init__(self, chapter_count):
+        self.chapter_count = chapter_count
+        self.parsed_chapters = 0
+        self.known_images = 0
+        self.loaded_images = 0
+        self.start_time = time.monotonic()
+
+    def add_chapter(self, image_count):
+        self.parsed_chapters += 1
+        self.known_images += image_count
+
+    @property
+    def total_images(self):
+        """Returns the number of images of all chapters including the estimate for unparsed chapters."""
+        if not self.parsed_chapters:
+            return 0
+        average = self.known_images / self.parsed_chapters
+        return self.known_images + round(average * (self.chapter_count - self.parsed_chapters))
+
+    @property
+    def throughput(self):
+        """Returns the number of loaded images per second."""
+        elapsed = time.monotonic() - self.start_time
+        return self.loaded_images / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Returns the estimated remaining time in seconds or -1, if it is not known yet."""
+        throughput = self.throughput
+        if not throughput:
+            return -1.0
+        return max(self.total_images - self.loaded_images, 0) / throughput
+
+
+class DownloadWorker(QtCore.QThread):
+    """
+    Loads queued download jobs one after another in a background thread. The
+    progress is reported by signals, which are delivered to the GUI thread.
+    Loading can be paused and resumed, and the current job or all jobs can be
+    cancelled.
+
+    :param loader_plugin_class: class of the plugin to be used for loading
+    :param parent: parent object
+    """
+    # job name
+    job_started = QtCore.pyqtSignal(str)
+    # job name, true if all chapters were loaded
+    job_finished = QtCore.pyqtSignal(str, bool)
+    # chapter name, true if the chapter was loaded
+    chapter_finished = QtCore.pyqtSignal(str, bool)
+    # loaded images, total images, images per second, remaining seconds
+    image_progress = QtCore.pyqtSignal(int, int, float, float)
+    # number of waiting jobs
+    queue_changed = QtCore.pyqtSignal(int)
+
+    def __init__(self, loader_plugin_class, parent=None):
+        super(DownloadWorker, self).__init__(parent)
+        self.loader_plugin_class = loader_plugin_class
+        # observed throughput of image hosts, shared by the loaders of all jobs
+        self.host_statistics = HostStatistics()
+        self.__jobs = queue.Queue()
+        self.__current_job = None
+        self.__running = threading.Event()
+        self.__running.set()
+        self.__stopped = False
+
+    def add_job(self, job):
+        """Queues a job and starts the worker thread, if it is not running yet."""
+        self.__jobs.put(job)
+        self.queue_changed.emit(self.__jobs.qsize())
+        if not self.isRunning():
+            self.start()
+
+    def pause(self):
+        """Pauses loading after the current image."""
+        self.__running.clear()
+
+    def resume(self):
+        self.__running.set()
+
+    def is_paused(self):
+        return not self.__running.is_set()
+
+    def cancel(self):
+        """Cancels the current job after the current image."""
+        job = self.__current_job
+        if job:
+            job.cancelled = True
+        self.resume()
+
+    def cancel_all(self):
+        """Cancels the current job and removes all waiting jobs."""
+        try:
+            while True:
+                self.__jobs.get_nowait().cancelled = True
+        except queue.Empty:
+            pass
+        self.queue_changed.emit(0)
+        self.cancel()
+
+    def stop(self):
+        """Cancels all jobs and waits for the worker thread to end."""
+        self.__stopped = True
+        self.cancel_all()
+        # wake up worker thread waiting for new jobs
+        self.__jobs.put(None)
+        self.wait()
+
+    def run(self):
+        while not self.__stopped:
+            job = self.__jobs.get()
+            if job is None:
+                break
+            self.queue_changed.emit(self.__jobs.qsize())
+            if job.cancelled:
+                continue
+            self.__current_job = job
+            try:
+                success = self.load_job(job)
+            except Exception as e:
+                logger.exception('Loading of {} failed: {}'.format(job, e))
+                success = False
+            self.__current_job = None
+            self.job_finished.emit(str(job), success)
+
+    def load_job(self, job):
+        logger.info('Loading job {}...'.format(job))
+        self.job_started.emit(str(job))
+        loader = Loader(self.loader_plugin_class(), job.store_directory, pickle_data=False,
+                        host_statistics=self.host_statistics)
+        progress = DownloadProgress(len(job.chapter_list))
+        counted_chapters = set()
+
+        def on_image_loaded(image, result):
+            # the number of images is known after the chapter was parsed
+            if id(image.chapter) not in counted_chapters:
+                counted_chapters.add(id(image.chapter))
+                progress.add_chapter(len(image.chapter.image_list))
+            progress.loaded_images += 1
+            self.image_progress.emit(progress.loaded_images, progress.total_images, progress.throughput,
+                                     progress.eta)
+            self.__running.wait()
+            return not job.cancelled
+
+        success = True
+        try:
+            for chapter in job.chapter_list:
+                self.__running.wait()
+                if job.cancelled:
+                    return False
+                result = loader.handle_chapter(chapter, progress_callback=on_image_loaded)
+                if result and job.do_zip:
+                    result = loader.zip_chapter(job.manga, chapter)
+                self.chapter_finished.emit(str(chapter), result)
+                success = success and result
+        finally:
+            loader.close()
+            self.host_statistics.save()
+        return success and not job.cancelled
+
+
+class ChapterListLoader(QtCore.QObject):
+    """
+    Loads chapter lists of manga in a background thread. Requests are
+    delayed until no new request was made for a short time, so that scrolling
+    through the list of manga does not load every chapter list. Results of
+    superseded requests are discarded and the chapter lists of recently chosen
+    manga are cached.
+
+    :param loader_plugin_class: class of the plugin to be used for loading
+    :param delay: time in milliseconds to wait for further requests
+    :param cache_size: maximum number of cached chapter lists
+    :param parent: parent object
+    """
+    # Manga object, list of Chapter objects
+    chapters_loaded = QtCore.pyqtSignal(object, object)
+    # Manga object, error message
+    chapters_failed = QtCore.pyqtSignal(object, str)
+    # generation of the request, Manga object, list of Chapter objects or None, error message
+    __result_ready = QtCore.pyqtSignal(int, object, object, str)
+
+    def __init__(self, loader_plugin_class, delay=CHAPTER_LIST_DELAY, cache_size=CHAPTER_LIST_CACHE_SIZE,
+                 parent=None):
+        super(ChapterListLoader, self).__init__(parent)
+        self.loader_plugin = loader_plugin_class()
+        self.cache_size = cache_size
+        self.__cache = OrderedDict()
+        self.__generation = 0
+        self.__requested_manga = None
+        self.__future = None
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__timer = QtCore.QTimer(self)
+        self.__timer.setSingleShot(True)
+        self.__timer.setInterval(delay)
+        self.__timer.timeout.connect(self._load)
+        # results are delivered from the background thread by a queued signal
+        self.__result_ready.connect(self._on_result_ready)
+
+    def request(self, manga):
+        """Requests the chapter list for a manga, cached lists are delivered immediately."""
+        self.__generation += 1
+        self.__requested_manga = manga
+        if self.__future:
+            # not yet started requests are not needed anymore
+            self.__future.cancel()
+        if manga is None:
+            self.__timer.stop()
+            return
+        if manga.name in self.__cache:
+            self.__timer.stop()
+            self.__cache.move_to_end(manga.name)
+            self.chapters_loaded.emit(manga, self.__cache[manga.name])
+            return
+        self.__timer.start()
+
+    def _load(self):
+        generation, manga = self.__generation, self.__requested_manga
+
+        def load():
+            try:
+                chapter_list, error = self.loader_plugin.load_chapter_list(manga), ''
+            except Exception as e:
+                logger.error('Could not load chapter list for {}: {}'.format(manga, e))
+                chapter_list, error = None, str(e) or type(e).__name__
+            self.__result_ready.emit(generation, manga, chapter_list, error)
+        self.__future = self.__executor.submit(load)
+
+    def _on_result_ready(self, generation, manga, chapter_list, error):
+        if chapter_list is not None:
+            self.__cache[manga.name] = chapter_list
+            while len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+        if generation != self.__generation:
+            logger.debug('Discarding chapter list for {}.'.format(manga))
+            return
+        if chapter_list is None:
+            # failed requests are not cached, so that choosing the manga again retries them
+            self.chapters_failed.emit(manga, error)
+        else:
+            self.chapters_loaded.emit(manga, chapter_list)
+
+    def shutdown(self):
+        self.__timer.stop()
+        self.__executor.shutdown(wait=False)
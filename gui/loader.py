@@ -14,10 +14,12 @@ import os
 from PyQt4 import QtGui
 from PyQt4 import QtCore
 
-from MangaBase import Loader
+from src.MangaBase import Loader
+from src.ThumbnailCache import ThumbnailCache
 from gui import viewer
-from src.plugins import MangaFoxPlugin
-from src.plugins import MangaParkPlugin
+from gui.downloader import ChapterListLoader, DownloadJob, DownloadWorker
+from gui.models import MangaListModel, MangaFilterProxyModel
+from src import plugins
 
 
 logger = logging.getLogger('MangaLoader.gui')
@@ -32,12 +34,19 @@ class LoaderWindow(QtGui.QWidget):
         super(LoaderWindow, self).__init__(parent)
         self.main_gui = parent
         self.manga_store_path = os.getcwd()
-        self.loader = Loader(MangaFoxPlugin.MangaFoxPlugin(), self.manga_store_path)
+        self.loader = Loader(plugins.create_plugin('mangafox'), self.manga_store_path)
         self.manga_list = []
         self.current_chapter_list = []
+        self.thumbnail_cache = ThumbnailCache()
+        self.thumbnail_notifier = viewer.ThumbnailNotifier(self)
+        self.preview_page = None
+        self.download_worker = DownloadWorker(type(self.loader.loader_plugin), self)
+        self.chapter_list_loader = ChapterListLoader(type(self.loader.loader_plugin), parent=self)
         self.create_fonts()
         self.setup_ui()
         self.set_signals_and_slots()
+        # load chapter list of the initially chosen manga in the background
+        self.on_update_chapter_fields()
 
     def create_fonts(self):
         self.label_font = QtGui.QFont()
@@ -78,44 +87,89 @@ class LoaderWindow(QtGui.QWidget):
         # add progressbar
         self.loader_progress = QtGui.QProgressBar()
         grid.addWidget(self.loader_progress, 4, 0, 1, 4)
+        # add status of downloads
+        self.status_label = QtGui.QLabel()
+        grid.addWidget(self.status_label, 5, 0, 1, 4)
         # add load button
         self.load_button = QtGui.QPushButton('Load...')
-        grid.addWidget(self.load_button, 5, 0, QtCore.Qt.AlignLeft)
+        grid.addWidget(self.load_button, 6, 0, QtCore.Qt.AlignLeft)
         # add show button
         self.show_button = QtGui.QPushButton('Show...')
-        grid.addWidget(self.show_button, 5, 1, QtCore.Qt.AlignLeft)
+        grid.addWidget(self.show_button, 6, 1, QtCore.Qt.AlignLeft)
+        # add pause and cancel buttons
+        self.pause_button = QtGui.QPushButton('Pause')
+        self.pause_button.setEnabled(False)
+        grid.addWidget(self.pause_button, 6, 2, QtCore.Qt.AlignLeft)
+        self.cancel_button = QtGui.QPushButton('Cancel')
+        self.cancel_button.setEnabled(False)
+        grid.addWidget(self.cancel_button, 6, 3, QtCore.Qt.AlignLeft)
         # add quit button
         self.quit_button = QtGui.QPushButton('Quit')
-        grid.addWidget(self.quit_button, 5, 3, QtCore.Qt.AlignRight)
+        grid.addWidget(self.quit_button, 7, 3, QtCore.Qt.AlignRight)
+        # add preview of first chosen chapter
+        self.preview_label = QtGui.QLabel()
+        self.preview_label.setFixedSize(*self.thumbnail_cache.thumbnail_size)
+        self.preview_label.setAlignment(QtCore.Qt.AlignCenter)
+        grid.addWidget(self.preview_label, 0, 4, 8, 1)
         self.setLayout(grid)
 
     def buildMangaComboBox(self):
         self.mangaComboBox = QtGui.QComboBox()
+        self.mangaComboBox.setEditable(True)
+        self.mangaComboBox.setInsertPolicy(QtGui.QComboBox.NoInsert)
+        # get list of mangas from Loader and populate a model that hands rows to the combo box when needed
+        self.manga_list = self.loader.get_all_manga(update=False)
+        self.manga_model = MangaListModel(self.manga_list, self)
+        self.mangaComboBox.setModel(self.manga_model)
+        # filter the completion popup by an index of all words in the manga names
+        self.manga_filter_model = MangaFilterProxyModel(self)
+        self.manga_filter_model.setSourceModel(self.manga_model)
         completer = QtGui.QCompleter(self)
-        completer.setCompletionMode(QtGui.QCompleter.UnfilteredPopupCompletion)  # PopupCompletion
+        completer.setModel(self.manga_filter_model)
+        completer.setCompletionMode(QtGui.QCompleter.UnfilteredPopupCompletion)
         self.mangaComboBox.setCompleter(completer)
-        # get list of mangas from Loader and populate combo box
-        self.manga_list = self.loader.get_all_manga(update=False)
-        for manga in self.manga_list:
-            self.mangaComboBox.addItem(manga.name, userData=manga)
         return self.mangaComboBox
 
     def set_signals_and_slots(self):
         """Sets all signals and slots for this widget."""
-        self.quit_button.clicked.connect(self.main_gui.close)
+        self.quit_button.clicked.connect(self.on_quit)
         self.directory_button.clicked.connect(self.on_choose_directory)
         self.load_button.clicked.connect(self.on_load_manga)
         self.mangaComboBox.currentIndexChanged.connect(self.on_update_chapter_fields)
+        self.mangaComboBox.lineEdit().textEdited.connect(self.manga_filter_model.set_filter_text)
+        self.mangaComboBox.completer().activated[str].connect(self.on_manga_chosen)
         self.update_list_button.clicked.connect(self.on_update_manga_list)
         self.show_button.clicked.connect(self.on_show_manga)
+        self.chapter_begin.valueChanged.connect(self.on_update_preview)
+        self.thumbnail_notifier.thumbnail_ready.connect(self.on_thumbnail_ready)
+        self.pause_button.clicked.connect(self.on_pause_loading)
+        self.cancel_button.clicked.connect(self.on_cancel_loading)
+        self.download_worker.job_started.connect(self.on_job_started)
+        self.download_worker.job_finished.connect(self.on_job_finished)
+        self.download_worker.chapter_finished.connect(self.on_chapter_finished)
+        self.download_worker.image_progress.connect(self.on_image_progress)
+        self.download_worker.queue_changed.connect(self.on_queue_changed)
+        self.chapter_list_loader.chapters_loaded.connect(self.on_chapters_loaded)
+        self.chapter_list_loader.chapters_failed.connect(self.on_chapters_failed)
+
+    @QtCore.pyqtSlot()
+    def on_quit(self):
+        self.download_worker.stop()
+        self.chapter_list_loader.shutdown()
+        self.main_gui.close()
 
     @QtCore.pyqtSlot()
     def on_update_manga_list(self):
         # TODO Load mangas in background and update combo box regularly?!
         self.manga_list = self.loader.get_all_manga(update=True)
-        # load combo box with items from manga list
-        for manga in self.manga_list:
-            self.mangaComboBox.addItem(manga.name, userData=manga)
+        # update only changed rows of the combo box
+        self.manga_model.set_manga_list(self.manga_list)
+
+    @QtCore.pyqtSlot(str)
+    def on_manga_chosen(self, manga_name):
+        row = self.manga_model.find_row(manga_name)
+        if row >= 0:
+            self.mangaComboBox.setCurrentIndex(row)
 
     @QtCore.pyqtSlot()
     def on_choose_directory(self):
@@ -137,36 +191,82 @@ class LoaderWindow(QtGui.QWidget):
         if not chosen_manga_name:
             QtGui.QMessageBox.warning(self, 'Error!', 'No manga was chosen.')
             return
-        logger.info('Loading loader...')
-        # setup progress bar for loading of chapters
-        self.loader_progress.setRange(start_chapter - 1, end_chapter)
-        self.loader_progress.setValue(start_chapter - 1)
-        # enforce event processing to update progress bar
-        QtGui.QApplication.processEvents()
-        logger.info('Loading chapters {} - {}'.format(str(start_chapter), str(end_chapter)))
-        for i in range(start_chapter, end_chapter + 1):
-            # find chapter object
-            current_chapter = None
-            for c in self.current_chapter_list:
-                if c.chapterNo == i:
-                    current_chapter = c
-                    break
-            if current_chapter:
-                self.loader.handle_chapter(current_chapter)
-                # set new value for progress bar and enforce event processing
-                self.loader_progress.setValue(i)
-                QtGui.QApplication.processEvents()
-                if self.do_zip_checkbox.checkState():
-                    self.loader.zip_chapter(self.mangaComboBox.itemData(self.mangaComboBox.currentIndex()),
-                                            current_chapter)
-            else:
-                logger.error('Could not find chapter object!')
+        if not self.current_chapter_list:
+            # chapter list could not be loaded before, so try again
+            self.on_update_chapter_fields()
+            return
+        chapter_list = [c for c in self.current_chapter_list if start_chapter <= c.chapterNo <= end_chapter]
+        if not chapter_list:
+            logger.error('Could not find chapter objects!')
+            return
+        logger.info('Queueing chapters {} - {}'.format(str(start_chapter), str(end_chapter)))
+        chosen_manga = self.mangaComboBox.itemData(self.mangaComboBox.currentIndex())
+        job = DownloadJob(chosen_manga, chapter_list, self.manga_store_path,
+                          do_zip=bool(self.do_zip_checkbox.checkState()))
+        self.download_worker.add_job(job)
+
+    @QtCore.pyqtSlot()
+    def on_pause_loading(self):
+        if self.download_worker.is_paused():
+            self.download_worker.resume()
+            self.pause_button.setText('Pause')
+        else:
+            self.download_worker.pause()
+            self.pause_button.setText('Resume')
+
+    @QtCore.pyqtSlot()
+    def on_cancel_loading(self):
+        self.download_worker.cancel_all()
+        self.pause_button.setText('Pause')
+
+    @QtCore.pyqtSlot(str)
+    def on_job_started(self, job_name):
+        # total number of images is unknown until the first chapter is parsed
+        self.loader_progress.setRange(0, 0)
+        self.status_label.setText('Loading {}...'.format(job_name))
+        self.pause_button.setEnabled(True)
+        self.cancel_button.setEnabled(True)
+
+    @QtCore.pyqtSlot(str, bool)
+    def on_job_finished(self, job_name, success):
+        self.loader_progress.setRange(0, 1)
+        self.loader_progress.setValue(1 if success else 0)
+        self.status_label.setText('{} {}.'.format(job_name, 'loaded' if success else 'not loaded completely'))
+        if not self.download_worker.is_paused():
+            self.pause_button.setText('Pause')
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+
+    @QtCore.pyqtSlot(str, bool)
+    def on_chapter_finished(self, chapter_name, success):
+        if not success:
+            logger.error('Could not load chapter {}.'.format(chapter_name))
+
+    @QtCore.pyqtSlot(int, int, float, float)
+    def on_image_progress(self, loaded_images, total_images, throughput, eta):
+        self.loader_progress.setRange(0, max(total_images, loaded_images))
+        self.loader_progress.setValue(loaded_images)
+        eta_text = '{:d}:{:02d}'.format(*divmod(int(eta), 60)) if eta >= 0 else '?'
+        self.status_label.setText('{} of {} images, {:.1f} images/s, remaining {}'.format(
+            loaded_images, total_images, throughput, eta_text))
+
+    @QtCore.pyqtSlot(int)
+    def on_queue_changed(self, waiting_jobs):
+        self.load_button.setText('Load... ({} queued)'.format(waiting_jobs) if waiting_jobs else 'Load...')
 
     @QtCore.pyqtSlot()
     def on_update_chapter_fields(self):
         chosen_manga = self.mangaComboBox.itemData(self.mangaComboBox.currentIndex())
         logger.debug('Combo box changed to {}.'.format(chosen_manga))
-        self.current_chapter_list = self.loader.get_all_chapters(chosen_manga)
+        # chapter list is loaded in the background and set by on_chapters_loaded()
+        self.current_chapter_list = []
+        self.load_button.setEnabled(False)
+        self.chapter_list_loader.request(chosen_manga)
+
+    @QtCore.pyqtSlot(object, object)
+    def on_chapters_loaded(self, manga, chapter_list):
+        self.current_chapter_list = chapter_list
+        self.load_button.setEnabled(True)
         # set max and min for input fields
         chapter_number_list = [x.chapterNo for x in self.current_chapter_list]
         if chapter_number_list:
@@ -177,6 +277,38 @@ class LoaderWindow(QtGui.QWidget):
             self.chapter_end.setMinimum(minimum)
             self.chapter_end.setMaximum(maximum)
             logger.debug('Found chapter min and max: {} - {}'.format(minimum, maximum))
+        self.on_update_preview()
+
+    @QtCore.pyqtSlot(object, str)
+    def on_chapters_failed(self, manga, error):
+        self.current_chapter_list = []
+        # re-enable the button, so that the chapter list can be requested again
+        self.load_button.setEnabled(True)
+        self.status_label.setText('Could not load chapter list for {}: {}'.format(manga, error))
+        self.on_update_preview()
+
+    @QtCore.pyqtSlot()
+    def on_update_preview(self):
+        """Shows a thumbnail of the first page of the chosen chapter, if it was already loaded."""
+        self.preview_label.clear()
+        self.preview_page = None
+        chosen_chapter = None
+        for c in self.current_chapter_list:
+            if c.chapterNo == self.chapter_begin.value():
+                chosen_chapter = c
+                break
+        if not chosen_chapter:
+            return
+        chapter_dir = self.loader.image_store_manager.get_chapter_dir(chosen_chapter)
+        self.preview_page = ThumbnailCache.find_first_page(chapter_dir)
+        if self.preview_page:
+            self.thumbnail_cache.request(self.preview_page, self.thumbnail_notifier.notify)
+
+    @QtCore.pyqtSlot(object, str)
+    def on_thumbnail_ready(self, path, thumbnail_path):
+        # ignore thumbnails of chapters that are no longer chosen
+        if path == self.preview_page:
+            self.preview_label.setPixmap(QtGui.QPixmap(thumbnail_path))
 
     @QtCore.pyqtSlot()
     def on_show_manga(self):
@@ -185,7 +317,6 @@ class LoaderWindow(QtGui.QWidget):
         viewer_window.setWindowState(QtCore.Qt.WindowMaximized)
         viewer_window.setWindowTitle('MangaLoader Viewer')
         chosen_manga = self.mangaComboBox.itemData(self.mangaComboBox.currentIndex())
-        self.current_chapter_list = self.plugin.load_chapter_list(chosen_manga)
         chosen_chapter = None
         for c in self.current_chapter_list:
             if c.chapterNo == self.chapter_begin.value():
@@ -193,6 +324,7 @@ class LoaderWindow(QtGui.QWidget):
                 break
         if chosen_chapter:
             image_view = viewer.ImageView(viewer_window, self.manga_store_path,
-                                          start_with_manga=chosen_manga, start_with_chapter=chosen_chapter)
+                                          start_with_manga=chosen_manga, start_with_chapter=chosen_chapter,
+                                          thumbnail_cache=self.thumbnail_cache)
             viewer_window.setCentralWidget(image_view)
             viewer_window.show()
@@ -0,0 +1,138 @@
+
+"""
+Item models for showing large lists of manga in the GUI.
+
+@author: Christian Wichmann
+"""
+
+
+import difflib
+import logging
+
+from PyQt4 import QtCore
+
+from src.NameIndex import NameIndex
+
+
+logger = logging.getLogger('MangaLoader.gui')
+
+# number of rows that are added to the model when a view needs more rows
+FETCH_BATCH_SIZE = 200
+
+
+class MangaListModel(QtCore.QAbstractListModel):
+    """
+    List model for all manga of a site. Rows are handed to views in batches
+    when they are needed, so that views for the whole catalog are created
+    instantly. When the list is updated, only changed rows are removed and
+    inserted.
+
+    :param manga_list: list of Manga objects
+    :param parent: parent object
+    """
+    def __init__(self, manga_list=(), parent=None):
+        super(MangaListModel, self).__init__(parent)
+        self.manga_list = list(manga_list)
+        self.loaded_rows = 0
+        self.name_index = NameIndex(m.name for m in self.manga_list)
+        self.__rows_by_name = {}
+        self._update_rows_by_name()
+
+    def _update_rows_by_name(self):
+        self.__rows_by_name = {m.name: row for row, m in reversed(list(enumerate(self.manga_list)))}
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.loaded_rows
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < self.loaded_rows:
+            return None
+        manga = self.manga_list[index.row()]
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return manga.name
+        if role == QtCore.Qt.UserRole:
+            return manga
+        return None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return False
+        return self.loaded_rows < len(self.manga_list)
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return
+        self.fetch_until(self.loaded_rows + FETCH_BATCH_SIZE)
+
+    def fetch_until(self, row_count):
+        """Makes the given number of rows available to views."""
+        row_count = min(row_count, len(self.manga_list))
+        if row_count <= self.loaded_rows:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self.loaded_rows, row_count - 1)
+        self.loaded_rows = row_count
+        self.endInsertRows()
+
+    def find_row(self, name):
+        """Returns the row of the manga with the given name and makes it available to views or -1."""
+        row = self.__rows_by_name.get(name, -1)
+        if row >= 0:
+            self.fetch_until(row + 1)
+        return row
+
+    def set_manga_list(self, manga_list):
+        """
+        Replaces the list of manga by a new one. Rows that are unchanged are
+        kept, so that views do not lose their selection and scroll position.
+        """
+        manga_list = list(manga_list)
+        matcher = difflib.SequenceMatcher(None, [m.name for m in self.manga_list], [m.name for m in manga_list],
+                                          autojunk=False)
+        # apply changes from the end of the list, so that positions of earlier changes stay valid
+        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+            if tag == 'equal':
+                # keep updated objects for unchanged names
+                self.manga_list[i1:i2] = manga_list[j1:j2]
+                continue
+            visible_end = min(i2, self.loaded_rows)
+            if i1 < visible_end:
+                self.beginRemoveRows(QtCore.QModelIndex(), i1, visible_end - 1)
+                del self.manga_list[i1:i2]
+                self.loaded_rows -= visible_end - i1
+                self.endRemoveRows()
+            else:
+                del self.manga_list[i1:i2]
+            if i1 < self.loaded_rows:
+                self.beginInsertRows(QtCore.QModelIndex(), i1, i1 + j2 - j1 - 1)
+                self.manga_list[i1:i1] = manga_list[j1:j2]
+                self.loaded_rows += j2 - j1
+                self.endInsertRows()
+            else:
+                self.manga_list[i1:i1] = manga_list[j1:j2]
+        self.name_index.build(m.name for m in self.manga_list)
+        self._update_rows_by_name()
+        logger.debug('Updated manga list model to {} entries.'.format(len(self.manga_list)))
+
+
+class MangaFilterProxyModel(QtCore.QSortFilterProxyModel):
+    """
+    Filters a MangaListModel by words of the manga names. Matching rows are
+    looked up in the name index of the source model instead of comparing the
+    filter text with every row.
+    """
+    def __init__(self, parent=None):
+        super(MangaFilterProxyModel, self).__init__(parent)
+        self.matching_rows = None
+
+    def set_filter_text(self, text):
+        source_model = self.sourceModel()
+        self.matching_rows = source_model.name_index.search(text)
+        if self.matching_rows:
+            # matching rows have to be available in the source model to be shown
+            source_model.fetch_until(max(self.matching_rows) + 1)
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return self.matching_rows is None or source_row in self.matching_rows
@@ -11,46 +11,212 @@ Created on Mon Dec 29 12:42:49 2014
 import os
 import sys
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt4 import QtGui
 from PyQt4 import QtCore
 from PyQt4 import Qt
 
 from src import MangaBase
+from src.MangaZipper import ArchivePage, archive_pool
+from src.ThumbnailCache import ThumbnailCache
 
 
 logger = logging.getLogger('MangaLoader.gui')
 
+# number of pages before and after the current page that are kept decoded
+PREFETCH_PAGES = 3
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+MAX_SCALED_CACHE_BYTES = 128 * 1024 * 1024
+# window sizes are rounded down to multiples of this, so that small changes reuse scaled pages
+SIZE_BUCKET = 64
+# delay after the last resize event before pages are scaled again in milliseconds
+RESIZE_DELAY = 100
+# height of the strip with thumbnails of all pages of the current chapter
+THUMBNAIL_STRIP_HEIGHT = 150
+
+
+def size_bucket(width, height):
+    """Returns the size bucket as tuple of width and height for a given size of the image label."""
+    return max(width // SIZE_BUCKET, 1) * SIZE_BUCKET, max(height // SIZE_BUCKET, 1) * SIZE_BUCKET
+
+
+class ScaledImageNotifier(QtCore.QObject):
+    """Delivers pages that were scaled in background threads to the GUI thread."""
+    image_ready = QtCore.pyqtSignal(object, object)
+
+    def notify(self, path, bucket):
+        self.image_ready.emit(path, bucket)
+
+
+class ThumbnailNotifier(QtCore.QObject):
+    """Delivers thumbnails that were generated in background threads to the GUI thread."""
+    thumbnail_ready = QtCore.pyqtSignal(object, str)
+
+    def notify(self, path, thumbnail_path):
+        if thumbnail_path:
+            self.thumbnail_ready.emit(path, thumbnail_path)
+
+
+class PageCache(object):
+    """
+    Keeps decoded pages in memory, so that switching pages does not need to
+    read and decode images on the GUI thread. Pages are decoded into QImage
+    objects in a background thread and the least recently used pages are
+    dropped when the cache exceeds its maximum size in bytes. Pages inside of
+    CBZ files are read from the shared pool of open archives.
+
+    Pages scaled to fit the window are cached separately for every size
+    bucket, so that scaling happens in the background as well.
+
+    :param max_bytes: maximum size of all decoded pages in bytes
+    :param max_scaled_bytes: maximum size of all scaled pages in bytes
+    """
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, max_scaled_bytes=MAX_SCALED_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.max_scaled_bytes = max_scaled_bytes
+        self.current_bytes = 0
+        self.current_scaled_bytes = 0
+        self.__images = OrderedDict()
+        self.__scaled_images = OrderedDict()
+        self.__pending = {}
+        self.__pending_scaled = {}
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, path):
+        """
+        Returns the decoded page for a given path. If the page is still being
+        decoded in the background, this waits for it.
+        """
+        with self.__lock:
+            if path in self.__images:
+                self.__images.move_to_end(path)
+                return self.__images[path]
+            future = self.__pending.get(path)
+        if future:
+            return future.result()
+        return self._decode(path)
+
+    def get_scaled(self, path, bucket):
+        """Returns the page scaled for a given size bucket, if it is already cached, otherwise None."""
+        with self.__lock:
+            key = (path, bucket)
+            if key in self.__scaled_images:
+                self.__scaled_images.move_to_end(key)
+                return self.__scaled_images[key]
+        return None
+
+    def prefetch(self, paths, bucket=None):
+        """
+        Decodes the given pages in the background, if they are not cached yet.
+        If a size bucket is given, the pages are also scaled for it.
+        """
+        with self.__lock:
+            for path in paths:
+                if path in self.__images:
+                    self.__images.move_to_end(path)
+                elif path not in self.__pending:
+                    self.__pending[path] = self.__executor.submit(self._decode, path)
+        if bucket:
+            for path in paths:
+                self.request_scaled(path, bucket)
+
+    def request_scaled(self, path, bucket, callback=None):
+        """
+        Scales a page for a given size bucket in the background thread. The
+        callback is called with the path and the size bucket from the
+        background thread after the scaled page was stored in the cache.
+        """
+        with self.__lock:
+            key = (path, bucket)
+            if key in self.__scaled_images:
+                self.__scaled_images.move_to_end(key)
+                return None
+            if key in self.__pending_scaled:
+                return self.__pending_scaled[key]
+            future = self.__pending_scaled[key] = self.__executor.submit(self._scale, path, bucket, callback)
+            return future
+
+    def _decode(self, path):
+        if isinstance(path, ArchivePage):
+            image = QtGui.QImage.fromData(archive_pool.read(path))
+        else:
+            image = QtGui.QImage(path)
+        with self.__lock:
+            self.__pending.pop(path, None)
+            if path not in self.__images:
+                self.__images[path] = image
+                self.current_bytes += image.byteCount()
+            while self.current_bytes > self.max_bytes and len(self.__images) > 1:
+                _, dropped_image = self.__images.popitem(last=False)
+                self.current_bytes -= dropped_image.byteCount()
+        return image
+
+    def _scale(self, path, bucket, callback):
+        key = (path, bucket)
+        try:
+            scaled_image = self.get(path).scaled(QtCore.QSize(*bucket), QtCore.Qt.KeepAspectRatio,
+                                                 QtCore.Qt.SmoothTransformation)
+            with self.__lock:
+                self.__scaled_images[key] = scaled_image
+                self.current_scaled_bytes += scaled_image.byteCount()
+                while self.current_scaled_bytes > self.max_scaled_bytes and len(self.__scaled_images) > 1:
+                    _, dropped_image = self.__scaled_images.popitem(last=False)
+                    self.current_scaled_bytes -= dropped_image.byteCount()
+        finally:
+            with self.__lock:
+                self.__pending_scaled.pop(key, None)
+        if callback:
+            callback(path, bucket)
+        return scaled_image
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False)
+
 
 class ImageView(QtGui.QWidget):
     """
     Shows a widget containing a single image for a given chapter in a specified manga series.
+    Below the image thumbnails of all pages of the current chapter are shown.
     
     :param parent: parent widget or window
     :param base_dir: base directory for all manga series data
     :param start_with_manga: Manga object for the series that should be shown
     :param start_with_chapter: Chapter object for the chapter that should be shown
+    :param thumbnail_cache: ThumbnailCache object to be used, by default a new one is created
     """
-    def __init__(self, parent, base_dir, start_with_manga=None, start_with_chapter=None):
+    def __init__(self, parent, base_dir, start_with_manga=None, start_with_chapter=None, thumbnail_cache=None):
         super(ImageView, self).__init__(parent)
         self.main_gui = parent
         self.base_dir = base_dir
         self.start_with_chapter = start_with_chapter
         self.start_with_manga = start_with_manga
         path_builder = MangaBase.ImageStoreManager(base_dir)
-        self.image_switcher = path_builder.find_next_image(start_with_manga, start_with_chapter)
+        self.series_index = path_builder.get_series_index(start_with_manga)
+        start_position = self.series_index.seek(start_with_chapter.chapterNo)
+        # position of the currently shown page in the series
+        self.position = start_position if start_position is not None else 0
+        self.page_cache = PageCache()
+        self.scaled_image_notifier = ScaledImageNotifier(self)
+        self.thumbnail_cache = thumbnail_cache if thumbnail_cache is not None else ThumbnailCache()
+        self.thumbnail_notifier = ThumbnailNotifier(self)
+        # chapter shown in the thumbnail strip and its items by page
+        self.strip_chapter = None
+        self.strip_items = {}
+        self.resize_timer = QtCore.QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(RESIZE_DELAY)
         self.create_fonts()
         self.setup_ui()
         self.set_signals_and_slots()
 
-    #def resizeEvent(self, event):
-    #    super(ImageView, self).resizeEvent(event)
-    #    # handle resizing of image
-    #    new_size = event.size()
-    #    new_size.setWidth(new_size.width() - 125)
-    #    new_size.setHeight(new_size.height() - 10)
-    #    self.scaled_image = self.image.scaled(new_size, QtCore.Qt.KeepAspectRatio)
-    #    self.image_label.setPixmap(self.scaled_image)
+    def resizeEvent(self, event):
+        super(ImageView, self).resizeEvent(event)
+        # scale the current page again after the user stopped resizing the window
+        self.resize_timer.start()
 
     def create_fonts(self):
         self.label_font = QtGui.QFont()
@@ -75,26 +241,39 @@ class ImageView(QtGui.QWidget):
         grid.addWidget(self.previous_button, 1, 0, QtCore.Qt.AlignCenter)
         # add image label
         self.image_label = QtGui.QLabel(self)
-        #self.image_label.setGeometry(10, 10, 400, 100)
-        path_to_image = next(self.image_switcher)
-        pixmap = QtGui.QPixmap(path_to_image)
-        #scaledPixmap = pixmap.scaled(self.image_label.size(), QtCore.Qt.KeepAspectRatio)
-        #self.image_label.setPixmap(scaledPixmap)
-        self.image_label.setPixmap(pixmap)
-        self.image_label.setScaledContents(True)
-        grid.addWidget(self.image_label, 1, 1, QtCore.Qt.AlignCenter | QtCore.Qt.AlignHCenter)
+        self.image_label.setAlignment(QtCore.Qt.AlignCenter)
+        # let the label take all available space instead of growing with the pixmap
+        self.image_label.setSizePolicy(QtGui.QSizePolicy.Ignored, QtGui.QSizePolicy.Ignored)
+        self.image_label.setMinimumSize(1, 1)
+        grid.addWidget(self.image_label, 1, 1)
         # add next button
         self.next_button = QtGui.QPushButton('Next')
         grid.addWidget(self.next_button, 1, 2, QtCore.Qt.AlignCenter)
+        # add strip with thumbnails of the current chapter
+        self.thumbnail_strip = QtGui.QListWidget()
+        self.thumbnail_strip.setViewMode(QtGui.QListView.IconMode)
+        self.thumbnail_strip.setFlow(QtGui.QListView.LeftToRight)
+        self.thumbnail_strip.setWrapping(False)
+        self.thumbnail_strip.setMovement(QtGui.QListView.Static)
+        width, height = self.thumbnail_cache.thumbnail_size
+        icon_height = THUMBNAIL_STRIP_HEIGHT - 40
+        self.thumbnail_strip.setIconSize(QtCore.QSize(icon_height * width // height, icon_height))
+        self.thumbnail_strip.setFixedHeight(THUMBNAIL_STRIP_HEIGHT)
+        grid.addWidget(self.thumbnail_strip, 2, 0, 1, 3)
         grid.setColumnStretch(0, 0)
         grid.setColumnStretch(1, 100)
         grid.setColumnStretch(2, 0)
         self.setLayout(grid)
+        self.show_page(self.position)
 
     def set_signals_and_slots(self):
         """Sets all signals and slots for this widget."""
         self.next_button.clicked.connect(self.on_next_image)
         self.previous_button.clicked.connect(self.on_previous_image)
+        self.scaled_image_notifier.image_ready.connect(self.on_scaled_image_ready)
+        self.resize_timer.timeout.connect(self.on_resize_finished)
+        self.thumbnail_notifier.thumbnail_ready.connect(self.on_thumbnail_ready)
+        self.thumbnail_strip.itemClicked.connect(self.on_thumbnail_clicked)
         # TODO: Handle mouse clicks on image label.
 
     def keyPressEvent(self, event):
@@ -115,17 +294,102 @@ class ImageView(QtGui.QWidget):
         elif key == QtCore.Qt.Key_Space:
             self.on_next_image()
 
+    def current_bucket(self):
+        """Returns the size bucket for the current size of the image label."""
+        return size_bucket(self.image_label.width(), self.image_label.height())
+
+    def show_page(self, index):
+        """
+        Shows the page with the given position in the series and prefetches
+        pages around it. If the page was not scaled for the current window size
+        yet, a fast scaled version is shown until the smooth one is ready.
+        """
+        path_to_image = self.series_index.get(index)
+        if path_to_image is None:
+            return False
+        self.position = index
+        bucket = self.current_bucket()
+        scaled_image = self.page_cache.get_scaled(path_to_image, bucket)
+        if scaled_image is None:
+            scaled_image = self.page_cache.get(path_to_image).scaled(QtCore.QSize(*bucket), QtCore.Qt.KeepAspectRatio,
+                                                                     QtCore.Qt.FastTransformation)
+            self.page_cache.request_scaled(path_to_image, bucket, self.scaled_image_notifier.notify)
+        self.image_label.setPixmap(QtGui.QPixmap.fromImage(scaled_image))
+        following_pages = [self.series_index.get(i) for i in range(index + 1, index + PREFETCH_PAGES + 1)]
+        previous_pages = [self.series_index.get(i) for i in range(index - 1, index - PREFETCH_PAGES - 1, -1)]
+        self.page_cache.prefetch([p for p in following_pages + previous_pages if p], bucket)
+        self.update_thumbnail_strip()
+        return True
+
+    def update_thumbnail_strip(self):
+        """
+        Fills the thumbnail strip with all pages of the current chapter, if the
+        chapter changed, and selects the current page. Thumbnails that are not
+        in the cache yet are generated in the background.
+        """
+        chapter = self.series_index.get_chapter(self.position)
+        if chapter is not self.strip_chapter:
+            self.strip_chapter = chapter
+            self.strip_items = {}
+            self.thumbnail_strip.clear()
+            if chapter is None:
+                return
+            first_position = self.series_index.seek(chapter.number)
+            for page_no, page in enumerate(chapter.pages):
+                item = QtGui.QListWidgetItem(str(page_no + 1))
+                item.setData(QtCore.Qt.UserRole, first_position + page_no)
+                self.thumbnail_strip.addItem(item)
+                self.strip_items[page] = item
+                thumbnail_path = self.thumbnail_cache.get_cached(page)
+                if thumbnail_path:
+                    item.setIcon(QtGui.QIcon(thumbnail_path))
+                else:
+                    self.thumbnail_cache.request(page, self.thumbnail_notifier.notify)
+        item = self.strip_items.get(self.series_index.get(self.position))
+        if item:
+            self.thumbnail_strip.setCurrentItem(item)
+            self.thumbnail_strip.scrollToItem(item)
+
+    def on_thumbnail_ready(self, path, thumbnail_path):
+        # ignore thumbnails of pages from chapters that are no longer shown
+        item = self.strip_items.get(path)
+        if item:
+            item.setIcon(QtGui.QIcon(thumbnail_path))
+
+    def on_thumbnail_clicked(self, item):
+        self.show_page(item.data(QtCore.Qt.UserRole))
+
+    def on_scaled_image_ready(self, path, bucket):
+        """Replaces the shown page with its smooth scaled version, if it is still current."""
+        if path != self.series_index.get(self.position) or bucket != self.current_bucket():
+            return
+        scaled_image = self.page_cache.get_scaled(path, bucket)
+        if scaled_image is not None:
+            self.image_label.setPixmap(QtGui.QPixmap.fromImage(scaled_image))
+
+    def on_resize_finished(self):
+        path_to_image = self.series_index.get(self.position)
+        if path_to_image is None:
+            return
+        bucket = self.current_bucket()
+        scaled_image = self.page_cache.get_scaled(path_to_image, bucket)
+        if scaled_image is not None:
+            self.image_label.setPixmap(QtGui.QPixmap.fromImage(scaled_image))
+        else:
+            self.page_cache.request_scaled(path_to_image, bucket, self.scaled_image_notifier.notify)
+
     def on_next_image(self):
-        try:
-            path_to_image = next(self.image_switcher)
-            logger.info('Switching to next image: {}.'.format(path_to_image))
-            self.image_label.setPixmap(QtGui.QPixmap(path_to_image))
-        except StopIteration:
+        if self.show_page(self.position + 1):
+            logger.info('Switching to next image: {}.'.format(self.series_index.get(self.position)))
+        else:
             logger.warn('Reached end of manga.')
             # TODO: Show message box!
     
     def on_previous_image(self):
-        logger.info('Switching to previous image.')
+        if self.show_page(self.position - 1):
+            logger.info('Switching to previous image: {}.'.format(self.series_index.get(self.position)))
+        else:
+            logger.warn('Reached beginning of manga.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import io
+import gzip
+import json
+import time
+import base64
+import logging
+import threading
+
+import requests
+import requests.adapters
+from urllib3.response import HTTPResponse
+
+from src import PluginBase
+
+
+logger = logging.getLogger('MangaLoader.Cassette')
+
+CASSETTE_VERSION = 1
+CASSETTE_MODES = ('record', 'replay')
+# headers that do not apply anymore, because bodies are stored decoded and complete
+DROPPED_HEADERS = ('content-encoding', 'transfer-encoding')
+
+
+# -------------------------------------------------------------------------------------------------
+#  CassetteAdapter class
+# -------------------------------------------------------------------------------------------------
+class CassetteAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter that records all responses to a cassette or answers all
+    requests from a cassette without accessing the network.
+    """
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == 'replay':
+            interaction = self.cassette.find(request.method, request.url)
+            if interaction is None:
+                raise requests.exceptions.ConnectionError('No recorded response for {} {}'.format(request.method,
+                                                                                                 request.url),
+                                                          request=request)
+            self.cassette.simulate_latency(interaction)
+            return self._build(request, interaction)
+        start_time = time.perf_counter()
+        response = super().send(request, **kwargs)
+        # read the whole body, so that it can be stored and streamed again
+        data = response.content
+        elapsed = time.perf_counter() - start_time
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in DROPPED_HEADERS}
+        if request.method != 'HEAD':
+            headers['Content-Length'] = str(len(data))
+        interaction = {'method': request.method, 'url': request.url, 'status': response.status_code,
+                       'reason': response.reason, 'headers': headers, 'elapsed': round(elapsed, 4),
+                       'body': base64.b64encode(data).decode('ascii')}
+        self.cassette.add(interaction)
+        response.close()
+        return self._build(request, interaction)
+
+    def _build(self, request, interaction):
+        raw = HTTPResponse(body=io.BytesIO(base64.b64decode(interaction['body'])), headers=interaction['headers'],
+                           status=interaction['status'], reason=interaction['reason'], preload_content=False,
+                           decode_content=False)
+        return self.build_response(request, raw)
+
+
+# -------------------------------------------------------------------------------------------------
+#  Cassette class
+# -------------------------------------------------------------------------------------------------
+class Cassette(object):
+    """
+    Records HTTP requests and responses of the shared session of all plugins
+    in a gzip compressed JSON file or replays them from it, so that plugins
+    can be developed and benchmarked offline with reproducible responses. All
+    page fetches of load_url() and all image downloads are covered, requests
+    made by other means (e.g. find_re_in_site) are not.
+
+    When a URL was recorded several times, the responses are replayed in the
+    recorded order and the last one is repeated afterwards.
+
+    :param file_name: cassette file
+    :param mode: 'record' or 'replay'
+    :param latency: delay in seconds before every replayed response
+    :param recorded_latency: additionally delay every replayed response by the
+                             time it took when it was recorded
+    """
+    def __init__(self, file_name, mode='replay', latency=0.0, recorded_latency=False):
+        if mode not in CASSETTE_MODES:
+            raise ValueError('Unknown cassette mode: {}'.format(mode))
+        self.file_name = file_name
+        self.mode = mode
+        self.latency = latency
+        self.recorded_latency = recorded_latency
+        self.interactions = []
+        self.__index = {}
+        self.__replay_counts = {}
+        self.__lock = threading.Lock()
+        self.__session = None
+        self.__previous_adapters = None
+        if mode == 'replay':
+            self.load()
+
+    def load(self):
+        with gzip.open(self.file_name, 'rt', encoding='UTF-8') as f:
+            data = json.load(f)
+        if data.get('version') != CASSETTE_VERSION:
+            raise ValueError('Unsupported cassette version: {}'.format(data.get('version')))
+        self.interactions = []
+        self.__index = {}
+        for interaction in data['interactions']:
+            self.add(interaction)
+        logger.info('Loaded {} responses from cassette {}.'.format(len(self.interactions), self.file_name))
+
+    def save(self):
+        with self.__lock:
+            data = {'version': CASSETTE_VERSION, 'interactions': list(self.interactions)}
+        with gzip.open(self.file_name, 'wt', encoding='UTF-8') as f:
+            json.dump(data, f)
+        logger.info('Saved {} responses to cassette {}.'.format(len(data['interactions']), self.file_name))
+
+    def add(self, interaction):
+        with self.__lock:
+            self.interactions.append(interaction)
+            self.__index.setdefault((interaction['method'], interaction['url']), []).append(interaction)
+
+    def find(self, method, url):
+        """Returns the next recorded interaction for a request or None, if it was not recorded."""
+        key = (method, url)
+        with self.__lock:
+            interactions = self.__index.get(key)
+            if not interactions:
+                return None
+            count = self.__replay_counts.get(key, 0)
+            self.__replay_counts[key] = count + 1
+            return interactions[min(count, len(interactions) - 1)]
+
+    def simulate_latency(self, interaction):
+        delay = self.latency + (interaction.get('elapsed', 0.0) if self.recorded_latency else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def install(self, session=None):
+        """Lets a session (by default the shared session of all plugins) use this cassette."""
+        self.__session = session if session is not None else PluginBase.get_session()
+        self.__previous_adapters = dict(self.__session.adapters)
+        adapter = CassetteAdapter(self, pool_connections=PluginBase.POOL_CONNECTIONS,
+                                  pool_maxsize=PluginBase.POOL_MAXSIZE)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+        return self
+
+    def uninstall(self):
+        """Restores the previous adapters of the session and saves recorded responses."""
+        if self.__session is None:
+            return
+        self.__session.adapters.clear()
+        self.__session.adapters.update(self.__previous_adapters)
+        self.__session = None
+        if self.mode == 'record':
+            self.save()
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+        return False
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import os
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class TestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = 'page {}'.format(self.path).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=UTF-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    print('testing Cassette')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/chapter/1.html'.format(server.server_address[1])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cassette_file = os.path.join(temp_dir, 'test.cassette.json.gz')
+        with Cassette(cassette_file, 'record'):
+            assert(PluginBase.load_url(url) == 'page /chapter/1.html')
+        server.shutdown()
+        server.server_close()
+        with Cassette(cassette_file, 'replay'):
+            assert(PluginBase.load_url(url) == 'page /chapter/1.html')
+            with PluginBase.get_session().get(url, stream=True) as response:
+                response.raw.decode_content = True
+                assert(response.raw.read() == b'page /chapter/1.html')
+            assert(PluginBase.load_url(url + '?missing') is None)
+    print('test successful')
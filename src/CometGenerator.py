@@ -24,28 +24,38 @@ def create_comet(manga_dir, chapter):
     comet_file = manga_dir + '/' + 'comet.xml'
     logger.debug('create comet file "{}"...'.format(str(comet_file)))
     
+    title = ""
+    series = None
+    if chapter.manga is not None:
+        series = chapter.manga.name
+        title = title + str(chapter.manga.name) + ' ' + str(chapter.chapterNo)
+    if chapter.title:
+        title = title + ' - ' + str(chapter.title)
+    
+    with open(comet_file, 'wb') as f:
+        f.write(build_comet(series=series, title=title, issue=chapter.chapterNo, pages=len(chapter.image_list)))
+
+
+def build_comet(series=None, title=None, issue=None, volume=None, pages=0):
+    """Builds the content of a comet file and returns it as UTF-8 encoded XML."""
     root = ET.Element('comet')
     root.attrib['xmlns:comet'] = 'http://www.denvog.com/comet/'
     root.attrib['xmlns:xsi'] = 'http://www.w3.org/2001/XMLSchema-instance'
     root.attrib['xsi:schemaLocation'] = 'http://www.denvog.com http://www.denvog.com/comet/comet.xsd'
     
-    title = ""
-    if chapter.manga is not None:
-        ET.SubElement(root, 'series').text = chapter.manga.name
-        title = title + str(chapter.manga.name) + ' ' + str(chapter.number)
-    if chapter.title:
-        title = title + ' - ' + str(chapter.title)
+    if series:
+        ET.SubElement(root, 'series').text = series
     if title:
         ET.SubElement(root, 'title').text = title
-    
-    ET.SubElement(root, 'issue').text = str(chapter.number)
-    # ET.SubElement(root, 'volume').text = ''
+    if issue is not None:
+        ET.SubElement(root, 'issue').text = str(issue)
+    if volume is not None:
+        ET.SubElement(root, 'volume').text = str(volume)
     ET.SubElement(root, 'language').text = 'ja'
-    ET.SubElement(root, 'pages').text = str(len(chapter.imagelist))
+    ET.SubElement(root, 'pages').text = str(pages)
     ET.SubElement(root, 'readingDirection').text = 'rtl'
     
-    tree = ET.ElementTree(root)
-    tree.write(comet_file, encoding='UTF-8', xml_declaration=True)
+    return ET.tostring(root, encoding='UTF-8', xml_declaration=True)
 
 # -------------------------------------------------------------------------------------------------
 #  <module>
@@ -0,0 +1,425 @@
+#!/usr/bin/python3
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# NumPy and Pillow are imported on first use, because importing them takes most of the start up time
+numpy = None
+PIL = None
+_image_libraries_checked = False
+
+
+logger = logging.getLogger('MangaLoader.ImageProcessing')
+
+# maximum standard deviation of the luminance of a row or column to be uniform
+DEFAULT_TOLERANCE = 6.0
+# minimum mean chroma of a row or column of a grayscale page to be part of an ad
+DEFAULT_SATURATION = 40.0
+# smallest band that is cropped in pixels
+DEFAULT_MIN_BAND = 4
+# largest band that is cropped as ratio of width or height of the page
+DEFAULT_MAX_BAND_RATIO = 0.2
+
+# formats for transcoding with their name in Pillow and their file extension
+TRANSCODE_FORMATS = {'webp': ('WEBP', '.webp'), 'jpeg': ('JPEG', '.jpg')}
+# quality for the encoder if none was given
+DEFAULT_QUALITY = 80
+# suffix for original files that are kept after transcoding
+ORIGINAL_SUFFIX = '.orig'
+
+
+def image_libraries_available():
+    """Imports NumPy and Pillow on first use and checks whether they are available for processing images."""
+    global numpy, PIL, _image_libraries_checked
+    if not _image_libraries_checked:
+        _image_libraries_checked = True
+        try:
+            import numpy
+            import PIL.Image
+        except ImportError:
+            numpy = PIL = None
+    return numpy is not None
+
+
+# -------------------------------------------------------------------------------------------------
+#  band detection
+# -------------------------------------------------------------------------------------------------
+def find_content_box(pixels, tolerance=DEFAULT_TOLERANCE, saturation=DEFAULT_SATURATION,
+                     min_band=DEFAULT_MIN_BAND, max_band_ratio=DEFAULT_MAX_BAND_RATIO):
+    """
+    Finds uniform bands and colored ad bands along the edges of a page. All
+    rows and columns are classified at once by their luminance deviation and
+    their mean chroma. Colored rows and columns are only considered as ads if
+    the page itself is grayscale.
+
+    :param pixels: array of shape (height, width, 3) containing RGB values
+    :return: box (left, top, right, bottom) of the page content without bands
+             or None, if no bands were found
+    """
+    image_libraries_available()
+    # elementwise operations on the channels are much faster than reducing the last axis
+    red, green, blue = pixels[:, :, 0], pixels[:, :, 1], pixels[:, :, 2]
+    luminance = (red.astype(numpy.float32) + green + blue) / 3
+    chroma = numpy.maximum(numpy.maximum(red, green), blue) - numpy.minimum(numpy.minimum(red, green), blue)
+    # estimating whether the page is grayscale from every 8th pixel is sufficient
+    if numpy.median(chroma[::8, ::8]) >= saturation:
+        saturation = None
+    height, width = luminance.shape
+    top, bottom = _find_edge_bands(luminance.std(axis=1), chroma.mean(axis=1, dtype=numpy.float32), tolerance,
+                                   saturation, min_band, int(height * max_band_ratio))
+    # columns are only checked between horizontal bands, because those bands span the whole width
+    luminance, chroma = luminance[top:bottom], chroma[top:bottom]
+    left, right = _find_edge_bands(luminance.std(axis=0), chroma.mean(axis=0, dtype=numpy.float32), tolerance,
+                                   saturation, min_band, int(width * max_band_ratio))
+    if (left, top, right, bottom) == (0, 0, width, height):
+        return None
+    return left, top, right, bottom
+
+
+def _find_edge_bands(deviation, colorfulness, tolerance, saturation, min_band, max_band):
+    """
+    Finds the runs of band rows (or columns) at the start and the end of a
+    page. Returns the index of the first and behind the last content row.
+    """
+    is_band = deviation < tolerance
+    if saturation is not None:
+        is_band |= colorfulness > saturation
+    length = len(is_band)
+    if is_band.all():
+        return 0, length
+    leading = int(numpy.argmin(is_band))
+    trailing = int(numpy.argmin(is_band[::-1]))
+    start = leading if min_band <= leading <= max_band else 0
+    end = length - trailing if min_band <= trailing <= max_band else length
+    return start, end
+
+
+def crop_bands(filename, **kwargs):
+    """
+    Crops uniform and ad bands along the edges of an image file. The file is
+    only written again, if any bands were found.
+
+    :param filename: image file to be cropped
+    :param kwargs: parameters for find_content_box()
+    :return: true, if the image was cropped
+    """
+    if not image_libraries_available():
+        logger.debug('NumPy or Pillow not available, not cropping image.')
+        return False
+    with PIL.Image.open(filename) as image:
+        image_format = image.format
+        image.load()
+    box = find_content_box(numpy.asarray(image.convert('RGB')), **kwargs)
+    if box is None:
+        return False
+    logger.debug('Cropping image {} to {}.'.format(filename, box))
+    image.crop(box).save(filename, format=image_format, quality=95)
+    return True
+
+
+# -------------------------------------------------------------------------------------------------
+#  perceptual hashes
+# -------------------------------------------------------------------------------------------------
+def average_hash(pixels):
+    """
+    Computes the average hash of a small grayscale image. Every bit tells
+    whether a pixel is brighter than the mean of all pixels.
+
+    :param pixels: array of shape (8, 8) with luminance values
+    :return: hash as integer
+    """
+    return _pack_bits(pixels > pixels.mean())
+
+
+def difference_hash(pixels):
+    """
+    Computes the difference hash of a small grayscale image. Every bit tells
+    whether a pixel is brighter than its right neighbour.
+
+    :param pixels: array of shape (8, 9) with luminance values
+    :return: hash as integer
+    """
+    return _pack_bits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def _pack_bits(bits):
+    image_libraries_available()
+    return int.from_bytes(numpy.packbits(bits.flatten()).tobytes(), 'big')
+
+
+HASH_FUNCTIONS = {'ahash': (average_hash, (8, 8)), 'dhash': (difference_hash, (9, 8))}
+
+
+def image_hash(filename, method='dhash'):
+    """
+    Computes a perceptual hash for an image file. Images that look alike have
+    hashes with a small hamming distance.
+
+    :param filename: image file to compute the hash for
+    :param method: 'ahash' or 'dhash'
+    :return: hash as integer
+    """
+    if not image_libraries_available():
+        raise OSError('NumPy and Pillow are needed to compute hashes of images')
+    hash_function, size = HASH_FUNCTIONS[method]
+    with PIL.Image.open(filename) as image:
+        # let the decoder reduce large JPEG files while loading them
+        image.draft('L', (size[0] * 8, size[1] * 8))
+        small_image = image.convert('L').resize(size, PIL.Image.BILINEAR)
+    return hash_function(numpy.asarray(small_image, dtype=numpy.float32))
+
+
+def image_hashes(filenames, method='dhash'):
+    """Computes perceptual hashes for a batch of image files."""
+    return [image_hash(f, method) for f in filenames]
+
+
+def hamming_distance(first_hash, second_hash):
+    return bin(first_hash ^ second_hash).count('1')
+
+
+# -------------------------------------------------------------------------------------------------
+#  Transcoder class
+# -------------------------------------------------------------------------------------------------
+class Transcoder(object):
+    """
+    Converts image files into a more space-efficient format. If the result is
+    not smaller than the original file and no downscaling was necessary, the
+    original file is kept unchanged. Images already in the target format are
+    only re-encoded if a quality was given. Kept originals get the suffix
+    ".orig", so that they are not recognized as manga pages anymore.
+
+    :param image_format: target format, either 'webp' or 'jpeg'
+    :param quality: quality for the encoder (1-100), defaults to DEFAULT_QUALITY
+    :param max_dimension: maximum width and height, larger images are downscaled
+    :param keep_original: keep the original file next to the transcoded one
+    """
+    def __init__(self, image_format='webp', quality=None, max_dimension=None, keep_original=False):
+        if image_format not in TRANSCODE_FORMATS:
+            raise ValueError('Unknown image format: {}'.format(image_format))
+        self.image_format = image_format
+        self.quality = quality
+        self.max_dimension = max_dimension
+        self.keep_original = keep_original
+
+    def __call__(self, filename):
+        """
+        Transcodes a single image file.
+
+        :return: tuple of new file name, original size and new size in bytes
+        """
+        original_size = os.path.getsize(filename)
+        if not image_libraries_available():
+            logger.debug('Pillow not available, not transcoding image.')
+            return filename, original_size, original_size
+        pil_format, extension = TRANSCODE_FORMATS[self.image_format]
+        with PIL.Image.open(filename) as image:
+            downscale = self.max_dimension and max(image.size) > self.max_dimension
+            if image.format == pil_format and not downscale and self.quality is None:
+                return filename, original_size, original_size
+            if downscale:
+                image.thumbnail((self.max_dimension, self.max_dimension), PIL.Image.LANCZOS)
+            else:
+                image.load()
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            new_filename = os.path.splitext(filename)[0] + extension
+            temp_filename = new_filename + '.part'
+            quality = DEFAULT_QUALITY if self.quality is None else self.quality
+            image.save(temp_filename, format=pil_format, quality=quality)
+        new_size = os.path.getsize(temp_filename)
+        if new_size >= original_size and not downscale:
+            os.remove(temp_filename)
+            return filename, original_size, original_size
+        if self.keep_original:
+            os.replace(filename, filename + ORIGINAL_SUFFIX)
+        elif new_filename != filename:
+            os.remove(filename)
+        os.replace(temp_filename, new_filename)
+        return new_filename, original_size, new_size
+
+
+class TranscodeStatistics(object):
+    """
+    Collects sizes of transcoded images and the time needed for it. Because
+    images are transcoded in parallel, the number of pages per second is
+    given for a single process.
+    """
+    def __init__(self):
+        self.pages = 0
+        self.original_bytes = 0
+        self.new_bytes = 0
+        self.elapsed = 0.0
+        self.__lock = threading.Lock()
+
+    def __str__(self):
+        pages_per_second = self.pages / self.elapsed if self.elapsed else 0.0
+        return '{} pages, {:.1f} KB saved ({:.1f} %), {:.1f} pages/s per process'.format(
+            self.pages, self.bytes_saved / 1024, self.saved_ratio * 100, pages_per_second)
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - self.new_bytes
+
+    @property
+    def saved_ratio(self):
+        return self.bytes_saved / self.original_bytes if self.original_bytes else 0.0
+
+    def add(self, results):
+        """Adds results of process_image() calls."""
+        with self.__lock:
+            for _, original_size, new_size, elapsed in results:
+                self.pages += 1
+                self.original_bytes += original_size
+                self.new_bytes += new_size
+                self.elapsed += elapsed
+
+
+def process_image(postprocess, transcoder, filename):
+    """
+    Post processes an image and transcodes it afterwards, if a transcoder is
+    given. This function is called for every image inside the pool.
+
+    :return: result of the transcoder and the time needed for transcoding or None
+    """
+    postprocess(filename)
+    if transcoder:
+        start_time = time.perf_counter()
+        return transcoder(filename) + (time.perf_counter() - start_time,)
+    return None
+
+
+# -------------------------------------------------------------------------------------------------
+#  ImageProcessingPool class
+# -------------------------------------------------------------------------------------------------
+class ImageProcessingPool(object):
+    """
+    Runs processing functions for downloaded images in a pool of processes,
+    so that they do not slow down loading further images. The function and
+    its arguments have to be picklable.
+
+    :param max_workers: number of processes, defaults to the number of CPUs
+    """
+    def __init__(self, max_workers=None):
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.__futures = {}
+        self.__lock = threading.Lock()
+
+    def submit(self, function, *args, group=None):
+        """
+        Schedules a function to be called for an image.
+
+        :param group: key of the group of calls, e.g. a chapter, that can be
+                      waited for separately from calls of other groups
+        :return: Future object of the call
+        """
+        future = self.executor.submit(function, *args)
+        with self.__lock:
+            self.__futures.setdefault(group, []).append(future)
+        return future
+
+    def wait(self, group=None, all_groups=False):
+        """
+        Waits until all scheduled functions of a group have been called.
+
+        :param group: key of the group given to submit()
+        :param all_groups: wait for the calls of all groups
+        :return: list of results in the order the functions were submitted
+        """
+        with self.__lock:
+            if all_groups:
+                futures = [f for group_futures in self.__futures.values() for f in group_futures]
+                self.__futures.clear()
+            else:
+                futures = self.__futures.pop(group, [])
+        results = []
+        for f in futures:
+            try:
+                results.append(f.result())
+            except Exception as e:
+                logger.error('Could not process image: {}'.format(e))
+                results.append(None)
+        return results
+
+    def map(self, function, items, batch_size=16):
+        """
+        Calls a function for batches of items in the pool. The function gets a
+        list of items and has to return a list of results.
+
+        :return: list of results for all items in the given order
+        """
+        batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+        results = []
+        for batch_result in self.executor.map(function, batches):
+            results.extend(batch_result)
+        return results
+
+    def shutdown(self):
+        self.wait(all_groups=True)
+        self.executor.shutdown()
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    image_libraries_available()
+    print('testing find_content_box()')
+    page = numpy.full((200, 100, 3), 255, dtype=numpy.uint8)
+    page[20:170, 10:90] = numpy.random.randint(0, 255, (150, 80, 1), dtype=numpy.uint8)
+    page[185:200] = numpy.random.randint(0, 255, (15, 100, 3), dtype=numpy.uint8)
+    page[185:200, :, 0] = 255
+    page[185:200, :, 1] = 0
+    assert(find_content_box(page) == (10, 20, 90, 170))
+    assert(find_content_box(page[20:170, 10:90]) is None)
+    print('test successful')
+
+    print('testing ImageProcessingPool.wait()')
+    pool = ImageProcessingPool(2)
+    pool.submit(abs, -1, group='a')
+    pool.submit(abs, -2, group='b')
+    pool.submit(abs, -3, group='a')
+    assert(pool.wait(group='a') == [1, 3])
+    assert(pool.wait(group='a') == [])
+    assert(pool.wait(all_groups=True) == [2])
+    pool.shutdown()
+    print('test successful')
+
+    print('######################################################################')
+
+    print('testing Transcoder()')
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, '001.png')
+        PIL.Image.fromarray(numpy.random.randint(0, 255, (400, 300), dtype=numpy.uint8)).save(filename)
+        new_filename, original_size, new_size = Transcoder('jpeg', max_dimension=200, keep_original=True)(filename)
+        assert(new_filename == os.path.join(temp_dir, '001.jpg'))
+        assert(sorted(os.listdir(temp_dir)) == ['001.jpg', '001.png.orig'])
+        with PIL.Image.open(new_filename) as image:
+            assert(image.size == (150, 200))
+        # images in the target format are only re-encoded with a given quality and only if they get smaller
+        filename = os.path.join(temp_dir, '002.jpg')
+        PIL.Image.fromarray(numpy.random.randint(0, 255, (400, 300), dtype=numpy.uint8)).save(filename, quality=95)
+        assert(Transcoder('jpeg')(filename)[1:] == (os.path.getsize(filename),) * 2)
+        new_filename, original_size, new_size = Transcoder('jpeg', quality=50)(filename)
+        assert(new_filename == filename and new_size < original_size)
+        assert(os.path.getsize(filename) == new_size)
+        assert(Transcoder('jpeg', quality=95)(filename) == (filename, new_size, new_size))
+        assert(sorted(os.listdir(temp_dir)) == ['001.jpg', '001.png.orig', '002.jpg'])
+    print('test successful')
+
+    print('######################################################################')
+
+    print('testing image_hash()')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        gradient = numpy.tile(numpy.linspace(0, 255, 300, dtype=numpy.uint8), (400, 1))
+        PIL.Image.fromarray(gradient).save(os.path.join(temp_dir, '001.png'))
+        PIL.Image.fromarray(gradient).save(os.path.join(temp_dir, '002.jpg'), quality=70)
+        PIL.Image.fromarray(gradient[:, ::-1]).save(os.path.join(temp_dir, '003.png'))
+        hashes = image_hashes([os.path.join(temp_dir, f) for f in ('001.png', '002.jpg', '003.png')])
+        assert(hamming_distance(hashes[0], hashes[1]) <= 2)
+        assert(hamming_distance(hashes[0], hashes[2]) > 32)
+    print('test successful')
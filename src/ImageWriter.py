@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+import os
+import logging
+import threading
+
+
+logger = logging.getLogger('MangaLoader.ImageWriter')
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_FSYNC_BATCH = 0
+
+
+# -------------------------------------------------------------------------------------------------
+#  ImageWriter class
+# -------------------------------------------------------------------------------------------------
+class ImageWriter(object):
+    """
+    Writes streamed image data to disk using large reusable buffers. Every
+    thread gets its own preallocated buffer, which is filled by readinto() of
+    the source and handed to the file as memoryview without further copies.
+    Directories that were created once are remembered, so that they are not
+    created again for every image.
+
+    :param buffer_size: size of the buffer for each thread in bytes
+    :param preallocate: reserve space on disk when the expected length is known
+    :param fsync_batch: number of written files after which all of them are
+                        synced to disk (0 = never, 1 = after every file)
+    """
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, preallocate=True, fsync_batch=DEFAULT_FSYNC_BATCH):
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate and hasattr(os, 'posix_fallocate')
+        self.fsync_batch = fsync_batch
+        self.created_dirs = set()
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__unsynced_files = []
+
+    def _get_buffer(self):
+        """Returns the buffer of the current thread as memoryview."""
+        view = getattr(self.__local, 'view', None)
+        if view is None:
+            view = memoryview(bytearray(self.buffer_size))
+            self.__local.view = view
+        return view
+
+    def ensure_directory(self, directory):
+        """Creates the given directory, if it was not created by this writer before."""
+        if directory in self.created_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        with self.__lock:
+            self.created_dirs.add(directory)
+
+    def write_stream(self, source, file_name, expected_length=None):
+        """
+        Writes all data from a given source into a file. The source should
+        provide a readinto() method, otherwise read() is used with the size of
+        the buffer. If reading fails, the partial file is removed.
+
+        :param source: file-like object to read data from
+        :param file_name: path of the file to be written
+        :param expected_length: number of bytes that are expected (e.g. from Content-Length header)
+        :return: number of bytes written to the file
+        """
+        self.ensure_directory(os.path.dirname(file_name))
+        view = self._get_buffer()
+        written = 0
+        try:
+            with open(file_name, 'wb', buffering=0) as f:
+                if expected_length:
+                    self._preallocate(f, expected_length)
+                readinto = getattr(source, 'readinto', None)
+                while True:
+                    if readinto is not None:
+                        n = readinto(view)
+                    else:
+                        chunk = source.read(len(view))
+                        n = len(chunk)
+                        view[:n] = chunk
+                    if not n:
+                        break
+                    self._write_all(f, view[:n])
+                    written += n
+                if expected_length and written < expected_length:
+                    # remove space that was reserved but never filled
+                    f.truncate(written)
+        except BaseException:
+            # do not leave a partial file, which may be padded with zeros by the preallocation
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+            raise
+        self._mark_unsynced(file_name)
+        return written
+
+    def _preallocate(self, f, length):
+        if not self.preallocate:
+            return
+        try:
+            os.posix_fallocate(f.fileno(), 0, length)
+        except OSError as e:
+            logger.debug('Preallocation not supported, disabling it: {}'.format(e))
+            self.preallocate = False
+
+    @staticmethod
+    def _write_all(f, view):
+        while view:
+            n = f.write(view)
+            view = view[n:]
+
+    def _mark_unsynced(self, file_name):
+        if not self.fsync_batch:
+            return
+        with self.__lock:
+            self.__unsynced_files.append(file_name)
+            if len(self.__unsynced_files) < self.fsync_batch:
+                return
+            files, self.__unsynced_files = self.__unsynced_files, []
+        self._sync_files(files)
+
+    def flush(self):
+        """Syncs all written files to disk that were not synced yet."""
+        with self.__lock:
+            files, self.__unsynced_files = self.__unsynced_files, []
+        self._sync_files(files)
+
+    @staticmethod
+    def _sync_files(files):
+        directories = set()
+        for file_name in files:
+            try:
+                fd = os.open(file_name, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logger.warning('Could not sync file {} to disk: {}'.format(file_name, e))
+            directories.add(os.path.dirname(file_name))
+        # directory entries of new files have to be synced as well
+        for directory in directories:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                logger.debug('Could not sync directory {} to disk.'.format(directory))
+        logger.debug('Synced {} files to disk.'.format(len(files)))
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import io
+    import tempfile
+
+    print('testing ImageWriter.write_stream()')
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        writer = ImageWriter(buffer_size=64 * 1024, fsync_batch=2)
+        file_name = os.path.join(temp_dir, 'Manga', 'Manga 001', '001.jpg')
+        assert(writer.write_stream(io.BytesIO(data), file_name, expected_length=len(data) + 100) == len(data))
+        with open(file_name, 'rb') as f:
+            assert(f.read() == data)
+        writer.flush()
+
+        class BrokenStream(io.BytesIO):
+            def readinto(self, buffer):
+                if self.tell():
+                    raise ConnectionError('connection dropped')
+                return super().readinto(buffer)
+
+        broken_file_name = os.path.join(temp_dir, 'Manga', 'Manga 001', '002.jpg')
+        try:
+            writer.write_stream(BrokenStream(data), broken_file_name, expected_length=len(data))
+            assert(False)
+        except ConnectionError:
+            assert(not os.path.exists(broken_file_name))
+    print('test successful')
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from src import MangaBase
+from src import plugins
+from src import Tracing
+
+
+logger = logging.getLogger('MangaLoader.JobScheduler')
+
+DEFAULT_MAX_WORKERS = 4
+
+
+# -------------------------------------------------------------------------------------------------
+#  job files
+# -------------------------------------------------------------------------------------------------
+def load_job_file(file_name):
+    """
+    Reads a list of jobs from a JSON, TOML or YAML file. The file contains
+    either a list of jobs or a table with the list under the key "jobs". Every
+    job is a table with the keys "plugin", "name", "chapters" and "output" and
+    optionally "zip", "archive_only" and "volume".
+
+    :return: list of Job objects
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.json':
+        with open(file_name, 'r', encoding='UTF-8') as f:
+            data = json.load(f)
+    elif extension == '.toml':
+        import tomllib
+        with open(file_name, 'rb') as f:
+            data = tomllib.load(f)
+    elif extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError('PyYAML is needed to read job file: {}'.format(file_name))
+        with open(file_name, 'r', encoding='UTF-8') as f:
+            data = yaml.safe_load(f)
+    else:
+        raise ValueError('Unknown format of job file: {}'.format(file_name))
+    if isinstance(data, dict):
+        data = data.get('jobs', [])
+    return [Job.from_dict(entry) for entry in data]
+
+
+def parse_chapter_spec(spec):
+    """
+    Returns a list of chapter numbers for a chapter specification. The
+    specification is a number, a string of numbers and ranges separated by
+    commas (e.g. "1, 5-7") or a list of those.
+    """
+    if isinstance(spec, int):
+        return [spec]
+    if isinstance(spec, (list, tuple)):
+        return [no for part in spec for no in parse_chapter_spec(part)]
+    chapters = []
+    for part in str(spec).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            chapters.extend(range(int(first), int(last) + 1))
+        else:
+            chapters.append(int(part))
+    return chapters
+
+
+# -------------------------------------------------------------------------------------------------
+#  Job class
+# -------------------------------------------------------------------------------------------------
+class Job(object):
+    """Chapters of a single manga series that should be loaded from a site."""
+
+    def __init__(self, plugin, name, chapters, output, zip=False, archive_only=False, volume=None):
+        self.plugin = plugin.lower()
+        self.name = name
+        self.chapters = chapters
+        self.output = output
+        self.zip = zip or archive_only
+        self.archive_only = archive_only
+        self.volume = volume
+        # results for the report
+        self.loaded_chapters = []
+        self.failed_chapters = []
+        self.missing_chapters = []
+        self.error = None
+        self.elapsed_time = 0.0
+
+    @classmethod
+    def from_dict(cls, entry):
+        try:
+            return cls(entry['plugin'], entry['name'], parse_chapter_spec(entry['chapters']), entry['output'],
+                       zip=bool(entry.get('zip', False)), archive_only=bool(entry.get('archive_only', False)),
+                       volume=entry.get('volume'))
+        except KeyError as e:
+            raise ValueError('Job is missing key {}: {}'.format(e, entry))
+
+    def __str__(self):
+        return '{} ({})'.format(self.name, self.plugin)
+
+    def get_report(self):
+        return {'plugin': self.plugin, 'name': self.name, 'loaded': sorted(self.loaded_chapters),
+                'failed': sorted(self.failed_chapters), 'missing': sorted(self.missing_chapters),
+                'error': self.error, 'elapsed_time': round(self.elapsed_time, 2)}
+
+
+# -------------------------------------------------------------------------------------------------
+#  JobScheduler class
+# -------------------------------------------------------------------------------------------------
+class JobScheduler(object):
+    """
+    Runs many jobs in a single process. The catalog of every site is loaded
+    only once and all downloads share the connection pool of the plugins. At
+    most max_workers chapters are loaded at the same time and free workers
+    take chapters from the jobs in turn, so that a series with many chapters
+    does not hold back all other series.
+
+    :param jobs: list of Job objects
+    :param plugin_classes: dictionary of lower case plugin name and plugin class,
+                           by default all plugins of the plugin registry
+    :param max_workers: maximum number of chapters that are loaded at the same time
+    :param loader_options: further keyword arguments for all Loader objects
+    """
+    def __init__(self, jobs, plugin_classes=None, max_workers=DEFAULT_MAX_WORKERS, **loader_options):
+        self.jobs = jobs
+        self.plugin_classes = plugin_classes
+        self.max_workers = max_workers
+        self.loader_options = loader_options
+        self.__plugins = {}
+        self.__catalogs = {}
+        self.__loaders = {}
+        self.__lock = threading.Lock()
+
+    def get_loader(self, job):
+        """Returns the loader for the site, destination and storage mode of a job."""
+        key = (job.plugin, job.output, job.archive_only)
+        with self.__lock:
+            if key not in self.__loaders:
+                if job.plugin not in self.__plugins:
+                    self.__plugins[job.plugin] = self._create_plugin(job.plugin)
+                # load the catalog of a site only once for all loaders
+                known_catalog = job.plugin in self.__catalogs
+                loader = MangaBase.Loader(self.__plugins[job.plugin], job.output, pickle_data=not known_catalog,
+                                          archive_only=job.archive_only, **self.loader_options)
+                if not known_catalog:
+                    self.__catalogs[job.plugin] = loader.get_all_manga()
+                loader.manga_list = self.__catalogs[job.plugin]
+                self.__loaders[key] = loader
+            return self.__loaders[key]
+
+    def _create_plugin(self, name):
+        if self.plugin_classes is None:
+            return plugins.create_plugin(name)
+        if name not in self.plugin_classes:
+            raise ValueError('Unknown plugin: {}'.format(name))
+        return self.plugin_classes[name]()
+
+    def _prepare_job(self, job):
+        """Finds manga and chapter objects of a job and returns the chapters to be loaded."""
+        with Tracing.span('manga', 'manga', manga=job.name, plugin=job.plugin):
+            loader = self.get_loader(job)
+            manga = loader.get_manga_by_name(job.name)
+            if manga is None:
+                raise ValueError('Manga not found: {}'.format(job.name))
+            chapters_by_number = {c.chapterNo: c for c in loader.get_all_chapters(manga)}
+        chapters = deque()
+        for no in job.chapters:
+            if no in chapters_by_number:
+                chapters.append(chapters_by_number[no])
+            else:
+                logger.error('Could not find object for chapter {} of {}.'.format(no, job))
+                job.missing_chapters.append(no)
+        return loader, manga, chapters
+
+    def _load_chapter(self, job, loader, manga, chapter):
+        start_time = time.monotonic()
+        try:
+            result = loader.handle_chapter(chapter)
+            if result and job.zip:
+                result = loader.zip_chapter(manga, chapter)
+        except Exception as e:
+            logger.exception('Loading chapter {} of {} failed: {}'.format(chapter.chapterNo, job, e))
+            result = False
+        with self.__lock:
+            job.elapsed_time += time.monotonic() - start_time
+            (job.loaded_chapters if result else job.failed_chapters).append(chapter.chapterNo)
+        return result
+
+    def run(self):
+        """Runs all jobs and returns true, if all chapters of all jobs were loaded."""
+        queues = deque()
+        for job in self.jobs:
+            try:
+                loader, manga, chapters = self._prepare_job(job)
+            except Exception as e:
+                logger.error('Could not prepare job {}: {}'.format(job, e))
+                job.error = str(e)
+                continue
+            if chapters:
+                queues.append((job, loader, manga, chapters))
+        running = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while queues or running:
+                # take the next chapter from every job in turn while workers are free
+                while queues and len(running) < self.max_workers:
+                    job, loader, manga, chapters = entry = queues.popleft()
+                    running.add(executor.submit(self._load_chapter, job, loader, manga, chapters.popleft()))
+                    if chapters:
+                        queues.append(entry)
+                if running:
+                    _, running = wait(running, return_when=FIRST_COMPLETED)
+        for job in self.jobs:
+            if job.volume is not None and job.loaded_chapters and not job.error:
+                loader = self.get_loader(job)
+                manga = loader.get_manga_by_name(job.name)
+                chapters = [manga.get_chapter(no) for no in sorted(job.loaded_chapters)]
+                loader.bundle_volume(manga, chapters, job.volume)
+        for loader in self.__loaders.values():
+            loader.close()
+        return all(not (job.error or job.failed_chapters or job.missing_chapters) for job in self.jobs)
+
+    def get_report(self):
+        """Returns the results of all jobs as list of dictionaries."""
+        return [job.get_report() for job in self.jobs]
+
+    def format_report(self):
+        lines = ['{:<30} {:<10} {:>6} {:>6} {:>7} {:>9}'.format('Manga', 'Plugin', 'Loaded', 'Failed',
+                                                               'Missing', 'Time')]
+        for job in self.jobs:
+            lines.append('{:<30} {:<10} {:>6} {:>6} {:>7} {:>8.1f}s{}'.format(
+                job.name[:30], job.plugin, len(job.loaded_chapters), len(job.failed_chapters),
+                len(job.missing_chapters), job.elapsed_time, '  ' + job.error if job.error else ''))
+        return '\n'.join(lines)
+
+    def write_report(self, file_name):
+        with open(file_name, 'w', encoding='UTF-8') as f:
+            json.dump(self.get_report(), f, indent=2)
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import tempfile
+
+    print('testing parse_chapter_spec()')
+    assert(parse_chapter_spec('1, 5-7') == [1, 5, 6, 7])
+    assert(parse_chapter_spec([3, '10-11']) == [3, 10, 11])
+    assert(parse_chapter_spec(42) == [42])
+    print('test successful')
+
+    print('testing load_job_file()')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        job_file = os.path.join(temp_dir, 'jobs.toml')
+        with open(job_file, 'w', encoding='UTF-8') as f:
+            f.write('[[jobs]]\nplugin = "MangaFox"\nname = "Claymore"\nchapters = "14-16"\noutput = "."\n'
+                    'archive_only = true\n')
+        jobs = load_job_file(job_file)
+        assert(len(jobs) == 1 and jobs[0].plugin == 'mangafox' and jobs[0].chapters == [14, 15, 16])
+        assert(jobs[0].zip)
+    print('test successful')
@@ -4,13 +4,23 @@ import logging
 import mimetypes
 import os
 import pickle
+import threading
+import time
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
-import requests
-
 from src.data import Image
 from src import MangaZipper
+from src import Metrics
+from src import Profiling
+from src import Tracing
+from src import PluginBase
+from src.ImageProcessing import ImageProcessingPool, TranscodeStatistics, process_image
+from src.PageFilter import HashIndex
+from src.SeriesIndex import SeriesIndex
+from src.Planner import HostStatistics
+from src.ImageWriter import ImageWriter
 
 
 logger = logging.getLogger('MangaLoader.MangaBase')
@@ -20,13 +30,34 @@ MANGA_LIST_FILE_PREFIX = 'Manga'
 MANGA_LIST_FILE_SUFFIX = '.dat'
 
 
+@contextmanager
+def raw_read_errors_as_request_errors():
+    """
+    Raises errors of urllib3 while reading the raw stream of a response as
+    the exceptions of requests, which requests raises itself when the
+    response is iterated, so that they are handled like all other failed
+    requests.
+    """
+    import requests
+    from urllib3.exceptions import HTTPError, ProtocolError, DecodeError
+    try:
+        yield
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e) from e
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e) from e
+    except HTTPError as e:
+        raise requests.exceptions.ConnectionError(e) from e
+
+
 # -------------------------------------------------------------------------------------------------
 #  ImageStoreManager class
 # -------------------------------------------------------------------------------------------------
 class ImageStoreManager(object):
 
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, writer=None):
         self.base_dir = base_dir
+        self.writer = writer if writer is not None else ImageWriter()
 
     def get_manga_dir(self, manga):
         return os.path.join(self.base_dir, manga.name)
@@ -53,18 +84,19 @@ class ImageStoreManager(object):
         """
         Finds path of the next image that should be shown. After a given
         chapter of a series is finished, the next image is automatically from
-        the following chapter.
+        the following chapter. Missing chapters are skipped and the search
+        ends after the last loaded chapter. Chapters that are only stored as
+        CBZ file yield ArchivePage objects instead of paths.
         """
-        # TODO: Implement reversing direction to get to previous image.
-        while True:
-            chapter_path = self.get_chapter_dir(start_with_chapter)
-            # TODO: Check whether to filter for file type/extension.
-            for path, dirs, files in os.walk(chapter_path):
-                for f in sorted(files):
-                    path = os.path.abspath(os.path.join(chapter_path, f))
-                    yield path
-            # TODO: Handle this better!!!
-            start_with_chapter.chapterNo += 1
+        series_index = SeriesIndex.for_directory(self.get_manga_dir(start_with_chapter.manga))
+        start = series_index.seek(start_with_chapter.chapterNo)
+        if start is None:
+            return iter(())
+        return series_index.iter_pages(start)
+
+    def get_series_index(self, manga):
+        """Returns the index of all loaded pages for a given manga."""
+        return SeriesIndex.for_directory(self.get_manga_dir(manga))
 
     def does_image_already_exists(self, image):
         """
@@ -77,17 +109,30 @@ class ImageStoreManager(object):
         base_name = self.get_image_path(image)
         extension = self.guess_file_extension(stream.headers['content-type'], image.url)
         image_file_name = '{}{}'.format(base_name, extension)
-        # create necessary directories first
-        try:
-            os.makedirs(base_name[0:base_name.rfind('/')])
-        except OSError:
-            logger.debug('Directories in image store already exist.')
-        # open file and write chunks of default size (128 byte)
-        with open(image_file_name, 'wb') as f:
-            for chunk in stream:
-                f.write(chunk)
+        # let urllib3 undo content encodings while filling the buffer of the writer
+        stream.raw.decode_content = True
+        expected_length = None
+        if 'content-encoding' not in stream.headers and stream.headers.get('content-length', '').isdigit():
+            expected_length = int(stream.headers['content-length'])
+        with raw_read_errors_as_request_errors():
+            self.writer.write_stream(stream.raw, image_file_name, expected_length=expected_length)
         return image_file_name
 
+    def store_file_in_archive(self, stream, image, archive):
+        """
+        Adds the data of a downloaded image directly to the archive of its
+        chapter instead of writing it into the chapter directory. The body of
+        the response is copied in chunks.
+
+        :return: number of bytes stored
+        """
+        extension = self.guess_file_extension(stream.headers['content-type'], image.url)
+        file_name = '{ImageNo:03d}{Ext}'.format(ImageNo=image.imageNo, Ext=extension)
+        # let urllib3 undo content encodings while copying the page
+        stream.raw.decode_content = True
+        with raw_read_errors_as_request_errors():
+            return archive.add_page_stream(image.imageNo, file_name, stream.raw)
+
     @staticmethod
     def guess_file_extension(content_type, source):
         # get file extension for content type
@@ -108,11 +153,33 @@ class ImageStoreManager(object):
 # -------------------------------------------------------------------------------------------------
 class Loader(object):
 
-    def __init__(self, loader_plugin, store_directory, pickle_data=True):
+    def __init__(self, loader_plugin, store_directory, pickle_data=True, image_writer=None, archive_only=False,
+                 compression_policy=MangaZipper.DEFAULT_POLICY, postprocess_workers=0, transcoder=None,
+                 page_filter=None, host_statistics=None):
         self.loader_plugin = loader_plugin
+        # label of all measured stages of this loader
+        self.plugin_name = loader_plugin.__class__.__name__
         self.__store_directory = store_directory
         self.pickle_data = pickle_data
-        self.image_store_manager = ImageStoreManager(store_directory)
+        self.archive_only = archive_only
+        self.compression_policy = compression_policy
+        # post process images in separate processes or directly after loading them
+        self.postprocess_pool = ImageProcessingPool(postprocess_workers) if postprocess_workers else None
+        self.transcoder = transcoder
+        self.transcode_statistics = TranscodeStatistics()
+        self.page_filter = page_filter
+        self.hash_indices = {}
+        self.__hash_indices_lock = threading.Lock()
+        # observed throughput of image hosts for estimating later downloads, saved by the caller
+        self.host_statistics = host_statistics if host_statistics is not None else HostStatistics()
+        self.image_store_manager = ImageStoreManager(store_directory, image_writer)
+        if archive_only:
+            # plugins that do not derive from PluginBase may lack the attribute
+            modifies_images = getattr(loader_plugin, 'modifies_images', False)
+            skipped = [name for name, used in (('plugin postprocessing', modifies_images), ('transcoding', transcoder),
+                                               ('page filter', page_filter)) if used]
+            if skipped:
+                logger.warning('Images are written directly into archives, skipping {}.'.format(', '.join(skipped)))
         self.manga_list = None
         self.manga_list_filename = '{}-{}{}'.format(MANGA_LIST_FILE_PREFIX, loader_plugin.__class__.__name__,
                                                     MANGA_LIST_FILE_SUFFIX)
@@ -130,7 +197,7 @@ class Loader(object):
 
     def _load_manga_list(self):
         try:
-            with open(self.manga_list_filename, 'rb') as f:
+            with open(self.manga_list_filename, 'rb') as f, Profiling.stage('pickle'):
                 self.manga_list = pickle.load(f)
             return self.manga_list
         except OSError:
@@ -145,7 +212,7 @@ class Loader(object):
         """
         logger.info('Saving manga list to file.')
         error = False
-        with open(self.manga_list_filename, 'wb') as f:
+        with open(self.manga_list_filename, 'wb') as f, Profiling.stage('pickle'):
             # pickle the manga list using the highest protocol available
             try:
                 pickle.dump(self.manga_list, f)  # , pickle.HIGHEST_PROTOCOL
@@ -156,7 +223,12 @@ class Loader(object):
 
     def get_all_manga(self, update=False):
         if update:
-            self.manga_list = self.loader_plugin.load_manga_list()
+            # plugins cache their catalog for all loaders, so it has to be loaded again explicitly
+            if hasattr(self.loader_plugin.load_manga_list, 'invalidate'):
+                self.loader_plugin.load_manga_list.invalidate()
+            with Profiling.stage('catalog'), Metrics.plugin_context(self.plugin_name), \
+                    Tracing.span('catalog', 'manga', plugin=self.plugin_name):
+                self.manga_list = self.loader_plugin.load_manga_list()
             # FIXME: Problem with circular dependencies between Manga and Chapter!
             if self.pickle_data:
                 self._save_manga_list()
@@ -181,7 +253,9 @@ class Loader(object):
         return None
 
     def get_all_chapters(self, chosen_manga):
-        return self.loader_plugin.load_chapter_list(chosen_manga)
+        with Profiling.stage('chapter_parse'), Metrics.plugin_context(self.plugin_name), \
+                Tracing.span('chapter list', 'manga', manga=str(chosen_manga)):
+            return self.loader_plugin.load_chapter_list(chosen_manga)
 
     def parse_chapter_for_manga(self, manga=None, chapter_no=None, image_no=None, load_images=True):
         """
@@ -192,9 +266,10 @@ class Loader(object):
         manga_name = '' if manga is None else manga.name
         # FIXME: Handle None for manga parameter.
         logger.debug('Parsing_manga({}, {}, {})'.format(str(manga_name), str(chapter_no), str(image_no)))
-        self.loader_plugin.load_chapter_list(manga)
-        if load_images:
-            self._parse_images_for_chapter(manga, chapter_no, image_no)
+        with Profiling.stage('chapter_parse'), Metrics.plugin_context(self.plugin_name):
+            self.loader_plugin.load_chapter_list(manga)
+            if load_images:
+                self._parse_images_for_chapter(manga, chapter_no, image_no)
         return manga
 
     def _parse_images_for_chapter(self, manga, chapter_no, image_no):
@@ -237,73 +312,213 @@ class Loader(object):
                 raise RuntimeError('Unable to retrieve chapter ' + str(chapter_no) + ' for manga ' + str(manga))
             manga_dir = self.image_store_manager.get_manga_dir(manga)
             chapter_dir = self.image_store_manager.get_chapter_dir(chapter)
-            MangaZipper.create_zip(chapter_dir, manga_dir)
+            with Profiling.stage('archive'), Metrics.measure('archive', self.plugin_name), \
+                    Tracing.span('archive', 'chapter', chapter=str(chapter)):
+                MangaZipper.create_zip(chapter_dir, manga_dir)
             logger.info('cbz: "' + str(chapter) + '"')
 
-    def handle_chapter(self, chapter):
+    def handle_chapter(self, chapter, progress_callback=None):
         logger.debug('handleChapter({})'.format(chapter))
-        if not self._parse_chapter(chapter):
-            return False
-        if not self.load_chapter(chapter):
-            return False
-        return True
+        with Tracing.span('chapter', 'chapter', chapter=str(chapter)) as span:
+            if not self.resolve_chapter(chapter):
+                span.set(result='no images')
+                return False
+            if not self.load_chapter(chapter, progress_callback=progress_callback):
+                span.set(result='incomplete')
+                return False
+            return True
 
     def zip_chapter(self, manga, chapter):
         logger.debug('zipChapter({}, {})'.format(manga.name, chapter.chapterNo))
-        if MangaZipper.create_zip(self.image_store_manager.get_chapter_dir(chapter),
-                                  self.image_store_manager.get_manga_dir(manga)):
+        if self.archive_only:
+            # images have already been stored in the archive while loading the chapter
+            return True
+        with Profiling.stage('archive'), Metrics.measure('archive', self.plugin_name), \
+                Tracing.span('archive', 'chapter', chapter=str(chapter)):
+            result = MangaZipper.create_zip(self.image_store_manager.get_chapter_dir(chapter),
+                                            self.image_store_manager.get_manga_dir(manga), self.compression_policy)
+        if result:
             logger.info('cbz: "' + str(chapter) + '"')
             return True
         return False
 
-    def _parse_chapter(self, chapter):
+    def zip_chapters(self, manga, chapter_list, max_workers=None):
+        """
+        Creates CBZ files for all given chapters concurrently in a pool of
+        processes.
+
+        :return: true, if all CBZ files could be created
+        """
+        logger.debug('zipChapters({}, {})'.format(manga.name, [c.chapterNo for c in chapter_list]))
+        if self.archive_only:
+            return True
+        manga_dir = self.image_store_manager.get_manga_dir(manga)
+        dir_list = [(self.image_store_manager.get_chapter_dir(c), manga_dir) for c in chapter_list]
+        results = MangaZipper.create_zips(dir_list, self.compression_policy, max_workers)
+        for chapter, result in zip(chapter_list, results):
+            if result:
+                logger.info('cbz: "' + str(chapter) + '"')
+        return all(results)
+
+    def bundle_volume(self, manga, chapter_list, volume_no, add_comet=True):
+        """
+        Bundles the CBZ files of all given chapters into a single CBZ file for
+        a volume. Missing chapter archives are created first.
+
+        :return: true, if the volume could be created
+        """
+        logger.debug('bundleVolume({}, {}, {})'.format(manga.name, [c.chapterNo for c in chapter_list], volume_no))
+        manga_dir = self.image_store_manager.get_manga_dir(manga)
+        cbz_files = []
+        for chapter in chapter_list:
+            chapter_dir = self.image_store_manager.get_chapter_dir(chapter)
+            cbz_file = os.path.join(manga_dir, os.path.basename(chapter_dir) + '.cbz')
+            if not os.path.exists(cbz_file) and not self.zip_chapter(manga, chapter):
+                logger.error('Could not find or create CBZ file for chapter {}.'.format(chapter))
+                return False
+            cbz_files.append(cbz_file)
+        if not cbz_files:
+            return False
+        volume_file = os.path.join(manga_dir, '{name} Vol {no:02d}.cbz'.format(name=manga.name, no=volume_no))
+        comet = {'series': manga.name, 'volume': volume_no} if add_comet else None
+        with Profiling.stage('archive'), Metrics.measure('archive', self.plugin_name), \
+                Tracing.span('volume', 'manga', volume=volume_no):
+            MangaZipper.bundle_volume(cbz_files, volume_file, comet)
+        logger.info('volume: "{}"'.format(volume_file))
+        return True
+
+    def resolve_chapter(self, chapter):
+        """
+        Resolves the URLs of all images of a chapter and adds the images to it.
+
+        :return: true, if at least one image was found
+        """
         return_value = False
-        for i in range(1, 1000):
-            image = Image(chapter, i)
-            if not self.loader_plugin.load_image_url(image):
-                break
-            chapter.add_image(image)
-            return_value = True
+        with Profiling.stage('chapter_parse'), Metrics.plugin_context(self.plugin_name), \
+                Tracing.span('resolve', 'chapter', chapter=str(chapter)):
+            for i in range(1, 1000):
+                image = Image(chapter, i)
+                if not self.loader_plugin.load_image_url(image):
+                    break
+                chapter.add_image(image)
+                return_value = True
         return return_value
 
-    def load_chapter(self, chapter, use_threads=False):
-        if not use_threads:
-            for image in chapter.image_list:
-                self.load_image(image)
-            return True
-        else:
-            list_of_futures = list()
-            # context manager cleans up automatically after all threads have executed
-            with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKER) as executor:
+    def load_chapter(self, chapter, use_threads=False, progress_callback=None):
+        """
+        Loads all images of a parsed chapter.
+
+        :param chapter: Chapter object with the list of its images
+        :param use_threads: load images concurrently in a pool of threads
+        :param progress_callback: function that is called with the Image object
+                                  and the result after every loaded image; if
+                                  it returns False, the remaining images are
+                                  not loaded anymore
+        :return: true, if the chapter was loaded completely
+        """
+        archive = None
+        if self.archive_only:
+            archive = MangaZipper.ChapterArchive(self.image_store_manager.get_chapter_dir(chapter),
+                                                 self.image_store_manager.get_manga_dir(chapter.manga),
+                                                 [image.imageNo for image in chapter.image_list],
+                                                 policy=self.compression_policy)
+        cancelled = threading.Event()
+
+        def load(image):
+            if cancelled.is_set():
+                return False
+            result = self.load_image(image, archive)
+            if progress_callback and progress_callback(image, result) is False:
+                cancelled.set()
+            return result
+
+        completed = False
+        try:
+            if not use_threads:
                 for image in chapter.image_list:
-                    f = executor.submit(self.load_image, image)
-                    list_of_futures.append(f)
-            return True
+                    load(image)
+            else:
+                list_of_futures = list()
+                # context manager cleans up automatically after all threads have executed
+                with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKER) as executor:
+                    for image in chapter.image_list:
+                        f = executor.submit(load, image)
+                        list_of_futures.append(f)
+                # raise errors of the threads like in the sequential case
+                for f in list_of_futures:
+                    f.result()
+            completed = True
+        finally:
+            if archive:
+                # an incomplete archive must not leave its file handle and temporary file behind
+                if completed and not cancelled.is_set():
+                    archive.close()
+                else:
+                    archive.abort()
+        if self.postprocess_pool:
+            # all images of this chapter have to be processed before it can be zipped, other chapters may be
+            # loaded by the same loader at the same time
+            self.transcode_statistics.add([r for r in self.postprocess_pool.wait(group=chapter) if r])
+        if self.transcoder:
+            logger.info('transcode: {}'.format(self.transcode_statistics))
+        if self.page_filter and not archive and not cancelled.is_set():
+            self.filter_pages(chapter)
+        # sync remaining images of this chapter when fsync batching is used
+        self.image_store_manager.writer.flush()
+        if cancelled.is_set():
+            logger.info('Loading of chapter {} was cancelled.'.format(chapter))
+            return False
+        return True
 
-    def load_image(self, image):
+    def load_image(self, image, archive=None):
         # calculate destination path and call store_file_on_disk()
-        if not self.store_file_on_disk(image):
+        with Profiling.stage('image_download'), Tracing.span('image', 'image', image=str(image)):
+            stored = self.store_file_on_disk(image, archive=archive)
+        if not stored:
+            if archive:
+                archive.skip_page(image.imageNo)
             return False
         logger.info('load: "{}"'.format(image))
         return True
 
-    def store_file_on_disk(self, image, max_tries=5):
+    def store_file_on_disk(self, image, max_tries=5, archive=None):
         """
         Requests data from given URL in Image object and calls ImageStoreManager instance to save it to destination
         file. If the requests times out or an error occurs, the requests is send again for a maximum number of times.
 
         :param image: Image object containing the URL to load data from
         :param max_tries: number of times to try to request data from URL
+        :param archive: ChapterArchive to store the image in instead of writing it to the chapter directory
         :return: true, if request was successful
         """
+        import requests
         tries = 1
         while True:
             source = image.url
+            host = urlparse(source).netloc
             try:
-                r = requests.get(source, stream=True, timeout=2)
-                if r.status_code == requests.codes.ok:
-                    actual_file_path = self.image_store_manager.store_file_on_disk(r, image)
-                    self.loader_plugin.postprocess_image(actual_file_path)
+                start_time = time.monotonic()
+                with Metrics.measure('write', self.plugin_name, host):
+                    with Tracing.span('http', 'image', url=source, try_count=tries) as span:
+                        r = PluginBase.get_session().get(source, stream=True, timeout=2)
+                        span.set(status=r.status_code)
+                    if r.status_code != requests.codes.ok:
+                        logger.warning('failed to load {} (status {})'.format(source, r.status_code))
+                        Metrics.add_error('write', self.plugin_name, host)
+                        return False
+                    # the body of the response is streamed while it is written
+                    with Tracing.span('write', 'image', archive=bool(archive)) as span:
+                        if archive:
+                            # post processing is only possible for image files in the chapter directory
+                            size = self.image_store_manager.store_file_in_archive(r, image, archive)
+                        else:
+                            actual_file_path = self.image_store_manager.store_file_on_disk(r, image)
+                            size = os.path.getsize(actual_file_path)
+                        span.set(size=size)
+                Metrics.add_bytes('write', size, self.plugin_name, host)
+                self.host_statistics.add(source, size, time.monotonic() - start_time)
+                if not archive:
+                    self.postprocess_image(actual_file_path, image.chapter)
                 return True
             except requests.exceptions.RequestException:
                 logger.warning('failed to load {} (try {})'.format(source, tries))
@@ -311,6 +526,56 @@ class Loader(object):
                     return False
             tries += 1
 
+    def postprocess_image(self, file_name, chapter=None):
+        """
+        Post processes a loaded image directly or schedules it in the pool of
+        processes, where it can be waited for by its chapter.
+        """
+        if self.postprocess_pool:
+            # measured time includes waiting for a free process of the pool
+            start_time = time.perf_counter_ns()
+            # the callback runs in a thread of the pool, but the span belongs to the thread loading the image
+            tid = threading.get_ident()
+
+            def observe(future):
+                if future.cancelled() or future.exception():
+                    Metrics.add_error('postprocess', self.plugin_name)
+                end_time = time.perf_counter_ns()
+                Metrics.STAGE_SECONDS.observe((end_time - start_time) / 1e9, stage='postprocess',
+                                              plugin=self.plugin_name, host='')
+                Tracing.add_span('postprocess', 'image', start_time, end_time, tid=tid, file=file_name, pool=True)
+
+            self.postprocess_pool.submit(process_image, self.loader_plugin.postprocess_image, self.transcoder,
+                                         file_name, group=chapter).add_done_callback(observe)
+        else:
+            with Metrics.measure('postprocess', self.plugin_name), Tracing.span('postprocess', 'image', file=file_name):
+                result = process_image(self.loader_plugin.postprocess_image, self.transcoder, file_name)
+            if result:
+                self.transcode_statistics.add([result])
+
+    def filter_pages(self, chapter):
+        """
+        Computes perceptual hashes for all pages of a loaded chapter, stores
+        them in the hash index of the manga and handles filler pages.
+        """
+        chapter_dir = self.image_store_manager.get_chapter_dir(chapter)
+        if not os.path.isdir(chapter_dir):
+            return []
+        manga_dir = self.image_store_manager.get_manga_dir(chapter.manga)
+        with self.__hash_indices_lock:
+            if manga_dir not in self.hash_indices:
+                self.hash_indices[manga_dir] = HashIndex(manga_dir)
+            hash_index = self.hash_indices[manga_dir]
+        fillers = self.page_filter.filter_chapter(chapter_dir, hash_index, self.postprocess_pool)
+        if fillers:
+            logger.info('filler pages in "{}": {}'.format(chapter, ', '.join(fillers)))
+        return fillers
+
+    def close(self):
+        """Waits for all images to be processed and releases the pool of processes."""
+        if self.postprocess_pool:
+            self.postprocess_pool.shutdown()
+
 
 # -------------------------------------------------------------------------------------------------
 #  <module>
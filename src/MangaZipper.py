@@ -1,37 +1,613 @@
 #!/usr/bin/python3
 
 import os
+import sys
+import time
+import shutil
+import zlib
+import struct
 import zipfile
+import tempfile
 import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from src import CometGenerator
+from src.helper import is_image_file
 
 
 logger = logging.getLogger('MangaLoader.MangaZipper')
 
+# image formats that are already compressed and gain nothing from deflating
+COMPRESSED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+COMPRESSION_MODES = ('auto', 'store', 'deflate')
+# valid compression levels of deflate
+COMPRESSION_LEVELS = range(0, 10)
+
+# layout of the local file header in front of every entry in a zip file
+LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'
+LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+COPY_BUFFER_SIZE = 1024 * 1024
+# pages streamed into a chapter archive are held in memory up to this size and in a temporary file beyond it
+SPOOL_MAX_SIZE = 256 * 1024
+# Python versions whose private zipfile internals are known to work with copying raw entries, other versions
+# decompress and compress all entries again through the public interface
+RAW_COPY_VERSIONS = ((3, 6), (3, 14))
+RAW_COPY_ATTRIBUTES = ('fp', 'filelist', 'NameToInfo', 'start_dir', '_didModify')
+
+
+# -------------------------------------------------------------------------------------------------
+#  CompressionPolicy class
+# -------------------------------------------------------------------------------------------------
+class CompressionPolicy(object):
+    """
+    Decides how files are compressed inside a CBZ file.
+
+    :param mode: 'auto' stores already compressed formats and deflates all
+                 other files, 'store' and 'deflate' use the same method for
+                 all files
+    :param level: compression level for deflated files (0-9)
+    """
+    def __init__(self, mode='auto', level=6):
+        if mode not in COMPRESSION_MODES:
+            raise ValueError('Unknown compression mode: {}'.format(mode))
+        if level not in COMPRESSION_LEVELS:
+            raise ValueError('Invalid compression level: {}'.format(level))
+        self.mode = mode
+        self.level = level
+
+    def __str__(self):
+        return '{} (level {})'.format(self.mode, self.level)
+
+    def get_compression(self, file_name):
+        """Returns compression type and level for a given file name."""
+        if self.mode == 'store':
+            return zipfile.ZIP_STORED, None
+        if self.mode == 'auto' and os.path.splitext(file_name)[1].lower() in COMPRESSED_EXTENSIONS:
+            return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, self.level
+
+
+DEFAULT_POLICY = CompressionPolicy()
+
 
 # -------------------------------------------------------------------------------------------------
 #  zipper functions
 # -------------------------------------------------------------------------------------------------
-def create_zip(manga_dir, dest_dir):
+def create_zip(manga_dir, dest_dir, policy=DEFAULT_POLICY, verify_crc=False):
+    """
+    Creates a CBZ file containing all files of a chapter directory in sorted
+    order. If the CBZ file already exists, its central directory is compared
+    with the files on disk. Missing pages at the end are appended, unchanged
+    archives are left alone and only archives with changed, extra or wrongly
+    ordered entries are rebuilt.
+
+    :param manga_dir: chapter directory containing all image files
+    :param dest_dir: directory to store the CBZ file in
+    :param policy: compression policy for all files
+    :param verify_crc: compare CRC of all entries instead of only size and modification time
+    :return: true, if the CBZ file is up to date
+    """
     logger.debug('Creating CBZ file from {} to {}.'.format(manga_dir, dest_dir))
     if not os.path.exists(manga_dir) or not os.path.isdir(manga_dir):
         return False
     name = os.path.basename(os.path.normpath(manga_dir))
-    zip_file_name = name + '.cbz'
-    logger.debug('Creating CBZ file: {}...'.format(zip_file_name))
-    with zipfile.ZipFile(os.path.join(dest_dir, zip_file_name), 'w') as cbzFile:
-        for f in os.listdir(manga_dir):
-            # TODO check file extension
-            # fileName, fileExtension = os.path.splitext(f)
+    zip_file_name = os.path.join(dest_dir, name + '.cbz')
+    pages = sorted(f for f in os.listdir(manga_dir)
+                   if (is_image_file(f) or f == 'comet.xml') and os.path.isfile(os.path.join(manga_dir, f)))
+    if os.path.exists(zip_file_name):
+        missing_pages = _find_missing_pages(zip_file_name, name, manga_dir, pages, verify_crc)
+        if missing_pages is not None:
+            if missing_pages:
+                logger.debug('Appending {} files to CBZ file: {}...'.format(len(missing_pages), zip_file_name))
+                _write_pages(zip_file_name, 'a', name, manga_dir, missing_pages, policy)
+            else:
+                logger.debug('CBZ file is up to date: {}'.format(zip_file_name))
+            return True
+        logger.debug('Rebuilding CBZ file: {}...'.format(zip_file_name))
+    else:
+        logger.debug('Creating CBZ file: {}...'.format(zip_file_name))
+    # build new archive in a temporary file to keep the old one until the new one is complete
+    temp_file_name = zip_file_name + '.part'
+    _write_pages(temp_file_name, 'w', name, manga_dir, pages, policy)
+    os.replace(temp_file_name, zip_file_name)
+    return True
+
+
+def _write_pages(zip_file_name, mode, name, manga_dir, pages, policy):
+    with zipfile.ZipFile(zip_file_name, mode) as cbzFile:
+        for f in pages:
             logger.debug('add file "{}" to cbz file "{}".'.format(f, zip_file_name))
             file_in_filesystem = os.path.join(manga_dir, f)
             # TODO: Check whether it is necessary to encode file_in_zipfile as ASCII (xxx.encode('ascii'))
             file_in_zipfile = os.path.join(name, os.path.basename(f))
-            cbzFile.write(file_in_filesystem, file_in_zipfile, zipfile.ZIP_DEFLATED)
-    return True
+            compress_type, compress_level = policy.get_compression(f)
+            cbzFile.write(file_in_filesystem, file_in_zipfile, compress_type, compress_level)
+
+
+def _find_missing_pages(zip_file_name, name, manga_dir, pages, verify_crc):
+    """
+    Compares the entries of an existing CBZ file with the pages on disk. If
+    the archive contains unchanged pages in the correct order and only pages
+    at the end are missing, the list of missing pages is returned. Otherwise
+    None is returned and the archive has to be rebuilt.
+    """
+    try:
+        with zipfile.ZipFile(zip_file_name) as cbzFile:
+            entries = cbzFile.infolist()
+    except (zipfile.BadZipFile, OSError):
+        logger.warning('Could not read existing CBZ file: {}'.format(zip_file_name))
+        return None
+    expected_names = [os.path.join(name, f) for f in pages]
+    if [info.filename for info in entries] != expected_names[:len(entries)]:
+        return None
+    for info, f in zip(entries, pages):
+        if _is_changed(info, os.path.join(manga_dir, f), verify_crc):
+            logger.debug('File "{}" changed since CBZ file was created.'.format(f))
+            return None
+    return pages[len(entries):]
+
+
+def _is_changed(info, file_name, verify_crc):
+    """
+    Checks whether a file differs from an entry in a CBZ file. Size and
+    modification time are compared first, only if the modification time
+    differs or verify_crc is set, the file has to be read to compare its CRC.
+    """
+    stat = os.stat(file_name)
+    if info.file_size != stat.st_size:
+        return True
+    # modification times are stored with a resolution of two seconds in zip files
+    date_time = time.localtime(stat.st_mtime)[0:6]
+    date_time = date_time[0:5] + (date_time[5] // 2 * 2,)
+    if not verify_crc and info.date_time == date_time:
+        return False
+    crc = 0
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc != info.CRC
+
+
+def create_zips(dir_list, policy=DEFAULT_POLICY, max_workers=None):
+    """
+    Creates CBZ files for many chapters concurrently in a pool of processes.
+
+    :param dir_list: list of tuples with chapter directory and destination directory
+    :param policy: compression policy for all CBZ files
+    :param max_workers: number of processes, defaults to the number of CPUs
+    :return: list of results of create_zip() in the order of the given directories
+    """
+    if max_workers == 1 or len(dir_list) < 2:
+        return [create_zip(manga_dir, dest_dir, policy) for manga_dir, dest_dir in dir_list]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(create_zip, manga_dir, dest_dir, policy) for manga_dir, dest_dir in dir_list]
+        return [f.result() for f in futures]
+
+
+def bundle_volume(cbz_files, dest_file, comet=None):
+    """
+    Merges the CBZ files of several chapters into a single CBZ file for a
+    whole volume. The compressed data of all entries is copied verbatim from
+    the chapter archives, so that nothing has to be decompressed or
+    compressed again. On Python versions whose zipfile internals were not
+    verified, entries are copied through the public interface instead. All
+    pages are renumbered consecutively in the order of
+    the given chapter files.
+
+    :param cbz_files: list of CBZ files of all chapters in reading order
+    :param dest_file: path of the CBZ file for the volume
+    :param comet: dictionary with metadata for CometGenerator.build_comet()
+                  or None, if no comet.xml should be added
+    :return: number of pages in the volume
+    """
+    logger.debug('Bundling {} CBZ files into {}.'.format(len(cbz_files), dest_file))
+    name = os.path.splitext(os.path.basename(dest_file))[0]
+    temp_file_name = dest_file + '.part'
+    page_count = 0
+    with zipfile.ZipFile(temp_file_name, 'w') as volume_file:
+        copy_raw = _can_copy_raw(volume_file)
+        for cbz_file_name in cbz_files:
+            with open(cbz_file_name, 'rb') as source, zipfile.ZipFile(source) as chapter_file:
+                for info in sorted(chapter_file.infolist(), key=lambda i: i.filename):
+                    if info.is_dir() or os.path.basename(info.filename) == 'comet.xml':
+                        continue
+                    page_count += 1
+                    extension = os.path.splitext(info.filename)[1]
+                    file_in_zipfile = os.path.join(name, '{:04d}{}'.format(page_count, extension))
+                    if copy_raw:
+                        _copy_raw_entry(source, info, volume_file, file_in_zipfile)
+                    else:
+                        _copy_entry(chapter_file, info, volume_file, file_in_zipfile)
+        if comet is not None:
+            volume_file.writestr('comet.xml', CometGenerator.build_comet(pages=page_count, **comet))
+    os.replace(temp_file_name, dest_file)
+    return page_count
+
+
+def _can_copy_raw(dest_zip):
+    """Checks whether the zipfile internals needed by _copy_raw_entry() are known to work."""
+    if not RAW_COPY_VERSIONS[0] <= sys.version_info[:2] < RAW_COPY_VERSIONS[1]:
+        return False
+    return all(hasattr(dest_zip, name) for name in RAW_COPY_ATTRIBUTES) and hasattr(zipfile.ZipInfo, 'FileHeader')
+
+
+def _copy_entry(source_zip, info, dest_zip, file_in_zipfile):
+    """
+    Copies an entry from an open zip file into another zip file under a new
+    name by decompressing and compressing its data again.
+    """
+    new_info = zipfile.ZipInfo(file_in_zipfile, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    new_info.file_size = info.file_size
+    with source_zip.open(info) as source, dest_zip.open(new_info, 'w') as dest:
+        shutil.copyfileobj(source, dest, COPY_BUFFER_SIZE)
+
+
+def _copy_raw_entry(source, info, dest_zip, file_in_zipfile):
+    """
+    Copies the compressed data of an entry from an open zip file into another
+    zip file, that is opened for writing, under a new name.
+    """
+    if info.flag_bits & 0x1:
+        raise zipfile.BadZipFile('Encrypted entry can not be copied: {}'.format(info.filename))
+    # skip local file header of the source entry to find the start of its data
+    source.seek(info.header_offset)
+    header = struct.unpack(LOCAL_HEADER_FORMAT, source.read(struct.calcsize(LOCAL_HEADER_FORMAT)))
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile('Bad local file header for entry: {}'.format(info.filename))
+    source.seek(header[10] + header[11], os.SEEK_CUR)
+    # sizes and CRC are known in advance, so no data descriptor is needed after the data
+    new_info = zipfile.ZipInfo(file_in_zipfile, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    dest = dest_zip.fp
+    new_info.header_offset = dest.tell()
+    dest.write(new_info.FileHeader(zip64))
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.read(min(remaining, COPY_BUFFER_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile('Unexpected end of data for entry: {}'.format(info.filename))
+        dest.write(chunk)
+        remaining -= len(chunk)
+    # register entry, so that it is written into the central directory when closing the zip file
+    dest_zip.filelist.append(new_info)
+    dest_zip.NameToInfo[new_info.filename] = new_info
+    dest_zip.start_dir = dest.tell()
+    dest_zip._didModify = True
+
+
+# -------------------------------------------------------------------------------------------------
+#  ChapterArchive class
+# -------------------------------------------------------------------------------------------------
+class ChapterArchive(object):
+    """
+    Writes downloaded pages of a chapter directly into a CBZ file without
+    storing them as image files first. Entries are written in page order as
+    soon as all previous pages are available. Pages that complete early are
+    held in a small reorder buffer. If the buffer overflows, the page with the
+    lowest number is written nevertheless.
+
+    The archive is written to a temporary file and renamed when it is closed,
+    so that an interrupted download never leaves an incomplete CBZ file.
+    Pages can be given as bytes or copied in chunks from a stream.
+
+    :param manga_dir: chapter directory that would contain the image files
+    :param dest_dir: directory to store the CBZ file in
+    :param page_numbers: numbers of all pages that are expected for this chapter
+    :param max_pending: maximum number of pages held in the reorder buffer
+    :param policy: compression policy for the pages
+    """
+    def __init__(self, manga_dir, dest_dir, page_numbers, max_pending=8, policy=DEFAULT_POLICY):
+        self.name = os.path.basename(os.path.normpath(manga_dir))
+        self.file_name = os.path.join(dest_dir, self.name + '.cbz')
+        self.max_pending = max_pending
+        self.policy = policy
+        self.__expected_pages = sorted(page_numbers)
+        self.__next_index = 0
+        self.__pending = {}
+        self.__lock = threading.Lock()
+        os.makedirs(dest_dir, exist_ok=True)
+        self.__temp_file_name = self.file_name + '.part'
+        self.__zip_file = zipfile.ZipFile(self.__temp_file_name, 'w')
+        logger.debug('Creating CBZ file: {}...'.format(self.file_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_page(self, page_no, file_name, data):
+        """
+        Adds the data of a single page to the archive.
+
+        :param page_no: number of the page inside the chapter
+        :param file_name: name of the page inside the archive, e.g. "001.jpg"
+        :param data: image data as bytes
+        """
+        with self.__lock:
+            self.__pending[page_no] = (file_name, data)
+            self._write_ready_pages()
+
+    def add_page_stream(self, page_no, file_name, stream):
+        """
+        Adds a single page by copying it in chunks from a file-like object,
+        e.g. the raw stream of a response. The page is spooled to a temporary
+        file that stays in memory while it is small, so that a download that
+        fails halfway leaves the archive untouched.
+
+        :return: number of bytes of the page
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            shutil.copyfileobj(stream, spool, COPY_BUFFER_SIZE)
+        except BaseException:
+            spool.close()
+            raise
+        size = spool.tell()
+        spool.seek(0)
+        with self.__lock:
+            self.__pending[page_no] = (file_name, spool)
+            self._write_ready_pages()
+        return size
+
+    def skip_page(self, page_no):
+        """Marks a page as missing, so that following pages are not held back."""
+        with self.__lock:
+            self.__pending[page_no] = None
+            self._write_ready_pages()
+
+    def _write_ready_pages(self):
+        while self.__next_index < len(self.__expected_pages):
+            page_no = self.__expected_pages[self.__next_index]
+            if page_no not in self.__pending:
+                break
+            self._write_page(self.__pending.pop(page_no))
+            self.__next_index += 1
+        if len(self.__pending) > self.max_pending:
+            page_no = min(self.__pending)
+            logger.warning('Reorder buffer for {} is full, writing page {} out of order.'.format(self.name, page_no))
+            self._write_page(self.__pending.pop(page_no))
+            self.__expected_pages.remove(page_no)
+
+    def _write_page(self, page):
+        if page is None:
+            return
+        file_name, data = page
+        logger.debug('add file "{}" to cbz file "{}".'.format(file_name, self.file_name))
+        compress_type, compress_level = self.policy.get_compression(file_name)
+        file_in_zipfile = os.path.join(self.name, file_name)
+        if isinstance(data, bytes):
+            self.__zip_file.writestr(file_in_zipfile, data, compress_type, compress_level)
+            return
+        # entries opened by name are compressed with the defaults of the zip file
+        self.__zip_file.compression = compress_type
+        self.__zip_file.compresslevel = compress_level
+        with data, self.__zip_file.open(file_in_zipfile, 'w') as entry:
+            shutil.copyfileobj(data, entry, COPY_BUFFER_SIZE)
+
+    def close(self):
+        """Writes all remaining pages and moves the finished archive to its final name."""
+        with self.__lock:
+            for page_no in sorted(self.__pending):
+                self._write_page(self.__pending.pop(page_no))
+            self.__zip_file.close()
+            os.replace(self.__temp_file_name, self.file_name)
+
+    def abort(self):
+        """Discards the incomplete archive."""
+        with self.__lock:
+            for page in self.__pending.values():
+                if page is not None and not isinstance(page[1], bytes):
+                    page[1].close()
+            self.__pending.clear()
+            self.__zip_file.close()
+            os.remove(self.__temp_file_name)
+
+
+# -------------------------------------------------------------------------------------------------
+#  ArchiveHandle class
+# -------------------------------------------------------------------------------------------------
+class ArchiveHandle(object):
+    """Open CBZ file of the ArchivePool with the number of threads reading from it."""
+
+    def __init__(self, mtime, zip_file):
+        self.mtime = mtime
+        self.zip_file = zip_file
+        self.users = 0
+        self.retired = False
+
+
+# -------------------------------------------------------------------------------------------------
+#  ArchivePool class
+# -------------------------------------------------------------------------------------------------
+ArchivePage = namedtuple('ArchivePage', ['archive', 'entry'])
+ArchivePage.__doc__ = 'Single page inside a CBZ file given by the path of the file and the name of the entry.'
+
+
+class ArchivePool(object):
+    """
+    Keeps a small number of CBZ files open to read single pages from them.
+    The least recently used file is closed when too many files are open.
+    Files that were changed since they were opened are opened again. Files
+    that are still read by another thread are closed after the last read
+    finished.
+
+    :param max_open: maximum number of open CBZ files
+    """
+    def __init__(self, max_open=8):
+        self.max_open = max_open
+        self.__archives = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def open_archive(self, archive):
+        """Returns a context manager for an open ZipFile object of the given CBZ file."""
+        mtime = os.stat(archive).st_mtime_ns
+        with self.__lock:
+            handle = self.__archives.get(archive)
+            if handle is not None and handle.mtime == mtime:
+                self.__archives.move_to_end(archive)
+            else:
+                if handle is not None:
+                    self.__retire(self.__archives.pop(archive))
+                handle = self.__archives[archive] = ArchiveHandle(mtime, zipfile.ZipFile(archive))
+                while len(self.__archives) > self.max_open:
+                    self.__retire(self.__archives.popitem(last=False)[1])
+            handle.users += 1
+        try:
+            yield handle.zip_file
+        finally:
+            with self.__lock:
+                handle.users -= 1
+                if handle.retired and not handle.users:
+                    handle.zip_file.close()
+
+    @staticmethod
+    def __retire(handle):
+        """Closes a file that was removed from the pool as soon as nobody reads from it anymore."""
+        handle.retired = True
+        if not handle.users:
+            handle.zip_file.close()
+
+    def list_pages(self, archive):
+        """Returns all pages of a CBZ file in sorted order using its central directory."""
+        with self.open_archive(archive) as zip_file:
+            names = zip_file.namelist()
+        return [ArchivePage(archive, name) for name in sorted(names) if is_image_file(name)]
+
+    def read(self, page):
+        """Reads the data of a single page from its CBZ file."""
+        with self.open_archive(page.archive) as zip_file:
+            return zip_file.read(page.entry)
+
+    def close(self):
+        with self.__lock:
+            for handle in self.__archives.values():
+                self.__retire(handle)
+            self.__archives.clear()
+
+
+# shared pool for all readers of CBZ files
+archive_pool = ArchivePool()
 
 
 # -------------------------------------------------------------------------------------------------
 #  <module>
 # -------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
-    print('No test implemented!')
+    import io
+
+    print('testing ChapterArchive.add_page()')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with ChapterArchive(os.path.join(temp_dir, 'Manga 001'), temp_dir, [1, 2, 3, 4]) as archive:
+            archive.add_page(3, '003.jpg', b'3')
+            archive.add_page(1, '001.jpg', b'1')
+            archive.skip_page(2)
+            archive.add_page(4, '004.jpg', b'4')
+        with zipfile.ZipFile(os.path.join(temp_dir, 'Manga 001.cbz')) as cbz_file:
+            assert(cbz_file.namelist() == ['Manga 001/001.jpg', 'Manga 001/003.jpg', 'Manga 001/004.jpg'])
+        large_page = os.urandom(SPOOL_MAX_SIZE * 2)
+        with ChapterArchive(os.path.join(temp_dir, 'Manga 002'), temp_dir, [1, 2],
+                            policy=CompressionPolicy('deflate')) as archive:
+            assert(archive.add_page_stream(2, '002.png', io.BytesIO(b'2' * 1000)) == 1000)
+            assert(archive.add_page_stream(1, '001.jpg', io.BytesIO(large_page)) == len(large_page))
+        with zipfile.ZipFile(os.path.join(temp_dir, 'Manga 002.cbz')) as cbz_file:
+            assert(cbz_file.namelist() == ['Manga 002/001.jpg', 'Manga 002/002.png'])
+            assert(cbz_file.read('Manga 002/001.jpg') == large_page)
+            assert(cbz_file.getinfo('Manga 002/002.png').compress_type == zipfile.ZIP_DEFLATED)
+            assert(cbz_file.getinfo('Manga 002/002.png').compress_size < 1000)
+        archive = ChapterArchive(os.path.join(temp_dir, 'Manga 003'), temp_dir, [1, 2])
+        archive.add_page_stream(2, '002.jpg', io.BytesIO(b'2'))
+        archive.abort()
+        assert(sorted(os.listdir(temp_dir)) == ['Manga 001.cbz', 'Manga 002.cbz'])
+    print('test successful')
+
+    print('######################################################################')
+
+    print('testing create_zip()')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        chapter_dir = os.path.join(temp_dir, 'Manga 001')
+        os.makedirs(chapter_dir)
+        for page in ('002.jpg', '001.jpg'):
+            with open(os.path.join(chapter_dir, page), 'wb') as f:
+                f.write(page.encode())
+        assert(create_zip(chapter_dir, temp_dir))
+        with open(os.path.join(chapter_dir, '003.jpg'), 'wb') as f:
+            f.write(b'003.jpg')
+        assert(_find_missing_pages(os.path.join(temp_dir, 'Manga 001.cbz'), 'Manga 001', chapter_dir,
+                                   ['001.jpg', '002.jpg', '003.jpg'], True) == ['003.jpg'])
+        assert(create_zip(chapter_dir, temp_dir))
+        with zipfile.ZipFile(os.path.join(temp_dir, 'Manga 001.cbz')) as cbz_file:
+            assert(cbz_file.namelist() == ['Manga 001/001.jpg', 'Manga 001/002.jpg', 'Manga 001/003.jpg'])
+        with open(os.path.join(chapter_dir, '002.jpg'), 'wb') as f:
+            f.write(b'changed page')
+        assert(create_zip(chapter_dir, temp_dir))
+        with zipfile.ZipFile(os.path.join(temp_dir, 'Manga 001.cbz')) as cbz_file:
+            assert(cbz_file.read('Manga 001/002.jpg') == b'changed page')
+    print('test successful')
+
+    print('######################################################################')
+
+    print('testing bundle_volume()')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for chapter_no in (1, 2):
+            chapter_dir = os.path.join(temp_dir, 'Manga {:03d}'.format(chapter_no))
+            os.makedirs(chapter_dir)
+            for page_no in (1, 2):
+                with open(os.path.join(chapter_dir, '{:03d}.jpg'.format(page_no)), 'wb') as f:
+                    f.write('chapter {} page {}'.format(chapter_no, page_no).encode() * 100)
+            assert(create_zip(chapter_dir, temp_dir, CompressionPolicy('deflate')))
+        volume_file_name = os.path.join(temp_dir, 'Manga Vol 01.cbz')
+        assert(bundle_volume([os.path.join(temp_dir, 'Manga 001.cbz'), os.path.join(temp_dir, 'Manga 002.cbz')],
+                             volume_file_name, comet={'series': 'Manga', 'volume': 1}) == 4)
+        with zipfile.ZipFile(volume_file_name) as cbz_file:
+            assert(cbz_file.testzip() is None)
+            assert(cbz_file.namelist() == ['Manga Vol 01/0001.jpg', 'Manga Vol 01/0002.jpg',
+                                           'Manga Vol 01/0003.jpg', 'Manga Vol 01/0004.jpg', 'comet.xml'])
+            assert(cbz_file.read('Manga Vol 01/0003.jpg') == b'chapter 2 page 1' * 100)
+        # copy through the public interface like on unknown Python versions, which has to give the same entries
+        raw_copy_versions, RAW_COPY_VERSIONS = RAW_COPY_VERSIONS, ((0, 0), (0, 0))
+        fallback_file_name = os.path.join(temp_dir, 'fallback', 'Manga Vol 01.cbz')
+        os.makedirs(os.path.dirname(fallback_file_name))
+        assert(bundle_volume([os.path.join(temp_dir, 'Manga 001.cbz'), os.path.join(temp_dir, 'Manga 002.cbz')],
+                             fallback_file_name, comet={'series': 'Manga', 'volume': 1}) == 4)
+        RAW_COPY_VERSIONS = raw_copy_versions
+        with zipfile.ZipFile(volume_file_name) as cbz_file, zipfile.ZipFile(fallback_file_name) as fallback_file:
+            assert(fallback_file.testzip() is None)
+            assert(fallback_file.namelist() == cbz_file.namelist())
+            for info, fallback_info in zip(cbz_file.infolist(), fallback_file.infolist()):
+                assert((info.CRC, info.file_size, info.compress_type) ==
+                       (fallback_info.CRC, fallback_info.file_size, fallback_info.compress_type))
+                assert(cbz_file.read(info) == fallback_file.read(fallback_info))
+            assert(fallback_file.getinfo('Manga Vol 01/0002.jpg').compress_type == zipfile.ZIP_DEFLATED)
+        print('test successful')
+
+        print('######################################################################')
+
+        print('testing ArchivePool.read()')
+        pool = ArchivePool(max_open=1)
+        pages = pool.list_pages(volume_file_name)
+        assert(len(pages) == 4)
+        assert(pool.read(pages[1]) == b'chapter 1 page 2' * 100)
+        assert(pool.read(ArchivePage(os.path.join(temp_dir, 'Manga 001.cbz'), 'Manga 001/001.jpg')) ==
+               b'chapter 1 page 1' * 100)
+        # a file that is evicted while it is read is closed after the read
+        with pool.open_archive(volume_file_name) as zip_file:
+            pool.read(ArchivePage(os.path.join(temp_dir, 'Manga 002.cbz'), 'Manga 002/001.jpg'))
+            assert(zip_file.read('Manga Vol 01/0001.jpg') == b'chapter 1 page 1' * 100)
+        assert(zip_file.fp is None)
+        pool.close()
+    print('test successful')
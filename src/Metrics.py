@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('MangaLoader.Metrics')
+
+# upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STAGE_LABELS = ('stage', 'plugin', 'host')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+# -------------------------------------------------------------------------------------------------
+#  Counter class
+# -------------------------------------------------------------------------------------------------
+class Counter(object):
+    """
+    Counter that only increases, with a separate value for every combination
+    of label values.
+
+    :param name: name of the metric
+    :param documentation: help text of the metric
+    :param labelnames: names of all labels of the metric
+    """
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def collect(self):
+        """Returns the lines of this metric in the Prometheus text format."""
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name, _format_labels(self.labelnames, key), value) for key, value in values]
+
+
+# -------------------------------------------------------------------------------------------------
+#  Histogram class
+# -------------------------------------------------------------------------------------------------
+class Histogram(Counter):
+    """
+    Histogram of observed values, e.g. durations in seconds, with cumulative
+    buckets, the sum and the number of all observations.
+
+    :param buckets: upper bounds of all buckets in ascending order
+    """
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get(self, **labels):
+        """Returns the number of observations for the given labels."""
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def collect(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in values:
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, key,
+                                                                              [('le', repr(float(bound)))]),
+                                                     bucket_count))
+            lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, key, [('le', '+Inf')]),
+                                                 count))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labelnames, key), total))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labelnames, key), count))
+        return lines
+
+
+# -------------------------------------------------------------------------------------------------
+#  Registry class
+# -------------------------------------------------------------------------------------------------
+class Registry(object):
+    """Collection of all metrics that are exposed together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.metric_type))
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram('mangaloader_stage_duration_seconds',
+                                            'Duration of fetch, parse, write, postprocess and archive stages.',
+                                            STAGE_LABELS))
+STAGE_ERRORS = REGISTRY.register(Counter('mangaloader_stage_errors_total',
+                                         'Number of stages that failed with an exception.', STAGE_LABELS))
+STAGE_BYTES = REGISTRY.register(Counter('mangaloader_stage_bytes_total',
+                                        'Number of bytes loaded or written by a stage.', STAGE_LABELS))
+
+
+# -------------------------------------------------------------------------------------------------
+#  instrumentation
+# -------------------------------------------------------------------------------------------------
+_context = threading.local()
+
+
+@contextmanager
+def plugin_context(plugin):
+    """Sets the plugin label for all stages measured by this thread inside the context."""
+    previous_plugin = getattr(_context, 'plugin', '')
+    _context.plugin = plugin
+    try:
+        yield
+    finally:
+        _context.plugin = previous_plugin
+
+
+def current_plugin():
+    return getattr(_context, 'plugin', '')
+
+
+@contextmanager
+def measure(stage, plugin=None, host=''):
+    """
+    Measures the duration of a stage and counts it as error, if an exception
+    is raised inside the context.
+
+    :param stage: name of the stage, e.g. 'fetch' or 'write'
+    :param plugin: name of the plugin, by default the plugin of the current context
+    :param host: host the data of the stage is loaded from
+    """
+    labels = {'stage': stage, 'plugin': current_plugin() if plugin is None else plugin, 'host': host}
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(**labels)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start_time, **labels)
+
+
+def add_bytes(stage, size, plugin=None, host=''):
+    STAGE_BYTES.inc(size, stage=stage, plugin=current_plugin() if plugin is None else plugin, host=host)
+
+
+def add_error(stage, plugin=None, host=''):
+    """Counts a failed stage that did not raise an exception, e.g. a HTTP error status."""
+    STAGE_ERRORS.inc(stage=stage, plugin=current_plugin() if plugin is None else plugin, host=host)
+
+
+def instrument(function, stage, plugin=None):
+    """
+    Wraps a function, static method or class method, so that every call is
+    measured as the given stage. If a plugin is given, it is also set as
+    plugin of all stages measured inside the function.
+    """
+    if isinstance(function, (staticmethod, classmethod)):
+        return type(function)(instrument(function.__func__, stage, plugin))
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with plugin_context(current_plugin() if plugin is None else plugin), measure(stage):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+# -------------------------------------------------------------------------------------------------
+#  exposition
+# -------------------------------------------------------------------------------------------------
+def start_http_server(port, address='127.0.0.1', registry=REGISTRY):
+    """
+    Serves all metrics in the Prometheus text format on a local port in a
+    background thread.
+
+    :return: server object, call shutdown() to stop it
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = registry.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug('metrics request: ' + format % args)
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True)
+    thread.start()
+    logger.info('Serving metrics on http://{}:{}/metrics'.format(address, server.server_address[1]))
+    return server
+
+
+def dump(file_name, registry=REGISTRY):
+    """Writes all metrics in the Prometheus text format to a file."""
+    with open(file_name, 'w', encoding='UTF-8') as f:
+        f.write(registry.expose())
+    logger.info('Metrics written to {}.'.format(file_name))
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import urllib.request
+
+    print('testing Registry.expose()')
+    registry = Registry()
+    histogram = registry.register(Histogram('test_seconds', 'Test histogram.', ('stage',), buckets=(0.1, 1.0)))
+    counter = registry.register(Counter('test_total', 'Test counter.', ('host',)))
+    histogram.observe(0.05, stage='fetch')
+    histogram.observe(0.5, stage='fetch')
+    counter.inc(3, host='a"b')
+    text = registry.expose()
+    assert('test_seconds_bucket{stage="fetch",le="0.1"} 1' in text)
+    assert('test_seconds_bucket{stage="fetch",le="+Inf"} 2' in text)
+    assert('test_seconds_count{stage="fetch"} 2' in text)
+    assert('test_total{host="a\\"b"} 3' in text)
+    print('test successful')
+
+    print('testing start_http_server()')
+    with plugin_context('TestPlugin'):
+        with measure('parse'):
+            pass
+    server = start_http_server(0)
+    with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])) as response:
+        assert('stage="parse",plugin="TestPlugin",host=""' in response.read().decode('utf-8'))
+    server.shutdown()
+    print('test successful')
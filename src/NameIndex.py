@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+import re
+import bisect
+import logging
+
+
+logger = logging.getLogger('MangaLoader.NameIndex')
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+# -------------------------------------------------------------------------------------------------
+#  NameIndex class
+# -------------------------------------------------------------------------------------------------
+class NameIndex(object):
+    """
+    Finds names in a large list by prefixes of the words they contain. All
+    words of all names are kept in a sorted list, so that the names for a
+    given word prefix can be found by binary search instead of comparing the
+    search text with every name.
+
+    :param names: list of names, results are given as positions in this list
+    """
+    def __init__(self, names=()):
+        self.words = []
+        self.positions = []
+        self.build(names)
+
+    def build(self, names):
+        entries = sorted((word, position) for position, name in enumerate(names)
+                         for word in set(WORD_PATTERN.findall(name.lower())))
+        self.words = [word for word, _ in entries]
+        self.positions = [position for _, position in entries]
+        logger.debug('Indexed {} words.'.format(len(self.words)))
+
+    def find_prefix(self, prefix):
+        """Returns the set of positions of all names containing a word that starts with the given prefix."""
+        result = set()
+        i = bisect.bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            result.add(self.positions[i])
+            i += 1
+        return result
+
+    def search(self, text):
+        """
+        Returns the positions of all names that contain a word starting with
+        every word of the search text or None, if the search text is empty.
+        """
+        result = None
+        # search the longest prefixes first, because they match the fewest names
+        for prefix in sorted(set(WORD_PATTERN.findall(text.lower())), key=len, reverse=True):
+            matches = self.find_prefix(prefix)
+            result = matches if result is None else result & matches
+            if not result:
+                break
+        return result
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print('testing NameIndex.search()')
+    index = NameIndex(['One Piece', 'One Punch-Man', 'Piece of Cake', 'Berserk'])
+    assert(index.search('one') == {0, 1})
+    assert(index.search('pie on') == {0})
+    assert(index.search('PUN') == {1})
+    assert(index.search('man punch') == {1})
+    assert(index.search('naruto') == set())
+    assert(index.search('  ') is None)
+    print('test successful')
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+import os
+import json
+import logging
+import threading
+
+from src import ImageProcessing
+from src.helper import is_image_file
+
+
+logger = logging.getLogger('MangaLoader.PageFilter')
+
+HASH_INDEX_FILE = '.page_hashes.json'
+# suffix for pages that are skipped, so that they are not recognized as manga pages anymore
+SKIPPED_SUFFIX = '.skipped'
+FILTER_MODES = ('mark', 'skip', 'drop')
+
+
+# -------------------------------------------------------------------------------------------------
+#  HashIndex class
+# -------------------------------------------------------------------------------------------------
+class HashIndex(object):
+    """
+    Stores perceptual hashes of all pages of a manga series in a file inside
+    the manga directory. Hashes are stored as hex strings for every page,
+    grouped by the name of the chapter directory. Chapters of the same manga
+    can be stored from several threads at once.
+
+    :param manga_dir: directory of the manga series
+    """
+    def __init__(self, manga_dir):
+        self.file_name = os.path.join(manga_dir, HASH_INDEX_FILE)
+        self.chapters = {}
+        self.__lock = threading.Lock()
+        try:
+            with open(self.file_name, 'r', encoding='UTF-8') as f:
+                self.chapters = json.load(f)
+        except OSError:
+            logger.debug('No hash index found in {}.'.format(manga_dir))
+        except ValueError:
+            logger.error('Hash index file is corrupt: {}'.format(self.file_name))
+
+    def set_chapter(self, chapter_name, page_hashes):
+        """Stores hashes for all pages of a chapter as dictionary of page name and hash."""
+        hashes = {page: '{:016x}'.format(h) for page, h in page_hashes.items()}
+        with self.__lock:
+            self.chapters[chapter_name] = hashes
+
+    def get_chapter(self, chapter_name):
+        with self.__lock:
+            hashes = dict(self.chapters.get(chapter_name, {}))
+        return {page: int(h, 16) for page, h in hashes.items()}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        with self.__lock:
+            with open(self.file_name, 'w', encoding='UTF-8') as f:
+                json.dump(self.chapters, f, indent=1, sort_keys=True)
+
+
+# -------------------------------------------------------------------------------------------------
+#  PageFilter class
+# -------------------------------------------------------------------------------------------------
+class PageFilter(object):
+    """
+    Finds filler pages of a chapter by their perceptual hash. A page is a
+    filler if it matches a hash from the blocklist (e.g. credit pages of a
+    scanlator or ads) or if it duplicates the previous page.
+
+    :param mode: 'mark' only logs filler pages, 'skip' renames them with the
+                 suffix ".skipped" and 'drop' deletes them
+    :param blocklist_file: text file with one hash as hex string per line
+    :param drop_duplicates: treat pages that duplicate the previous page as filler
+    :param threshold: maximum hamming distance for hashes to match
+    :param method: hash function, 'ahash' or 'dhash'
+    """
+    def __init__(self, mode='mark', blocklist_file=None, drop_duplicates=True, threshold=4, method='dhash'):
+        if mode not in FILTER_MODES:
+            raise ValueError('Unknown filter mode: {}'.format(mode))
+        self.mode = mode
+        self.drop_duplicates = drop_duplicates
+        self.threshold = threshold
+        self.method = method
+        self.blocklist = []
+        if blocklist_file:
+            self.blocklist = self.load_blocklist(blocklist_file)
+
+    @staticmethod
+    def load_blocklist(blocklist_file):
+        blocklist = []
+        with open(blocklist_file, 'r', encoding='UTF-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    blocklist.append(int(line, 16))
+        return blocklist
+
+    def hash_pages(self, chapter_dir, pool=None):
+        """
+        Computes hashes for all pages of a chapter directory. If a pool is
+        given, the pages are hashed in batches by its processes.
+
+        :return: dictionary with page name and hash for all pages
+        """
+        pages = sorted(filter(is_image_file, os.listdir(chapter_dir)))
+        items = [(os.path.join(chapter_dir, p), self.method) for p in pages]
+        if pool:
+            hashes = pool.map(_hash_batch, items)
+        else:
+            hashes = _hash_batch(items)
+        return {page: h for page, h in zip(pages, hashes) if h is not None}
+
+    def find_fillers(self, page_hashes):
+        """
+        Finds all filler pages in a chapter.
+
+        :param page_hashes: dictionary with page name and hash
+        :return: list of page names
+        """
+        fillers = []
+        previous_hash = None
+        for page in sorted(page_hashes):
+            page_hash = page_hashes[page]
+            if any(ImageProcessing.hamming_distance(page_hash, h) <= self.threshold for h in self.blocklist):
+                logger.info('Page {} matches blocklist.'.format(page))
+                fillers.append(page)
+            elif (self.drop_duplicates and previous_hash is not None and
+                  ImageProcessing.hamming_distance(page_hash, previous_hash) <= self.threshold):
+                logger.info('Page {} duplicates previous page.'.format(page))
+                fillers.append(page)
+            previous_hash = page_hash
+        return fillers
+
+    def filter_chapter(self, chapter_dir, hash_index, pool=None):
+        """
+        Hashes all pages of a chapter, stores their hashes in the index and
+        handles filler pages depending on the mode of this filter.
+
+        :return: list of filler pages
+        """
+        page_hashes = self.hash_pages(chapter_dir, pool)
+        hash_index.set_chapter(os.path.basename(os.path.normpath(chapter_dir)), page_hashes)
+        hash_index.save()
+        fillers = self.find_fillers(page_hashes)
+        for page in fillers:
+            file_name = os.path.join(chapter_dir, page)
+            if self.mode == 'skip':
+                os.replace(file_name, file_name + SKIPPED_SUFFIX)
+            elif self.mode == 'drop':
+                os.remove(file_name)
+        return fillers
+
+
+def _hash_batch(batch):
+    """Computes hashes for a batch of (file name, method) tuples and returns None for unreadable files."""
+    result = []
+    for file_name, method in batch:
+        try:
+            result.append(ImageProcessing.image_hash(file_name, method))
+        except OSError as e:
+            logger.warning('Could not compute hash for {}: {}'.format(file_name, e))
+            result.append(None)
+    return result
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    print('testing PageFilter.find_fillers()')
+    page_filter = PageFilter()
+    page_filter.blocklist = [0xff00ff00ff00ff00]
+    fillers = page_filter.find_fillers({'001.jpg': 0x0123456789abcdef, '002.jpg': 0x0123456789abcdee,
+                                        '003.jpg': 0xff00ff00ff00ff01, '004.jpg': 0x1111111111111111})
+    assert(fillers == ['002.jpg', '003.jpg'])
+    print('test successful')
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+
+import os
+import json
+import logging
+import threading
+from os.path import expanduser
+from urllib.parse import urlparse
+
+from src import PluginBase
+from src.MangaZipper import ArchivePage
+from src.SeriesIndex import SeriesIndex
+
+
+logger = logging.getLogger('MangaLoader.Planner')
+
+HOST_STATISTICS_FILE = os.path.join(expanduser('~'), '.MangaLoader', 'throughput.json')
+# throughput that is assumed for hosts without any loaded images
+DEFAULT_BYTES_PER_SECOND = 1024 * 1024
+DEFAULT_SECONDS_PER_REQUEST = 0.5
+# number of images per chapter whose size is requested
+DEFAULT_SAMPLE_SIZE = 3
+
+
+# -------------------------------------------------------------------------------------------------
+#  HostStatistics class
+# -------------------------------------------------------------------------------------------------
+class HostStatistics(object):
+    """
+    Collects the observed throughput of image downloads for every host and
+    stores it in a file, so that the time for later downloads can be
+    estimated. Only the files loaded since the last save are added to the
+    current content of the file, so that several loaders or processes can
+    share it.
+
+    :param file_name: JSON file to store the statistics in
+    """
+    def __init__(self, file_name=HOST_STATISTICS_FILE):
+        self.file_name = file_name
+        self.hosts = self._load(file_name)
+        # files loaded since the last save
+        self.__added = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def _load(file_name):
+        try:
+            with open(file_name, 'r', encoding='UTF-8') as f:
+                return json.load(f)
+        except OSError:
+            logger.debug('No host statistics found.')
+        except ValueError:
+            logger.error('Host statistics file is corrupt: {}'.format(file_name))
+        return {}
+
+    def add(self, url, size, elapsed_time):
+        """Adds a single loaded file with its size in bytes and the time it took to load it."""
+        host = urlparse(url).netloc
+        with self.__lock:
+            for hosts in (self.hosts, self.__added):
+                entry = hosts.setdefault(host, {'bytes': 0, 'seconds': 0.0, 'requests': 0})
+                entry['bytes'] += size
+                entry['seconds'] += elapsed_time
+                entry['requests'] += 1
+
+    def get_bytes_per_second(self, host):
+        """Returns the observed throughput for a host or None, if no files were loaded from it."""
+        entry = self.hosts.get(host)
+        if not entry or entry['seconds'] <= 0:
+            return None
+        return entry['bytes'] / entry['seconds']
+
+    def save(self):
+        """Adds all files loaded since the last save to the statistics in the file."""
+        with self.__lock:
+            if not self.__added:
+                return
+            hosts = self._load(self.file_name)
+            for host, added_entry in self.__added.items():
+                entry = hosts.setdefault(host, {'bytes': 0, 'seconds': 0.0, 'requests': 0})
+                for key in ('bytes', 'seconds', 'requests'):
+                    entry[key] += added_entry[key]
+            temp_file_name = self.file_name + '.tmp'
+            try:
+                os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+                with open(temp_file_name, 'w', encoding='UTF-8') as f:
+                    json.dump(hosts, f, indent=1, sort_keys=True)
+                os.replace(temp_file_name, self.file_name)
+            except OSError as e:
+                logger.warning('Could not save host statistics: {}'.format(e))
+                return
+            self.hosts = hosts
+            self.__added = {}
+
+
+# -------------------------------------------------------------------------------------------------
+#  ChapterPlan class
+# -------------------------------------------------------------------------------------------------
+class ChapterPlan(object):
+    """Estimated costs for loading a single chapter."""
+
+    def __init__(self, chapter):
+        self.chapter = chapter
+        self.page_count = 0
+        self.present_pages = 0
+        self.missing_pages = 0
+        self.page_requests = 0
+        self.page_request_time = 0.0
+        self.estimated_bytes = 0
+        self.sampled_sizes = []
+        self.hosts = set()
+
+
+# -------------------------------------------------------------------------------------------------
+#  Planner class
+# -------------------------------------------------------------------------------------------------
+class Planner(object):
+    """
+    Estimates the number of requests, the amount of data and the time needed
+    to load chapters without loading any image data. Page URLs are resolved by
+    the plugin of the loader (using its cached data where possible), pages in
+    the local image store are counted as present and the size of the missing
+    pages is estimated from the Content-Length of a few sampled images.
+
+    :param loader: Loader object to resolve chapters and pages with
+    :param sample_size: number of images per chapter whose size is requested
+    :param host_statistics: observed throughput of hosts from earlier downloads
+    """
+    def __init__(self, loader, sample_size=DEFAULT_SAMPLE_SIZE, host_statistics=None):
+        self.loader = loader
+        self.sample_size = sample_size
+        self.host_statistics = host_statistics if host_statistics is not None else HostStatistics()
+        self.__request_count = 0
+        self.__request_time = 0.0
+
+    def _count_request(self, response, *args, **kwargs):
+        self.__request_count += 1
+        self.__request_time += response.elapsed.total_seconds()
+
+    @staticmethod
+    def _get_present_pages(series_index, chapter_no):
+        """Returns the numbers of all pages of a chapter that are already in the image store."""
+        position = series_index.seek(chapter_no)
+        if position is None:
+            return set()
+        chapter_entry = series_index.get_chapter(position)
+        if chapter_entry.number != chapter_no:
+            return set()
+        page_numbers = set()
+        for page in chapter_entry.pages:
+            name = page.entry if isinstance(page, ArchivePage) else page
+            stem = os.path.splitext(os.path.basename(name))[0]
+            if stem.isdigit():
+                page_numbers.add(int(stem))
+        return page_numbers
+
+    def _sample_sizes(self, images):
+        """Requests the headers of evenly spaced images and returns their sizes in bytes."""
+        session = PluginBase.get_session()
+        step = max(len(images) // self.sample_size, 1)
+        sizes = []
+        for image in images[::step][:self.sample_size]:
+            try:
+                response = session.head(image.url, allow_redirects=True, timeout=5)
+                length = response.headers.get('content-length', '') if response.ok else ''
+                if not length.isdigit():
+                    # some servers do not answer HEAD requests, only read the headers of a GET request
+                    with session.get(image.url, stream=True, timeout=5) as response:
+                        length = response.headers.get('content-length', '') if response.ok else ''
+            except Exception as e:
+                logger.warning('Could not request size of {}: {}'.format(image.url, e))
+                continue
+            if length.isdigit():
+                sizes.append(int(length))
+        return sizes
+
+    def plan_chapter(self, chapter, series_index):
+        plan = ChapterPlan(chapter)
+        present_pages = self._get_present_pages(series_index, chapter.chapterNo)
+        session = PluginBase.get_session()
+        session.hooks['response'].append(self._count_request)
+        try:
+            self.__request_count, self.__request_time = 0, 0.0
+            if not chapter.image_list:
+                self.loader.resolve_chapter(chapter)
+            plan.page_requests, plan.page_request_time = self.__request_count, self.__request_time
+            missing_images = [i for i in chapter.image_list if i.imageNo not in present_pages and i.url]
+            plan.sampled_sizes = self._sample_sizes(missing_images) if missing_images else []
+        finally:
+            session.hooks['response'].remove(self._count_request)
+        plan.page_count = len(chapter.image_list)
+        plan.present_pages = sum(1 for i in chapter.image_list if i.imageNo in present_pages)
+        plan.missing_pages = len(missing_images)
+        plan.hosts = {urlparse(i.url).netloc for i in missing_images}
+        if plan.sampled_sizes:
+            plan.estimated_bytes = round(sum(plan.sampled_sizes) / len(plan.sampled_sizes) * plan.missing_pages)
+        return plan
+
+    def plan(self, manga, chapters):
+        """
+        Estimates the costs for loading the given chapters of a manga.
+
+        :return: list of ChapterPlan objects
+        """
+        series_index = SeriesIndex.for_directory(self.loader.image_store_manager.get_manga_dir(manga))
+        plans = []
+        for chapter in chapters:
+            logger.info('planning chapter {}'.format(chapter))
+            plans.append(self.plan_chapter(chapter, series_index))
+        return plans
+
+    def estimate_duration(self, plans):
+        """
+        Estimates the time for loading all planned chapters from the observed
+        throughput of the hosts and the time the page requests took now.
+        """
+        duration = 0.0
+        for plan in plans:
+            # page URLs have to be resolved again when loading the chapter
+            duration += plan.page_request_time or plan.page_requests * DEFAULT_SECONDS_PER_REQUEST
+            if not plan.missing_pages:
+                continue
+            rates = [self.host_statistics.get_bytes_per_second(host) for host in plan.hosts]
+            rates = [rate for rate in rates if rate]
+            duration += plan.estimated_bytes / (min(rates) if rates else DEFAULT_BYTES_PER_SECOND)
+        return duration
+
+    def format_report(self, plans):
+        lines = ['{:<30} {:>6} {:>8} {:>8} {:>9} {:>11}'.format('Chapter', 'Pages', 'Present', 'Missing',
+                                                               'Requests', 'Est. size')]
+        for plan in plans:
+            lines.append('{:<30} {:>6} {:>8} {:>8} {:>9} {:>8.1f} MB'.format(
+                str(plan.chapter)[:30], plan.page_count, plan.present_pages, plan.missing_pages,
+                plan.page_requests + plan.missing_pages, plan.estimated_bytes / 1024 / 1024))
+        requests = sum(p.page_requests + p.missing_pages for p in plans)
+        size = sum(p.estimated_bytes for p in plans)
+        known_hosts = all(self.host_statistics.get_bytes_per_second(h) for p in plans for h in p.hosts)
+        lines.append('Total: {} requests, {:.1f} MB, about {:.1f} s{}'.format(
+            requests, size / 1024 / 1024, self.estimate_duration(plans),
+            '' if known_hosts else ' (assuming {:.0f} KB/s for unknown hosts)'.format(DEFAULT_BYTES_PER_SECOND / 1024)))
+        return '\n'.join(lines)
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import tempfile
+
+    print('testing HostStatistics')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        statistics_file = os.path.join(temp_dir, 'throughput.json')
+        host_statistics = HostStatistics(statistics_file)
+        host_statistics.add('http://images.example.com/1.jpg', 300000, 0.5)
+        host_statistics.add('http://images.example.com/2.jpg', 100000, 0.5)
+        host_statistics.save()
+        assert(HostStatistics(statistics_file).get_bytes_per_second('images.example.com') == 400000)
+        assert(host_statistics.get_bytes_per_second('other.example.com') is None)
+        # statistics saved by another loader in the meantime are kept
+        other_statistics = HostStatistics(statistics_file)
+        other_statistics.add('http://images.example.com/3.jpg', 200000, 1.0)
+        host_statistics.add('http://other.example.com/1.jpg', 100000, 1.0)
+        other_statistics.save()
+        host_statistics.save()
+        merged_statistics = HostStatistics(statistics_file)
+        assert(merged_statistics.get_bytes_per_second('images.example.com') == 300000)
+        assert(merged_statistics.get_bytes_per_second('other.example.com') == 100000)
+    print('test successful')
@@ -1,20 +1,47 @@
 #!/usr/bin/python3
 
-import urllib.request, urllib.parse, urllib.error
 import re
 import logging
-import requests
+import threading
 from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+from src import Metrics
+from src import Tracing
 
 
 logger = logging.getLogger('MangaLoader.PluginBase')
 
+# maximum number of connections kept open per host by the shared session
+POOL_MAXSIZE = 16
+POOL_CONNECTIONS = 8
+
+# functions of plugins that are measured as parse stage, including name mangled private functions
+PARSE_FUNCTION_PATTERN = re.compile(r'^_(\w+__)?parse_')
+
+_session = None
+_session_lock = threading.Lock()
+
 
 # -------------------------------------------------------------------------------------------------
 #  PluginBase class
 # -------------------------------------------------------------------------------------------------
 class PluginBase(object):
 
+    # whether postprocess_image() changes the loaded images, it is not called when writing archives directly
+    modifies_images = False
+
+    def __init_subclass__(cls, **kwargs):
+        """Measures the duration of all parse functions of a plugin."""
+        super().__init_subclass__(**kwargs)
+        for name, value in list(vars(cls).items()):
+            if PARSE_FUNCTION_PATTERN.match(name) and (callable(value) or isinstance(value, staticmethod)):
+                setattr(cls, name, Metrics.instrument(value, 'parse', cls.__name__))
+
+    def cache_key(self):
+        """Identifies a plugin in cached results by its class, so that all instances share them."""
+        return type(self).__name__
+
     def load_image_url(self, image):
         """Gets an image URL for a specific manga from a specific chapter. The
         URL is stored in the given Image object.
@@ -177,6 +204,45 @@ class FindTagParser(HTMLParser):
         logger.error('Error while parsing HTML: {}'.format(message))
 
 
+# -------------------------------------------------------------------------------------------------
+#  get_session
+# -------------------------------------------------------------------------------------------------
+def get_session():
+    """
+    Returns the requests session that is shared by all plugins and loaders,
+    so that connections to the same host are reused across requests and
+    threads.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            # requests is imported on first use to keep the start up fast
+            import requests
+            import requests.adapters
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+# -------------------------------------------------------------------------------------------------
+#  parse_html
+# -------------------------------------------------------------------------------------------------
+def parse_html(data, features='html.parser'):
+    """
+    Parses a HTML document with BeautifulSoup. The module bs4 is only imported
+    when the first document is parsed.
+
+    :param data: HTML document as string
+    :param features: parser to be used by BeautifulSoup
+    :return: BeautifulSoup object of the document
+    """
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(data, features)
+
+
 # -------------------------------------------------------------------------------------------------
 #  find_re_in_site
 # -------------------------------------------------------------------------------------------------
@@ -187,6 +253,7 @@ def find_re_in_site(url, regex):
     :param url: site URL to be scanned for matching strings
     :param regex: regular expression to be searched for
     """
+    import urllib.request
     site = urllib.request.urlopen(url)
     content = site.read().decode(site.headers.get_content_charset())
     result_list = re.findall(regex, content)
@@ -215,15 +282,20 @@ def load_url(url, max_try_count=5, evaluate_js=False):
         result = session.body()
         return result
     else:
+        import requests
         headers = {'User-Agent': agent_string}
+        host = urlparse(url).netloc
         try:
             logger.debug('requesting: {}'.format(url))
-            request = requests.get(url)
+            with Metrics.measure('fetch', host=host), Tracing.span('fetch', 'resolve', url=url):
+                request = get_session().get(url)
             if request.status_code == requests.codes.ok:
                 result = request.text
+                Metrics.add_bytes('fetch', len(request.content), host=host)
                 logger.debug('URL successfully loaded.')
             else:
                 result = ''
+                Metrics.add_error('fetch', host=host)
                 logger.warn('URL could not be loaded.')
             return result
         except requests.exceptions.ConnectionError:
@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import logging
+import threading
+from contextlib import nullcontext, contextmanager
+from collections import defaultdict
+
+
+logger = logging.getLogger('MangaLoader.Profiling')
+
+PROFILE_MODES = ('cpu', 'mem')
+DEFAULT_PROFILE_DIR = 'profile'
+# stage of all code that runs outside of any other stage in the main thread
+MAIN_STAGE = 'main'
+# number of frames stored for every memory allocation, more frames make snapshots much slower
+MEM_FRAMES = 1
+# comparing snapshots takes about a second, so only the first calls of every stage are compared
+MEM_SAMPLES = 2
+SUMMARY_LINES = 5
+TOP_ALLOCATIONS = 25
+# since Python 3.12 cProfile uses sys.monitoring, which allows only a single active profiler in the process
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+NULL_STAGE = nullcontext()
+
+_profiler = None
+
+
+# -------------------------------------------------------------------------------------------------
+#  Profiler class
+# -------------------------------------------------------------------------------------------------
+class Profiler(object):
+    """
+    Profiles CPU time with cProfile or memory allocations with tracemalloc
+    separately for every stage of the pipeline, e.g. catalog load or image
+    download.
+
+    In cpu mode every thread has its own profile per stage and entering a
+    stage pauses the profile of the enclosing stage, so that every function
+    call is only counted for the innermost stage. The profiles of all threads
+    are merged and written as <stage>.pstats file. Since Python 3.12 only a
+    single profiler can be active in a process and it records the calls of
+    all threads. Therefore only the main thread switches between the profiles
+    of its stages, and calls of other threads are counted for the stage the
+    main thread is in at that time. Stages entered by other threads are
+    listed in a note of the summary.
+
+    In mem mode the growth of traced memory is counted for all calls of a
+    stage. Snapshots are only taken before and after the first calls of every
+    stage and the differences per source line are accumulated. Allocations of
+    other threads running at the same time are included in these numbers. For
+    every stage the last snapshot is written as <stage>.snapshot file and the
+    top allocations as <stage>-top.txt file.
+
+    :param mode: 'cpu' or 'mem'
+    :param output_dir: directory to write all files to
+    """
+    def __init__(self, mode, output_dir=DEFAULT_PROFILE_DIR):
+        if mode not in PROFILE_MODES:
+            raise ValueError('Unknown profile mode: {}'.format(mode))
+        self.mode = mode
+        self.output_dir = output_dir
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__profiles = defaultdict(list)
+        self.__other_thread_stages = defaultdict(int)
+        self.__sample_counts = defaultdict(int)
+        self.__memory_growth = defaultdict(int)
+        self.__allocations = defaultdict(lambda: defaultdict(int))
+        self.__snapshots = {}
+
+    def start(self):
+        if self.mode == 'cpu':
+            self.__stack().append(self.__get_profile(MAIN_STAGE))
+            self.__stack()[-1].enable()
+        else:
+            import tracemalloc
+            tracemalloc.start(MEM_FRAMES)
+
+    def __stack(self):
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+            self.__local.profiles = {}
+        return self.__local.stack
+
+    def __get_profile(self, name):
+        """Returns the profile of the current thread for a stage."""
+        import cProfile
+        self.__stack()
+        profile = self.__local.profiles.get(name)
+        if profile is None:
+            profile = self.__local.profiles[name] = cProfile.Profile()
+            with self.__lock:
+                self.__profiles[name].append(profile)
+        return profile
+
+    @contextmanager
+    def stage(self, name):
+        if self.mode == 'cpu':
+            with self.__cpu_stage(name):
+                yield
+        else:
+            with self.__mem_stage(name):
+                yield
+
+    @contextmanager
+    def __cpu_stage(self, name):
+        if PROCESS_WIDE_PROFILER and threading.current_thread() is not threading.main_thread():
+            # calls are recorded by the profile of the current stage of the main thread
+            with self.__lock:
+                self.__other_thread_stages[name] += 1
+            yield
+            return
+        stack = self.__stack()
+        profile = self.__get_profile(name)
+        if profile in stack:
+            # calls of a stage inside the same stage are already profiled
+            yield
+            return
+        if stack:
+            stack[-1].disable()
+        stack.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            stack.pop()
+            if stack:
+                stack[-1].enable()
+
+    @contextmanager
+    def __mem_stage(self, name):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            yield
+            return
+        with self.__lock:
+            self.__sample_counts[name] += 1
+            take_sample = self.__sample_counts[name] <= MEM_SAMPLES
+        start_snapshot = tracemalloc.take_snapshot() if take_sample else None
+        start_size = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            growth = tracemalloc.get_traced_memory()[0] - start_size
+            end_snapshot = tracemalloc.take_snapshot() if take_sample else None
+            with self.__lock:
+                self.__memory_growth[name] += growth
+                if take_sample:
+                    allocations = self.__allocations[name]
+                    for statistic in end_snapshot.compare_to(start_snapshot, 'lineno'):
+                        allocations[str(statistic.traceback)] += statistic.size_diff
+                    self.__snapshots[name] = end_snapshot
+
+    @staticmethod
+    def _is_own_allocation(location):
+        """Checks whether an allocation was made by tracemalloc or this module while profiling."""
+        import tracemalloc
+        return location.startswith((tracemalloc.__file__, __file__))
+
+    def finish(self):
+        """
+        Stops profiling, writes all files and returns a short summary of the
+        most expensive functions or allocations of every stage.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.mode == 'cpu':
+            return self.__finish_cpu()
+        return self.__finish_mem()
+
+    def __finish_cpu(self):
+        import pstats
+        for profile in reversed(self.__stack()):
+            profile.disable()
+        self.__stack().clear()
+        lines = []
+        with self.__lock:
+            profiles = dict(self.__profiles)
+            other_thread_stages = dict(self.__other_thread_stages)
+        for name, stage_profiles in sorted(profiles.items()):
+            stats = pstats.Stats(*stage_profiles)
+            file_name = os.path.join(self.output_dir, '{}.pstats'.format(name))
+            stats.dump_stats(file_name)
+            call_count = sum(nc for cc, nc, tt, ct, callers in stats.stats.values())
+            lines.append('{}: {:.3f} s in {} calls -> {}'.format(name, stats.total_tt, call_count, file_name))
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+            for (file, line, function), (cc, nc, tt, ct, callers) in functions[:SUMMARY_LINES]:
+                lines.append('  {:>8.3f} s {:>8.3f} s cum  {}:{}({})'.format(tt, ct, os.path.basename(file), line,
+                                                                          function))
+        if other_thread_stages:
+            lines.append('note: only one profiler can be active since Python 3.12, calls of stages in other threads '
+                         'are counted for the current stage of the main thread: {}'.format(
+                             ', '.join('{} ({} calls)'.format(name, count)
+                                       for name, count in sorted(other_thread_stages.items()))))
+        return '\n'.join(lines)
+
+    def __finish_mem(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            return ''
+        current, peak = tracemalloc.get_traced_memory()
+        with self.__lock:
+            self.__snapshots[MAIN_STAGE] = tracemalloc.take_snapshot()
+            total_statistics = self.__snapshots[MAIN_STAGE].statistics('lineno')
+            self.__allocations[MAIN_STAGE] = {str(s.traceback): s.size for s in total_statistics}
+            self.__memory_growth[MAIN_STAGE] = current
+            self.__sample_counts[MAIN_STAGE] = 1
+            snapshots = dict(self.__snapshots)
+            allocations = {name: dict(a) for name, a in self.__allocations.items()}
+        tracemalloc.stop()
+        lines = ['traced memory: {:.1f} MB current, {:.1f} MB peak'.format(current / 1024 / 1024,
+                                                                         peak / 1024 / 1024)]
+        for name, snapshot in sorted(snapshots.items()):
+            snapshot.dump(os.path.join(self.output_dir, '{}.snapshot'.format(name)))
+            top = sorted(((location, size) for location, size in allocations[name].items()
+                          if not self._is_own_allocation(location)), key=lambda item: abs(item[1]), reverse=True)
+            file_name = os.path.join(self.output_dir, '{}-top.txt'.format(name))
+            with open(file_name, 'w', encoding='UTF-8') as f:
+                for location, size in top[:TOP_ALLOCATIONS]:
+                    f.write('{:>+12.1f} KB  {}\n'.format(size / 1024, location))
+            lines.append('{}: {:+.1f} KB in {} calls -> {}'.format(name, self.__memory_growth[name] / 1024,
+                                                                   self.__sample_counts[name], file_name))
+            for location, size in top[:SUMMARY_LINES]:
+                lines.append('  {:>+10.1f} KB  {}'.format(size / 1024, location))
+        return '\n'.join(lines)
+
+
+# -------------------------------------------------------------------------------------------------
+#  module interface
+# -------------------------------------------------------------------------------------------------
+def start(mode, output_dir=DEFAULT_PROFILE_DIR):
+    """Starts profiling all stages of this process."""
+    global _profiler
+    _profiler = Profiler(mode, output_dir)
+    _profiler.start()
+    logger.info('Profiling {} usage, writing results to {}.'.format(mode, output_dir))
+    return _profiler
+
+
+def stage(name):
+    """
+    Returns a context manager for a stage of the pipeline. While profiling is
+    disabled, a shared context manager is returned that does nothing.
+    """
+    if _profiler is None:
+        return NULL_STAGE
+    return _profiler.stage(name)
+
+
+def finish(stream=None):
+    """Stops profiling, writes all results and prints a summary."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return
+    summary = profiler.finish()
+    print(summary, file=stream or sys.stdout)
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import io
+    import tempfile
+
+    def busy(n):
+        return sum(i * i for i in range(n))
+
+    for mode in PROFILE_MODES:
+        print('testing {} profiling'.format(mode))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            start(mode, temp_dir)
+            with stage('catalog'):
+                data = [str(i) for i in range(20000)]
+                with stage('chapter_parse'):
+                    busy(10000)
+            with stage('image_download'):
+                busy(1000)
+            output = io.StringIO()
+            finish(output)
+            summary = output.getvalue()
+            assert('catalog' in summary and 'chapter_parse' in summary and 'image_download' in summary)
+            extension = '.pstats' if mode == 'cpu' else '.snapshot'
+            assert(os.path.exists(os.path.join(temp_dir, 'catalog' + extension)))
+            assert(os.path.exists(os.path.join(temp_dir, MAIN_STAGE + extension)))
+            assert(stage('catalog') is NULL_STAGE)
+        print('test successful')
+
+    print('testing cpu profiling of other threads')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start('cpu', temp_dir)
+
+        def download():
+            with stage('image_download'):
+                busy(10000)
+
+        with stage('chapter'):
+            thread = threading.Thread(target=download)
+            thread.start()
+            thread.join()
+        output = io.StringIO()
+        finish(output)
+        summary = output.getvalue()
+        import pstats
+        if PROCESS_WIDE_PROFILER:
+            assert('image_download (1 calls)' in summary)
+            stats = pstats.Stats(os.path.join(temp_dir, 'chapter.pstats'))
+        else:
+            assert('note' not in summary)
+            stats = pstats.Stats(os.path.join(temp_dir, 'image_download.pstats'))
+        assert('busy' in [function for file, line, function in stats.stats])
+    print('test successful')
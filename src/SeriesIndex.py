@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+
+import os
+import re
+import bisect
+import logging
+import zipfile
+import threading
+
+from src.helper import is_image_file
+from src.MangaZipper import archive_pool
+
+
+logger = logging.getLogger('MangaLoader.SeriesIndex')
+
+# chapter directories are named "<manga name> <chapter number>"
+CHAPTER_NUMBER_PATTERN = re.compile(r'\s(\d+)$')
+# CBZ files for whole volumes are named "<manga name> Vol <volume number>"
+VOLUME_PATTERN = re.compile(r'\sVol\s\d+$')
+ARCHIVE_EXTENSION = '.cbz'
+
+
+# -------------------------------------------------------------------------------------------------
+#  ChapterEntry class
+# -------------------------------------------------------------------------------------------------
+class ChapterEntry(object):
+    """
+    All pages of a single chapter in the image store. Pages of a chapter
+    directory are given as paths, pages of a CBZ file as ArchivePage objects.
+    """
+
+    def __init__(self, name, number, path, mtime, is_archive=False):
+        self.name = name
+        self.number = number
+        self.path = path
+        self.mtime = mtime
+        self.is_archive = is_archive
+        self.pages = []
+
+    def __str__(self):
+        return self.name
+
+    def scan(self):
+        if self.is_archive:
+            try:
+                self.pages = archive_pool.list_pages(self.path)
+            except (OSError, zipfile.BadZipFile) as e:
+                logger.warning('Could not read CBZ file {}: {}'.format(self.path, e))
+                self.pages = []
+            return
+        with os.scandir(self.path) as entries:
+            self.pages = sorted(e.path for e in entries if e.is_file() and is_image_file(e.name))
+
+
+# -------------------------------------------------------------------------------------------------
+#  SeriesIndex class
+# -------------------------------------------------------------------------------------------------
+class SeriesIndex(object):
+    """
+    Ordered list of all pages of a manga series in the image store. The
+    chapter directories and CBZ files are scanned once and afterwards only
+    rescanned, if their modification time changed. If a chapter exists as
+    directory and as CBZ file, the directory is used. Pages are addressed by their position in
+    the whole series, so that going to the next or previous page or seeking
+    to a chapter does not need any access to the file system. Missing
+    chapters are simply skipped.
+
+    Instances can be shared between threads, e.g. by the viewer and a server
+    for reading manga. Use for_directory() to get the shared instance for a
+    manga directory.
+
+    :param manga_dir: directory containing all chapter directories of a manga
+    """
+    __instances = {}
+    __instances_lock = threading.Lock()
+
+    def __init__(self, manga_dir):
+        self.manga_dir = manga_dir
+        self.chapters = []
+        self.pages = []
+        self.chapter_starts = []
+        self.__mtime = None
+        self.__lock = threading.RLock()
+        self.refresh()
+
+    @classmethod
+    def for_directory(cls, manga_dir):
+        """Returns the shared index for a manga directory and refreshes it."""
+        manga_dir = os.path.abspath(manga_dir)
+        with cls.__instances_lock:
+            index = cls.__instances.get(manga_dir)
+            if index is None:
+                index = cls.__instances[manga_dir] = cls(manga_dir)
+                return index
+        index.refresh()
+        return index
+
+    def __len__(self):
+        return len(self.pages)
+
+    def refresh(self):
+        """
+        Updates the index for changes in the image store. Only chapter
+        directories and CBZ files whose modification time changed are scanned
+        again.
+        """
+        with self.__lock:
+            try:
+                mtime = os.stat(self.manga_dir).st_mtime_ns
+            except OSError:
+                self.chapters, self.pages, self.chapter_starts = [], [], []
+                return
+            changed = mtime != self.__mtime
+            if changed:
+                self.chapters = self._scan_chapters()
+                self.__mtime = mtime
+            for chapter in self.chapters:
+                try:
+                    chapter_mtime = os.stat(chapter.path).st_mtime_ns
+                except OSError:
+                    continue
+                if chapter_mtime != chapter.mtime:
+                    chapter.mtime = chapter_mtime
+                    chapter.scan()
+                    changed = True
+            if changed:
+                self._build_page_list()
+
+    def _scan_chapters(self):
+        known_chapters = {(c.name, c.is_archive): c for c in self.chapters}
+        chapters = {}
+        with os.scandir(self.manga_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                is_archive = name.lower().endswith(ARCHIVE_EXTENSION)
+                if is_archive:
+                    name = name[:-len(ARCHIVE_EXTENSION)]
+                    if VOLUME_PATTERN.search(name) or not entry.is_file():
+                        continue
+                elif not entry.is_dir():
+                    continue
+                match = CHAPTER_NUMBER_PATTERN.search(name)
+                if not match:
+                    continue
+                number = int(match.group(1))
+                if is_archive and number in chapters:
+                    continue
+                chapter = known_chapters.get((name, is_archive))
+                if chapter is None:
+                    chapter = ChapterEntry(name, number, entry.path, None, is_archive)
+                chapters[number] = chapter
+        return sorted(chapters.values(), key=lambda c: c.number)
+
+    def _build_page_list(self):
+        pages = []
+        chapter_starts = []
+        for chapter in self.chapters:
+            chapter_starts.append(len(pages))
+            pages.extend(chapter.pages)
+        self.pages, self.chapter_starts = pages, chapter_starts
+        logger.debug('Indexed {} pages in {} chapters of {}.'.format(len(pages), len(self.chapters),
+                                                                     self.manga_dir))
+
+    def get(self, index):
+        """Returns the page at the given position or None, if there is no such page."""
+        pages = self.pages
+        if 0 <= index < len(pages):
+            return pages[index]
+        return None
+
+    def seek(self, chapter_no, page_no=1):
+        """
+        Returns the position of a page given by chapter and page number. If
+        the chapter is missing, the first page of the following chapter is
+        returned.
+
+        :param chapter_no: number of the chapter
+        :param page_no: number of the page inside the chapter starting with 1
+        :return: position in the series or None, if no such page exists
+        """
+        with self.__lock:
+            numbers = [c.number for c in self.chapters]
+            i = bisect.bisect_left(numbers, chapter_no)
+            # skip chapters without any pages
+            while i < len(self.chapters) and not self.chapters[i].pages:
+                i += 1
+            if i >= len(self.chapters):
+                return None
+            if self.chapters[i].number != chapter_no:
+                page_no = 1
+            if not 1 <= page_no <= len(self.chapters[i].pages):
+                return None
+            return self.chapter_starts[i] + page_no - 1
+
+    def get_chapter(self, index):
+        """Returns the chapter containing the page at the given position."""
+        with self.__lock:
+            if not 0 <= index < len(self.pages):
+                return None
+            return self.chapters[bisect.bisect_right(self.chapter_starts, index) - 1]
+
+    def iter_pages(self, start=0):
+        """Yields all pages starting at the given position."""
+        index = start
+        while True:
+            page = self.get(index)
+            if page is None:
+                return
+            yield page
+            index += 1
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import tempfile
+
+    print('testing SeriesIndex')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for chapter_no, page_count in ((1, 2), (3, 3), (10, 1)):
+            chapter_dir = os.path.join(temp_dir, 'Manga {:03d}'.format(chapter_no))
+            os.makedirs(chapter_dir)
+            for page_no in range(1, page_count + 1):
+                open(os.path.join(chapter_dir, '{:03d}.jpg'.format(page_no)), 'wb').close()
+        open(os.path.join(temp_dir, 'Manga 003', 'notes.txt'), 'wb').close()
+        index = SeriesIndex.for_directory(temp_dir)
+        assert(len(index) == 6)
+        assert(index.seek(2) == 2)
+        assert(index.get(index.seek(3, 3)).endswith(os.path.join('Manga 003', '003.jpg')))
+        assert(index.get_chapter(5).number == 10)
+        assert(index.seek(11) is None)
+        assert(index.get(6) is None)
+        open(os.path.join(temp_dir, 'Manga 010', '002.jpg'), 'wb').close()
+        # force a changed modification time for file systems with coarse timestamps
+        os.utime(os.path.join(temp_dir, 'Manga 010'), ns=(0, 0))
+        assert(len(SeriesIndex.for_directory(temp_dir)) == 7)
+        assert(list(index.iter_pages(5)) == [os.path.join(temp_dir, 'Manga 010', p) for p in ('001.jpg', '002.jpg')])
+    print('test successful')
+
+    print('testing SeriesIndex with CBZ files')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for chapter_no in (1, 2):
+            with zipfile.ZipFile(os.path.join(temp_dir, 'Manga {:03d}.cbz'.format(chapter_no)), 'w') as cbz_file:
+                for page_no in (2, 1):
+                    cbz_file.writestr('Manga {:03d}/{:03d}.jpg'.format(chapter_no, page_no), b'page')
+                cbz_file.writestr('Manga {:03d}/comet.xml'.format(chapter_no), b'')
+        os.makedirs(os.path.join(temp_dir, 'Manga 002'))
+        open(os.path.join(temp_dir, 'Manga 002', '001.jpg'), 'wb').close()
+        open(os.path.join(temp_dir, 'Manga Vol 01.cbz'), 'wb').close()
+        index = SeriesIndex(temp_dir)
+        assert(len(index) == 3)
+        assert(index.get(0).entry == 'Manga 001/001.jpg')
+        assert(archive_pool.read(index.get(1)) == b'page')
+        assert(not index.get_chapter(2).is_archive)
+        archive_pool.close()
+    print('test successful')
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+import io
+import os
+import hashlib
+import logging
+import zipfile
+import threading
+from os.path import expanduser
+from concurrent.futures import ThreadPoolExecutor
+
+from src.helper import is_image_file
+from src.MangaZipper import ArchivePage, archive_pool
+
+# Pillow is imported on first use, because importing it takes a noticeable part of the start up time
+PIL = None
+_pillow_checked = False
+
+
+logger = logging.getLogger('MangaLoader.ThumbnailCache')
+
+DEFAULT_CACHE_DIR = os.path.join(expanduser('~'), '.MangaLoader', 'thumbnails')
+DEFAULT_MAX_CACHE_SIZE = 128 * 1024 * 1024
+DEFAULT_THUMBNAIL_SIZE = (200, 300)
+# after exceeding its maximum size the cache is cleaned up to this ratio of it
+CLEANUP_RATIO = 0.8
+
+
+def pillow_available():
+    """Imports Pillow on first use and checks whether it is available for generating thumbnails."""
+    global PIL, _pillow_checked
+    if not _pillow_checked:
+        _pillow_checked = True
+        try:
+            import PIL.Image
+        except ImportError:
+            PIL = None
+    return PIL is not None
+
+
+# -------------------------------------------------------------------------------------------------
+#  ThumbnailCache class
+# -------------------------------------------------------------------------------------------------
+class ThumbnailCache(object):
+    """
+    Creates small previews of manga pages and stores them in a size-bounded
+    directory. Thumbnails are keyed by path, modification time and size of
+    the page, so that changed pages get a new thumbnail automatically. Pages
+    inside of CBZ files are given as ArchivePage objects and keyed by the
+    archive. When the cache grows too large, the least recently used
+    thumbnails are deleted. Thumbnails can be generated in background threads.
+
+    :param cache_dir: directory to store thumbnails in
+    :param max_size: maximum size of all thumbnails in bytes
+    :param thumbnail_size: maximum width and height of thumbnails
+    :param max_workers: number of threads generating thumbnails
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_CACHE_SIZE,
+                 thumbnail_size=DEFAULT_THUMBNAIL_SIZE, max_workers=2):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.thumbnail_size = thumbnail_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.current_size = sum(e.stat().st_size for e in os.scandir(cache_dir) if e.is_file())
+
+    def get_cache_path(self, path):
+        """Returns the path of the thumbnail for a given page."""
+        if isinstance(path, ArchivePage):
+            stat = os.stat(path.archive)
+            name = '{}\0{}'.format(os.path.abspath(path.archive), path.entry)
+        else:
+            stat = os.stat(path)
+            name = os.path.abspath(path)
+        key = '{}\0{}\0{}\0{}x{}'.format(name, stat.st_mtime_ns, stat.st_size, *self.thumbnail_size)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jpg')
+
+    def get_cached(self, path):
+        """
+        Returns the thumbnail for a given page if it is already in the cache,
+        otherwise None.
+        """
+        try:
+            cache_path = self.get_cache_path(path)
+            # update modification time to keep recently used thumbnails in the cache
+            os.utime(cache_path)
+            return cache_path
+        except OSError:
+            return None
+
+    def get_thumbnail(self, path):
+        """
+        Returns the thumbnail for a given page and generates it first, if it is
+        not in the cache.
+
+        :return: path of the thumbnail or None, if no thumbnail could be generated
+        """
+        cache_path = self.get_cached(path)
+        if cache_path:
+            return cache_path
+        if not pillow_available():
+            logger.debug('Pillow not available, no thumbnails are generated.')
+            return None
+        try:
+            return self._generate(path)
+        except (OSError, zipfile.BadZipFile, KeyError) as e:
+            logger.warning('Could not generate thumbnail for {}: {}'.format(path, e))
+            return None
+
+    def _generate(self, path):
+        cache_path = self.get_cache_path(path)
+        source = io.BytesIO(archive_pool.read(path)) if isinstance(path, ArchivePage) else path
+        with PIL.Image.open(source) as image:
+            # let the decoder reduce large JPEG files while loading instead of decoding them fully
+            image.draft('RGB', self.thumbnail_size)
+            image.thumbnail(self.thumbnail_size)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            temp_path = '{}.{}.part'.format(cache_path, threading.get_ident())
+            image.save(temp_path, format='JPEG', quality=85)
+        os.replace(temp_path, cache_path)
+        with self.__lock:
+            self.current_size += os.path.getsize(cache_path)
+            if self.current_size > self.max_size:
+                self._cleanup()
+        return cache_path
+
+    def _cleanup(self):
+        """Deletes least recently used thumbnails until the cache is small enough again."""
+        entries = sorted((e for e in os.scandir(self.cache_dir) if e.is_file()), key=lambda e: e.stat().st_mtime)
+        self.current_size = sum(e.stat().st_size for e in entries)
+        for entry in entries:
+            if self.current_size <= self.max_size * CLEANUP_RATIO:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.current_size -= size
+            except OSError:
+                pass
+        logger.debug('Cleaned up thumbnail cache to {} bytes.'.format(self.current_size))
+
+    def request(self, path, callback):
+        """
+        Generates the thumbnail for a given page in a background thread. The
+        callback is called with the path of the page and the path of the
+        thumbnail from the background thread.
+        """
+        def generate():
+            callback(path, self.get_thumbnail(path))
+        return self.executor.submit(generate)
+
+    @staticmethod
+    def find_first_page(chapter_dir):
+        """Returns the path of the first page in a chapter directory or None."""
+        try:
+            pages = sorted(filter(is_image_file, os.listdir(chapter_dir)))
+        except OSError:
+            return None
+        return os.path.join(chapter_dir, pages[0]) if pages else None
+
+    def request_chapter(self, chapter_dir, callback):
+        """Generates the thumbnail for the first page of a chapter in a background thread."""
+        first_page = self.find_first_page(chapter_dir)
+        if first_page is None:
+            return None
+        return self.request(first_page, callback)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import tempfile
+    pillow_available()
+
+    print('testing ThumbnailCache.get_thumbnail()')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        chapter_dir = os.path.join(temp_dir, 'Manga 001')
+        os.makedirs(chapter_dir)
+        for i in range(1, 4):
+            PIL.Image.new('RGB', (800, 1200), (i * 50, 0, 0)).save(os.path.join(chapter_dir, '{:03d}.jpg'.format(i)))
+        cache = ThumbnailCache(os.path.join(temp_dir, 'cache'), max_size=3000)
+        thumbnail = cache.get_thumbnail(ThumbnailCache.find_first_page(chapter_dir))
+        with PIL.Image.open(thumbnail) as image:
+            assert(image.size == (200, 300))
+        assert(cache.get_cached(os.path.join(chapter_dir, '001.jpg')) == thumbnail)
+        for i in range(2, 4):
+            cache.request(os.path.join(chapter_dir, '{:03d}.jpg'.format(i)), lambda *args: None).result()
+        assert(cache.current_size <= 3000)
+        archive = os.path.join(temp_dir, 'Manga 002.cbz')
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.write(os.path.join(chapter_dir, '001.jpg'), '001.jpg')
+        page = archive_pool.list_pages(archive)[0]
+        assert(cache.get_cache_path(page) != thumbnail)
+        with PIL.Image.open(cache.get_thumbnail(page)) as image:
+            assert(image.size == (200, 300))
+        cache.shutdown()
+        archive_pool.close()
+    print('test successful')
@@ -20,8 +20,16 @@ class Manga(object):
     def __str__(self):
         return str(self.name)
 
+    def cache_key(self):
+        return self.name, self.url
+
     def add_chapter(self, chapter):
+        """Adds a chapter to this manga. A chapter with the same number is replaced."""
         chapter.manga = self
+        for i, existing_chapter in enumerate(self.chapter_list):
+            if existing_chapter.chapterNo == chapter.chapterNo:
+                self.chapter_list[i] = chapter
+                return
         self.chapter_list.append(chapter)
 
     def get_chapter(self, number):
@@ -58,8 +66,25 @@ class Chapter(object):
         else:
             return str(self.chapterNo)
 
+    def cache_key(self):
+        return str(self.manga) if self.manga is not None else '', self.chapterNo, self.url
+
+    def copy(self, manga):
+        """Returns a copy of this chapter without its images for the given manga."""
+        chapter = Chapter(manga, self.chapterNo)
+        chapter.chapterTitle = self.chapterTitle
+        chapter.url = self.url
+        chapter.text = self.text
+        chapter.title = self.title
+        return chapter
+
     def add_image(self, image):
+        """Adds an image to this chapter. An image with the same number is replaced."""
         image.chapter = self
+        for i, existing_image in enumerate(self.image_list):
+            if existing_image.imageNo == image.imageNo:
+                self.image_list[i] = image
+                return
         self.image_list.append(image)
 
     def get_image(self, number):
@@ -91,3 +116,12 @@ class Image(object):
             return str(self.chapter) + ' - ' + str(self.imageNo)
         else:
             return str(self.imageNo)
+
+    def cache_key(self):
+        return self.chapter.cache_key() if self.chapter is not None else None, self.imageNo
+
+    def copy(self, chapter):
+        """Returns a copy of this image for the given chapter."""
+        image = Image(chapter, self.imageNo)
+        image.url = self.url
+        return image
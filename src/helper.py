@@ -1,41 +1,256 @@
 
-import collections
+import os
+import time
+import atexit
+import pickle
+import logging
+import threading
+import weakref
 import functools
+from collections import OrderedDict, namedtuple
 
 
-class memoized(object):
+logger = logging.getLogger('MangaLoader.helper')
+
+# file extensions of all image formats that are stored as manga pages
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+# default number of results kept by a cached function
+DEFAULT_CACHE_SIZE = 128
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'currsize', 'maxsize'])
+
+
+def _is_persistent(key):
+    """Checks whether a key can be saved, keys with weak references are only valid in this process."""
+    if isinstance(key, weakref.ref):
+        return False
+    if isinstance(key, tuple):
+        return all(_is_persistent(k) for k in key)
+    return True
+
+
+def cache_key(value):
     """
-    Caches a function's return value each time it is called. If called later
-    with the same arguments, the cached value is returned (not reevaluated).
+    Returns a hashable key for a value. Objects that define a cache_key()
+    method are identified by their content instead of their identity, so that
+    e.g. two Manga objects loaded from the same catalog share their results
+    and the keys stay valid when the cache is persisted. Other objects that
+    are compared by identity are referenced weakly, so that cached results do
+    not keep them alive.
+    """
+    key_function = getattr(value, 'cache_key', None)
+    if key_function is not None and not isinstance(value, type):
+        return type(value).__name__, key_function()
+    if type(value).__hash__ is object.__hash__ and type(value).__eq__ is object.__eq__:
+        try:
+            return weakref.ref(value)
+        except TypeError:
+            return value
+    if isinstance(value, (list, tuple)):
+        return tuple(cache_key(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, cache_key(v)) for k, v in value.items()))
+    return value
 
-    Source: https://wiki.python.org/moin/PythonDecoratorLibrary
+
+# -------------------------------------------------------------------------------------------------
+#  CachedFunction class
+# -------------------------------------------------------------------------------------------------
+class CachedFunction(object):
     """
-    def __init__(self, func):
+    Caches the return values of a function by its arguments. The cache holds
+    at most maxsize results and drops the least recently used result first.
+    Results older than ttl seconds are computed again. Calls with arguments
+    that can not be hashed are not cached. Arguments are turned into keys by
+    cache_key(), so results for objects compared by identity do not keep
+    them alive, but stay in the cache until they are dropped as least
+    recently used or expire. These results are not saved to the cache file.
+
+    The cache can be used by several threads at once. When several threads
+    call the function with the same arguments, only the first one computes
+    the result and all others wait for it.
+
+    :param func: function to cache
+    :param maxsize: maximum number of cached results, None for unlimited
+    :param ttl: seconds until a cached result expires, None for never
+    :param file_name: file to load cached results from, all results are saved
+                      to it when the program exits or save() is called
+    """
+    def __init__(self, func, maxsize=DEFAULT_CACHE_SIZE, ttl=None, file_name=None):
+        functools.update_wrapper(self, func)
         self.func = func
-        self.cache = {}
-
-    def __call__(self, *args):
-        if not isinstance(args, collections.Hashable):
-            # not able to cache, a list, for instance.
-            # better to not cache than blow up.
-            return self.func(*args)
-        if args in self.cache:
-            return self.cache[args]
-        else:
-            value = self.func(*args)
-            self.cache[args] = value
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.file_name = file_name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__key_locks = {}
+        self.__bound_functions = weakref.WeakKeyDictionary()
+        if file_name:
+            self.load()
+            atexit.register(self.save)
+
+    def __get__(self, obj, objtype=None):
+        """
+        Binds the cache to an instance. The bound function is created once per
+        instance and kept outside of it, so that instances can still be pickled.
+        """
+        if obj is None:
+            return self
+        try:
+            bound = self.__bound_functions.get(obj)
+            if bound is None:
+                bound = self.__bound_functions[obj] = BoundCachedFunction(self, weakref.ref(obj))
+            return bound
+        except TypeError:
+            # instances that can not be referenced weakly or hashed
+            return BoundCachedFunction(self, lambda: obj)
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key = self.make_key(args, kwargs)
+            hash(key)
+        except TypeError:
+            return self.func(*args, **kwargs)
+        found, value = self.__lookup(key, count_miss=False)
+        if found:
             return value
+        with self.__lock:
+            key_lock = self.__key_locks.get(key)
+            if key_lock is None:
+                key_lock = self.__key_locks[key] = [threading.RLock(), 0]
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                # another thread may have computed the result while waiting
+                found, value = self.__lookup(key, count_miss=True)
+                if found:
+                    return value
+                value = self.func(*args, **kwargs)
+                self.__store(key, value)
+                return value
+        finally:
+            with self.__lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self.__key_locks[key]
+
+    @staticmethod
+    def make_key(args, kwargs):
+        if kwargs:
+            return cache_key(args), cache_key(kwargs)
+        return cache_key(args)
+
+    def __lookup(self, key, count_miss):
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self.__cache.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self.__cache[key]
+            if count_miss:
+                self.misses += 1
+            return False, None
+
+    def __store(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.__lock:
+            self.__cache[key] = (value, expires)
+            self.__cache.move_to_end(key)
+            while self.maxsize is not None and len(self.__cache) > self.maxsize:
+                self.__cache.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *args, **kwargs):
+        """Removes the cached result for the given arguments."""
+        with self.__lock:
+            return self.__cache.pop(self.make_key(args, kwargs), None) is not None
+
+    def cache_clear(self):
+        with self.__lock:
+            self.__cache.clear()
+
+    def cache_info(self):
+        with self.__lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, len(self.__cache), self.maxsize)
+
+    def load(self):
+        try:
+            with open(self.file_name, 'rb') as f:
+                entries = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            logger.warning('Could not load cache file {}: {}'.format(self.file_name, e))
+            return
+        now = time.time()
+        with self.__lock:
+            for key, (value, expires) in entries:
+                if expires is None or expires > now:
+                    self.__cache[key] = (value, expires)
+        logger.debug('Loaded {} cached results from {}.'.format(len(self.__cache), self.file_name))
+
+    def save(self):
+        with self.__lock:
+            entries = [(key, entry) for key, entry in self.__cache.items() if _is_persistent(key)]
+        try:
+            with open(self.file_name, 'wb') as f:
+                pickle.dump(entries, f)
+        except (OSError, pickle.PicklingError, RecursionError) as e:
+            logger.warning('Could not save cache file {}: {}'.format(self.file_name, e))
 
     def __repr__(self):
-        """Return the function's docstring."""
-        return self.func.__doc__
+        return '<cached function {}>'.format(self.__qualname__)
+
+
+# -------------------------------------------------------------------------------------------------
+#  BoundCachedFunction class
+# -------------------------------------------------------------------------------------------------
+class BoundCachedFunction(object):
+    """
+    Cached method bound to an instance, which shares the cache of its class.
+    The instance is referenced by a function that returns it, so that the
+    bound function does not keep it alive.
+    """
+    __slots__ = ('cached_function', 'get_obj')
+
+    def __init__(self, cached_function, get_obj):
+        self.cached_function = cached_function
+        self.get_obj = get_obj
 
-    def __get__(self, obj, objtype):
-        """Support instance methods."""
-        return functools.partial(self.__call__, obj)
+    def __call__(self, *args, **kwargs):
+        return self.cached_function(self.get_obj(), *args, **kwargs)
 
+    def invalidate(self, *args, **kwargs):
+        return self.cached_function.invalidate(self.get_obj(), *args, **kwargs)
 
-@memoized
+    def __getattr__(self, name):
+        return getattr(self.cached_function, name)
+
+
+def cached(func=None, maxsize=DEFAULT_CACHE_SIZE, ttl=None, file_name=None):
+    """
+    Decorator that caches the return values of a function or method, either
+    used as @cached or with parameters as @cached(maxsize=16, ttl=600). See
+    CachedFunction for all parameters.
+    """
+    if func is None:
+        return lambda f: CachedFunction(f, maxsize, ttl, file_name)
+    return CachedFunction(func, maxsize, ttl, file_name)
+
+
+# kept for plugins written against the old unbounded decorator
+memoized = cached
+
+
+@cached
 def module_exists(module_name):
     """
     Checks whether a module defined by its name can be imported.
@@ -46,3 +261,106 @@ def module_exists(module_name):
         return False
     else:
         return True
+
+
+def is_image_file(file_name):
+    """
+    Checks whether a file is a manga page by its extension.
+    """
+    return os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS
+
+
+# -------------------------------------------------------------------------------------------------
+#  <module>
+# -------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import tempfile
+
+    print('testing cached()')
+    calls = []
+
+    @cached(maxsize=2)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert(square(2) == 4 and square(2) == 4 and calls == [2])
+    square(3)
+    square(4)
+    assert(square.cache_info() == CacheInfo(hits=1, misses=3, evictions=1, currsize=2, maxsize=2))
+    square(2)
+    assert(calls == [2, 3, 4, 2])
+    assert(square.invalidate(2) and not square.invalidate(2))
+
+    @cached
+    def length(values):
+        return len(values)
+
+    # sets can not be hashed and are passed without caching
+    assert(length({1, 2}) == 2 and length.cache_info().currsize == 0)
+
+    @cached(ttl=0.05)
+    def now():
+        return time.monotonic()
+
+    first = now()
+    assert(now() == first)
+    time.sleep(0.06)
+    assert(now() != first)
+
+    class Value(object):
+        def __init__(self, name):
+            self.name = name
+
+        def cache_key(self):
+            return self.name
+
+    class Plain(object):
+        def __init__(self, name):
+            self.name = name
+
+    class Loader(object):
+        @cached
+        def load(self, value):
+            calls.append(value.name)
+            return value.name.upper()
+
+    loader = Loader()
+    assert(loader.load is loader.load)
+    # neither binding nor calling a method must keep its instance or arguments without cache_key() alive
+    unused_loader = Loader()
+    unused_loader.load
+    unused_loader = weakref.ref(unused_loader)
+    assert(unused_loader() is None)
+    unused_loader, unused_value = Loader(), Plain('b')
+    assert(unused_loader.load(unused_value) == 'B' and unused_loader.load(unused_value) == 'B')
+    assert(calls.count('b') == 1)
+    unused_loader, unused_value = weakref.ref(unused_loader), weakref.ref(unused_value)
+    assert(unused_loader() is None and unused_value() is None)
+    del calls[:]
+    assert(loader.load(Value('a')) == 'A' and loader.load(Value('a')) == 'A' and calls == ['a'])
+
+    @cached
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.05)
+        return x
+
+    del calls[:]
+    threads = [threading.Thread(target=slow, args=(1,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(calls == [1] and slow.cache_info().hits == 7)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_file = os.path.join(temp_dir, 'cache.pickle')
+        stored = CachedFunction(lambda x: x + 1, file_name=cache_file)
+        stored(1)
+        stored.save()
+        restored = CachedFunction(lambda x: 0, file_name=cache_file)
+        assert(restored(1) == 2)
+        atexit.unregister(stored.save)
+        atexit.unregister(restored.save)
+    print('test successful')
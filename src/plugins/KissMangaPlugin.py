@@ -5,7 +5,6 @@ import logging
 import src.PluginBase as PluginBase
 from src.PluginBase import find_re_in_site
 from src.data import Manga, Chapter
-from src.helper import memoized
 
 
 logger = logging.getLogger('MangaLoader.KissMangaPlugin')
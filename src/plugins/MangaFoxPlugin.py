@@ -3,17 +3,19 @@
 import logging
 import urllib
 
-from bs4 import BeautifulSoup
-
 import src.PluginBase as PluginBase
+from src import ImageProcessing
 from src.data import Manga, Chapter, Image
-from src.helper import memoized
+from src.helper import cached
 
 
 logger = logging.getLogger('MangaLoader.MangaFoxPlugin')
 
 BASE_URL = 'http://mangafox.me/'
 MANGA_LIST_URL = BASE_URL + 'manga/'
+# seconds until a loaded catalog or chapter list is loaded again, image lists of a chapter do not change
+MANGA_LIST_TTL = 60 * 60
+CHAPTER_LIST_TTL = 10 * 60
 
 
 # -------------------------------------------------------------------------------------------------
@@ -21,17 +23,20 @@ MANGA_LIST_URL = BASE_URL + 'manga/'
 # -------------------------------------------------------------------------------------------------
 class MangaFoxPlugin(PluginBase.PluginBase):
 
+    # images are cropped to remove ads
+    modifies_images = True
+
     def __init__(self):
         pass
 
-    @memoized
+    @cached(maxsize=1, ttl=MANGA_LIST_TTL)
     def load_manga_list(self):
         loaded_manga_list = PluginBase.load_url(MANGA_LIST_URL)
         return self._parse_manga_list(loaded_manga_list)
     
     @staticmethod
     def _parse_manga_list(data):
-        doc = BeautifulSoup(data, 'html.parser')
+        doc = PluginBase.parse_html(data)
         list_of_mangas = []
         for div in doc.find_all('div', class_='manga_list'):
             for li in div.find_all('li'):
@@ -44,17 +49,21 @@ class MangaFoxPlugin(PluginBase.PluginBase):
                         list_of_mangas.append(manga)
         return list_of_mangas
     
-    @memoized
     def load_chapter_list(self, manga):
-        response = PluginBase.load_url(manga.url)
-        chapter_list = self._parse_chapter_list(manga, response)
+        # cached chapters are shared by all calls, so every manga gets its own copies
+        chapter_list = [c.copy(manga) for c in self._load_chapter_list(manga)]
         for chapter in chapter_list:
             manga.add_chapter(chapter)
         return chapter_list
+
+    @cached(maxsize=256, ttl=CHAPTER_LIST_TTL)
+    def _load_chapter_list(self, manga):
+        # chapters are cached without their manga, which is only used for creating copies of them
+        return self._parse_chapter_list(None, PluginBase.load_url(manga.url))
     
     @staticmethod
     def _parse_chapter_list(manga, data):
-        doc = BeautifulSoup(data, 'html.parser')
+        doc = PluginBase.parse_html(data)
         list_of_chapters = []
         for div in doc.find_all('div', id='chapters'):
             for ul in div.find_all('ul', class_='chlist'):
@@ -74,18 +83,24 @@ class MangaFoxPlugin(PluginBase.PluginBase):
                         list_of_chapters.append(chapter)
         return list_of_chapters
     
-    @memoized
     def load_images_for_chapter(self, chapter):
-        response = PluginBase.load_url(chapter.url)
-        image_list = self._parse_image_list(chapter, response)
+        image_list = [i.copy(chapter) for i in self._load_image_list(chapter)]
         for image in image_list:
             chapter.add_image(image)
         return image_list
+
+    @cached(maxsize=64)
+    def _load_image_list(self, chapter):
+        image_list = self._parse_image_list(chapter, PluginBase.load_url(chapter.url))
+        # images are cached without their chapter, which is only used for creating copies of them
+        for image in image_list:
+            image.chapter = None
+        return image_list
     
     def _parse_image_list(self, chapter, data):
         result = []
         options = []
-        doc = BeautifulSoup(data, 'html.parser')
+        doc = PluginBase.parse_html(data)
         div = doc.find('div', class_='r m')
         select = div.find('select', class_='m')
         for option in select.find_all():
@@ -101,9 +116,9 @@ class MangaFoxPlugin(PluginBase.PluginBase):
                 result.append(image)
         return result
     
-    @memoized
     def load_image_url(self, image):
-        list_of_images = self.load_images_for_chapter(image.chapter)
+        # only look up the URL, the images of the chapter are not replaced by the cached ones
+        list_of_images = self._load_image_list(image.chapter)
         for i in list_of_images:
             if i.imageNo == image.imageNo:
                 image.url = i.url
@@ -113,7 +128,7 @@ class MangaFoxPlugin(PluginBase.PluginBase):
     @staticmethod
     def _parse_image_page(page_url):
         data = PluginBase.load_url(page_url)
-        doc = BeautifulSoup(data, 'html.parser')
+        doc = PluginBase.parse_html(data)
         outer_div = doc.find('div', id='viewer')
         inner_div = outer_div.find('div', class_='read_img')
         img = inner_div.find('img', id='image')
@@ -121,9 +136,7 @@ class MangaFoxPlugin(PluginBase.PluginBase):
 
     def postprocess_image(self, filename):
         logger.debug('Cropping image file to delete ads.')
-        # image = PIL.Image.open(filename)
-        # w, h = image.size
-        # image.crop((0, 0, w, h-30)).save(filename)
+        return ImageProcessing.crop_bands(filename)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -3,11 +3,9 @@
 import logging
 import urllib.parse
 
-from bs4 import BeautifulSoup
-
 import src.PluginBase as PluginBase
 from src.data import Manga, Chapter, Image
-from src.helper import memoized
+from src.helper import cached
 from src.PluginBase import load_url
 
 
@@ -15,6 +13,9 @@ logger = logging.getLogger('MangaLoader.MangaParkPlugin')
 
 BASE_URL = 'http://mangapark.me/'
 MANGA_LIST_URL = BASE_URL + 'genre/'
+# seconds until a loaded catalog or chapter list is loaded again, image lists of a chapter do not change
+MANGA_LIST_TTL = 60 * 60
+CHAPTER_LIST_TTL = 10 * 60
 
 
 # -------------------------------------------------------------------------------------------------
@@ -27,14 +28,14 @@ class MangaParkPlugin(PluginBase.PluginBase):
         self.__list_of_found_chapter_URLs = {}
         self.__last_found_image_URL = ''
 
-    @memoized
+    @cached(maxsize=1, ttl=MANGA_LIST_TTL)
     def load_manga_list(self):
         response = load_url(MANGA_LIST_URL)
         return self._parse_manga_list(response)
     
     @staticmethod
     def _parse_manga_list(data):
-        doc = BeautifulSoup(data, 'html.parser')
+        doc = PluginBase.parse_html(data)
         result = []
         for div in doc.find_all('div', class_='item'):
             for a in div.find_all('a', class_='cover'):
@@ -44,17 +45,21 @@ class MangaParkPlugin(PluginBase.PluginBase):
                 result.append(manga)
         return result
     
-    @memoized
     def load_chapter_list(self, manga):
-        response = load_url(manga.url)
-        chapter_list = self._parse_chapter_list(manga, response)
+        # cached chapters are shared by all calls, so every manga gets its own copies
+        chapter_list = [c.copy(manga) for c in self._load_chapter_list(manga)]
         for chapter in chapter_list:
             manga.add_chapter(chapter)
         return chapter_list
+
+    @cached(maxsize=256, ttl=CHAPTER_LIST_TTL)
+    def _load_chapter_list(self, manga):
+        # chapters are cached without their manga, which is only used for creating copies of them
+        return self._parse_chapter_list(None, load_url(manga.url))
     
     @staticmethod
     def _parse_chapter_list(manga, data):
-        doc = BeautifulSoup(data, 'html.parser')
+        doc = PluginBase.parse_html(data)
         result = []
         for div in doc.find_all('div', id='list'):
             for span in div.find_all('span'):
@@ -76,23 +81,30 @@ class MangaParkPlugin(PluginBase.PluginBase):
         return result
 
     def load_image_url(self, image):
-        list_of_images = self.load_images_for_chapter(image.chapter)
+        # only look up the URL, the images of the chapter are not replaced by the cached ones
+        list_of_images = self._load_image_list(image.chapter)
         for i in list_of_images:
             if i.imageNo == image.imageNo:
                 image.url = i.url
                 return True
         return False
 
-    @memoized
     def load_images_for_chapter(self, chapter):
-        response = load_url(chapter.url)
-        image_list = self._parse_image_list(chapter, response)
+        image_list = [i.copy(chapter) for i in self._load_image_list(chapter)]
         for image in image_list:
             chapter.add_image(image)
         return image_list
+
+    @cached(maxsize=64)
+    def _load_image_list(self, chapter):
+        image_list = self._parse_image_list(chapter, load_url(chapter.url))
+        # images are cached without their chapter, which is only used for creating copies of them
+        for image in image_list:
+            image.chapter = None
+        return image_list
     
     def _parse_image_list(self, chapter, data):
-        doc = BeautifulSoup(data, 'html.parser')
+        doc = PluginBase.parse_html(data)
         list_of_images = []
         outer_div = doc.find('div', class_='board')
         inner_div = outer_div.find('div', class_='info')
@@ -108,7 +120,7 @@ class MangaParkPlugin(PluginBase.PluginBase):
     @staticmethod
     def __parse_image_page(page_url):
         response = load_url(page_url)
-        doc = BeautifulSoup(response, 'html.parser')
+        doc = PluginBase.parse_html(response)
         image = doc.find('a', class_='img-link').find('img')
         # no = image['rel']
         url = image['src']
@@ -6,7 +6,7 @@ from itertools import islice
 
 import src.PluginBase as PluginBase
 from src.data import Manga, Chapter
-from src.helper import memoized
+from src.helper import cached
 
 
 logger = logging.getLogger('MangaLoader.OneMangaPlugin')
@@ -138,7 +138,7 @@ class OneMangaPlugin(PluginBase.PluginBase):
         print('Found {} mangas on site!'.format(len(self.list_of_all_mangas)))
         return self.list_of_all_mangas
 
-    @memoized
+    @cached
     def __getInternalName(self, searchedManga):
         internalName = ''
         #internalName = name
@@ -0,0 +1,133 @@
+"""
+Registry of all plugins in this package. Plugin modules are found by
+scanning their source code for subclasses of PluginBase without importing
+them. The result is cached in a manifest file and only renewed when a plugin
+module changed, so that only the plugin that is actually used is imported.
+"""
+
+import os
+import ast
+import json
+import logging
+import importlib
+from os.path import expanduser
+
+
+logger = logging.getLogger('MangaLoader.plugins')
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_MODULE_SUFFIX = 'Plugin.py'
+MANIFEST_FILE = os.path.join(expanduser('~'), '.MangaLoader', 'plugins.json')
+# manifests written by older versions may list plugins that are not usable
+MANIFEST_VERSION = 2
+# functions of PluginBase that a plugin has to implement to be usable by the Loader
+REQUIRED_FUNCTIONS = ('load_manga_list', 'load_chapter_list', 'load_image_url')
+
+_plugins = None
+
+
+def _get_signature(plugin_dir):
+    """Returns names, sizes and modification times of all plugin modules to detect changes."""
+    signature = []
+    with os.scandir(plugin_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(PLUGIN_MODULE_SUFFIX) and entry.is_file():
+                stat = entry.stat()
+                signature.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    return sorted(signature)
+
+
+def _find_plugin_classes(file_name):
+    """
+    Returns the names of all classes in a module that are derived from
+    PluginBase and implement all required functions. Old plugins that only
+    implement their own interface are skipped.
+    """
+    with open(file_name, 'rb') as f:
+        tree = ast.parse(f.read(), file_name)
+    classes = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        for base in node.bases:
+            base_name = base.attr if isinstance(base, ast.Attribute) else getattr(base, 'id', None)
+            if base_name == 'PluginBase':
+                functions = {n.name for n in node.body if isinstance(n, ast.FunctionDef)}
+                if functions.issuperset(REQUIRED_FUNCTIONS):
+                    classes.append(node.name)
+                break
+    return classes
+
+
+def scan_plugins(plugin_dir=PLUGIN_DIR):
+    """
+    Finds all plugins by scanning the source code of the plugin modules.
+
+    :return: dictionary of plugin name (lower case class name without suffix
+             "Plugin") and a tuple of module name and class name
+    """
+    plugins = {}
+    for file_name, _, _ in _get_signature(plugin_dir):
+        module_name = '{}.{}'.format(__name__, file_name[:-len('.py')])
+        try:
+            class_names = _find_plugin_classes(os.path.join(plugin_dir, file_name))
+        except (OSError, SyntaxError) as e:
+            logger.warning('Could not scan plugin module {}: {}'.format(file_name, e))
+            continue
+        for class_name in class_names:
+            name = class_name[:-len('Plugin')] if class_name.endswith('Plugin') else class_name
+            plugins[name.lower()] = (module_name, class_name)
+    return plugins
+
+
+def load_manifest(manifest_file=MANIFEST_FILE, plugin_dir=PLUGIN_DIR):
+    """
+    Returns all plugins from the manifest file. If the manifest is missing or
+    any plugin module changed, the plugin modules are scanned again and the
+    manifest is renewed.
+    """
+    signature = _get_signature(plugin_dir)
+    try:
+        with open(manifest_file, 'r', encoding='UTF-8') as f:
+            manifest = json.load(f)
+        if (manifest.get('version') == MANIFEST_VERSION and manifest['signature'] == signature
+                and manifest['plugin_dir'] == plugin_dir):
+            return {name: tuple(entry) for name, entry in manifest['plugins'].items()}
+    except (OSError, ValueError, KeyError):
+        logger.debug('No valid plugin manifest found.')
+    plugins = scan_plugins(plugin_dir)
+    try:
+        os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+        with open(manifest_file, 'w', encoding='UTF-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'plugin_dir': plugin_dir, 'signature': signature,
+                       'plugins': plugins}, f, indent=1)
+    except OSError as e:
+        logger.warning('Could not write plugin manifest: {}'.format(e))
+    return plugins
+
+
+def get_plugins():
+    global _plugins
+    if _plugins is None:
+        _plugins = load_manifest()
+    return _plugins
+
+
+def get_plugin_names():
+    """Returns the names of all available plugins."""
+    return sorted(get_plugins())
+
+
+def get_plugin_class(name):
+    """Imports the module of a plugin and returns its class."""
+    try:
+        module_name, class_name = get_plugins()[name.lower()]
+    except KeyError:
+        raise ValueError('Unknown plugin: {}'.format(name))
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_plugin(name):
+    """Returns a new instance of the plugin with the given name."""
+    return get_plugin_class(name)()
+